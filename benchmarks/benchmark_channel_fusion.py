@@ -0,0 +1,88 @@
+"""
+Compare fusing one and several channels of resampled tiles.
+
+Usage:
+    python benchmarks/benchmark_channel_fusion.py [--n-workers N]
+
+Fuses tiled sample datasets with sub-pixel translations (such that all
+tiles are resampled) using napari_stitcher._fusion.fuse_channels, once
+with a single channel and once with several channels, and prints the
+run times and the cost of the multi-channel fusion relative to fusing
+each channel separately. Blending weights, valid regions and sampling
+coordinates are shared between channels, so the relative cost is
+expected to be below one.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from multiview_stitcher import param_utils, spatial_image_utils
+from multiview_stitcher.sample_data import generate_tiled_dataset
+
+from napari_stitcher import _fusion, _scheduler
+
+
+N_CHANNELS = 4
+
+DATASETS = {
+    '2D 3x3 tiles of 512x512': dict(
+        ndim=2, N_t=1, tile_size=512, overlap=50, tiles_x=3, tiles_y=3),
+    '3D 2x2 tiles of 96^3': dict(
+        ndim=3, N_t=1, tile_size=96, overlap=16,
+        tiles_x=2, tiles_y=2, tiles_z=1),
+}
+
+
+def get_sims(dataset_kwargs, N_c):
+    sims = generate_tiled_dataset(dtype=np.uint16, N_c=N_c, **dataset_kwargs)
+    sims = [sim.copy(data=sim.data.persist()) for sim in sims]
+
+    # sub-pixel translations require resampling all tiles
+    affine = param_utils.affine_from_translation(
+        [0.3] * dataset_kwargs['ndim'])
+    for sim in sims:
+        spatial_image_utils.set_sim_affine(
+            sim,
+            param_utils.rebase_affine(
+                param_utils.affine_to_xaffine(affine),
+                spatial_image_utils.get_affine_from_sim(
+                    sim, 'affine_metadata')),
+            transform_key='affine_metadata')
+
+    return sims
+
+
+def time_fusion(sims):
+    start = time.perf_counter()
+    _fusion.fuse_channels(
+        sims, transform_key='affine_metadata',
+        output_chunksize=128).data.compute()
+    return time.perf_counter() - start
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--n-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    print('%-28s %12s %12s %14s' % (
+        'dataset', '1 ch [s]', '%s ch [s]' % N_CHANNELS,
+        'relative cost'), flush=True)
+
+    with _scheduler.scheduler_context(n_workers=args.n_workers):
+
+        for dataset_name, dataset_kwargs in DATASETS.items():
+
+            single_time = time_fusion(get_sims(dataset_kwargs, 1))
+            multi_time = time_fusion(get_sims(dataset_kwargs, N_CHANNELS))
+
+            print('%-28s %12.2f %12.2f %14.2f' % (
+                dataset_name, single_time, multi_time,
+                multi_time / (N_CHANNELS * single_time)),
+                flush=True)
+
+
+if __name__ == '__main__':
+    main()
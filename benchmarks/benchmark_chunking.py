@@ -0,0 +1,94 @@
+"""
+Compare the fusion throughput of planned and fixed output chunk sizes.
+
+Usage:
+    python benchmarks/benchmark_chunking.py [--tile-size 128] [--n-workers N]
+
+Fuses the 3D sample dataset (see napari_stitcher._sample_data), optionally
+with larger tiles, into a zarr store using multiview-stitcher's default
+output chunks, a range of fixed chunk sizes and the chunks planned by
+napari_stitcher._budget.plan_output_chunksize, and prints the run times,
+throughput in megapixels per second and estimated peak memory.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from multiview_stitcher import fusion, msi_utils
+from multiview_stitcher.sample_data import generate_tiled_dataset
+
+from napari_stitcher import _budget, _checkpoint, _scheduler
+
+
+FIXED_CHUNKSIZES = [32, 64, 128]
+
+
+def get_sims(tile_size):
+    # single timepoint of the 3D sample dataset
+    sims = generate_tiled_dataset(
+        ndim=3, N_t=1, N_c=1,
+        tile_size=tile_size, tiles_x=3, tiles_y=3, tiles_z=1,
+        drift_scale=0., shift_scale=2.,
+        overlap=tile_size // 10, zoom=8, dtype=np.uint8)
+    return [sim.copy(data=sim.data.persist()) for sim in sims]
+
+
+def run(sims, output_chunksize, store_path):
+
+    start = time.perf_counter()
+    fused = fusion.fuse(
+        sims, transform_key='affine_metadata',
+        output_chunksize=output_chunksize)
+    _checkpoint.write_msim_to_zarr(
+        msi_utils.get_msim_from_sim(fused, scale_factors=[]), store_path)
+
+    return time.perf_counter() - start, fused.size
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tile-size', type=int, default=30,
+                        help='Tile size, by default that of the sample dataset.')
+    parser.add_argument('--n-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    sims = get_sims(args.tile_size)
+    output_stack_properties = fusion.process_output_stack_properties(
+        sims, transform_key='affine_metadata')
+
+    with _scheduler.scheduler_context(n_workers=args.n_workers):
+
+        planned = _budget.plan_output_chunksize(sims, output_stack_properties)
+
+        configurations = [('default', None)] + \
+            [('fixed %s' % c, c) for c in FIXED_CHUNKSIZES] + \
+            [('planned', planned)]
+
+        print('output shape %s, tile shape %s' % (
+            tuple(int(s) for s in output_stack_properties['shape'].values()),
+            sims[0].data.shape[-3:]), flush=True)
+        print('%-10s %-18s %10s %12s %14s' % (
+            'chunks', 'chunksize', 'fuse [s]', 'fuse [MPx/s]', 'memory [MB]'),
+            flush=True)
+
+        for name, output_chunksize in configurations:
+
+            estimate = _budget.estimate_fusion(
+                sims, 'affine_metadata', output_chunksize=output_chunksize)
+
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fusion_time, size = run(
+                    sims, output_chunksize, Path(tmpdir) / 'fused.zarr')
+
+            print('%-10s %-18s %10.2f %12.1f %14.0f' % (
+                name, tuple(estimate['chunksize'].values()), fusion_time,
+                size / fusion_time / 1e6, estimate['memory'] / 2**20),
+                flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Compare the throughput of registration and fusion between dask schedulers.
+
+Usage:
+    python benchmarks/benchmark_scheduler.py [--n-workers N] [--memory-limit 4GB]
+
+Runs registration and fusion (written into a zarr store) of tiled sample
+datasets using each available scheduler (see napari_stitcher._scheduler)
+and prints the run times and throughput in megapixels per second.
+"""
+import argparse
+import importlib
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from multiview_stitcher import fusion, msi_utils, registration
+from multiview_stitcher.sample_data import generate_tiled_dataset
+
+from napari_stitcher import _checkpoint, _scheduler
+
+
+DATASETS = {
+    '2D 3x3 tiles of 512x512': dict(
+        ndim=2, N_t=1, N_c=1, tile_size=512, overlap=50,
+        tiles_x=3, tiles_y=3),
+    '3D 2x2 tiles of 128^3': dict(
+        ndim=3, N_t=1, N_c=1, tile_size=128, overlap=20,
+        tiles_x=2, tiles_y=2, tiles_z=1),
+}
+
+
+def get_sims(dataset_kwargs):
+    sims = generate_tiled_dataset(dtype=np.uint16, **dataset_kwargs)
+    return [sim.copy(data=sim.data.persist()) for sim in sims]
+
+
+def run(sims, store_path):
+
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims]
+
+    start = time.perf_counter()
+    registration.register(
+        msims,
+        reg_channel_index=0,
+        transform_key='affine_metadata',
+        new_transform_key='affine_registered',
+        pre_registration_pruning_method='keep_axis_aligned',
+    )
+    registration_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fused = fusion.fuse(
+        [msi_utils.get_sim_from_msim(msim) for msim in msims],
+        transform_key='affine_registered')
+    _checkpoint.write_msim_to_zarr(
+        msi_utils.get_msim_from_sim(fused, scale_factors=[]), store_path)
+    fusion_time = time.perf_counter() - start
+
+    return registration_time, fusion_time, fused.size
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--n-workers', type=int, default=None)
+    parser.add_argument('--memory-limit', default=None)
+    args = parser.parse_args()
+
+    schedulers = [
+        scheduler for scheduler in _scheduler.SCHEDULERS
+        if scheduler != _scheduler.SCHEDULER_DISTRIBUTED
+        or importlib.util.find_spec('distributed') is not None]
+
+    print('%-28s %-12s %14s %14s %16s' % (
+        'dataset', 'scheduler', 'register [s]', 'fuse [s]', 'fuse [MPx/s]'),
+        flush=True)
+
+    for dataset_name, dataset_kwargs in DATASETS.items():
+        sims = get_sims(dataset_kwargs)
+
+        for scheduler in schedulers:
+            with tempfile.TemporaryDirectory() as tmpdir, \
+                    _scheduler.scheduler_context(
+                        scheduler,
+                        n_workers=args.n_workers,
+                        memory_limit=args.memory_limit
+                        if scheduler == _scheduler.SCHEDULER_DISTRIBUTED
+                        else None):
+                registration_time, fusion_time, size = run(
+                    sims, Path(tmpdir) / 'fused.zarr')
+
+            print('%-28s %-12s %14.2f %14.2f %16.1f' % (
+                dataset_name, scheduler, registration_time, fusion_time,
+                size / fusion_time / 1e6), flush=True)
+
+    _scheduler.close_local_clusters()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Compare fusing regular grids by resampling and by pasting tiles.
+
+Usage:
+    python benchmarks/benchmark_translation_fusion.py [--n-workers N]
+
+Fuses tiled sample datasets with translations on the output grid using
+multiview-stitcher's fusion (resampling each tile) and
+napari_stitcher._fusion.fuse_channels (pasting tiles and blending only
+their overlaps), and prints the run times, throughput in megapixels per
+second and the largest difference between the results.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from multiview_stitcher import fusion
+from multiview_stitcher.sample_data import generate_tiled_dataset
+
+from napari_stitcher import _budget, _fusion, _scheduler
+
+
+DATASETS = {
+    '2D 3x3 tiles of 1024x1024': dict(
+        ndim=2, N_t=1, N_c=1, tile_size=1024, overlap=100,
+        tiles_x=3, tiles_y=3),
+    '3D 2x2 tiles of 128^3': dict(
+        ndim=3, N_t=1, N_c=1, tile_size=128, overlap=20,
+        tiles_x=2, tiles_y=2, tiles_z=1),
+}
+
+
+def get_sims(dataset_kwargs):
+    sims = generate_tiled_dataset(dtype=np.uint16, **dataset_kwargs)
+    return [sim.copy(data=sim.data.persist()) for sim in sims]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--n-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    print('%-28s %12s %12s %14s %14s %9s %9s' % (
+        'dataset', 'resample [s]', 'paste [s]', 'resample [MPx/s]',
+        'paste [MPx/s]', 'speedup', 'max diff'), flush=True)
+
+    with _scheduler.scheduler_context(n_workers=args.n_workers):
+
+        for dataset_name, dataset_kwargs in DATASETS.items():
+
+            sims = get_sims(dataset_kwargs)
+            output_stack_properties = fusion.process_output_stack_properties(
+                sims, transform_key='affine_metadata')
+            assert _fusion.is_on_output_grid(
+                sims, 'affine_metadata', output_stack_properties)
+
+            output_chunksize = _budget.plan_output_chunksize(
+                sims, output_stack_properties)
+
+            start = time.perf_counter()
+            resampled = fusion.fuse(
+                sims, transform_key='affine_metadata',
+                output_chunksize=output_chunksize).data.compute()
+            resample_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            pasted = _fusion.fuse_channels(
+                sims, transform_key='affine_metadata',
+                output_chunksize=output_chunksize).data.compute()
+            paste_time = time.perf_counter() - start
+
+            print('%-28s %12.2f %12.2f %14.1f %14.1f %9.1f %9d' % (
+                dataset_name, resample_time, paste_time,
+                resampled.size / resample_time / 1e6,
+                resampled.size / paste_time / 1e6,
+                resample_time / paste_time,
+                np.abs(pasted.astype(float) - resampled).max()),
+                flush=True)
+
+
+if __name__ == '__main__':
+    main()
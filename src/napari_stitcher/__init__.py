@@ -4,12 +4,13 @@ from ._reader import napari_get_reader
 from ._sample_data import make_sample_data
 from ._stitcher_widget import StitcherQWidget
 from ._mosaic_widget import MosaicQWidget
-from ._writer import write_multiple, write_single_image
+from ._writer import write_multiple, write_ome_zarr, write_single_image
 
 __all__ = (
     "napari_get_reader",
     "write_single_image",
     "write_multiple",
+    "write_ome_zarr",
     "make_sample_data",
     "StitcherQWidget",
     "MosaicQWidget",
@@ -0,0 +1,518 @@
+"""
+Pre-flight resource estimates for fusion.
+
+Before fusing, the output geometry is derived from the tile extents and
+their transformations. From it, the size of the fused image on disk, the
+peak working memory and the number of dask tasks are estimated. Fusion
+refuses to start if the fused image doesn't fit into the disk budget,
+and uses smaller output chunks if the working memory would exceed the
+memory budget.
+
+Unless given explicitly, output chunks are planned from the tile size,
+data type, number of workers and memory budget (see
+plan_output_chunksize), avoiding both chunks too large to fuse in
+parallel and chunks so small that scheduling overhead dominates.
+
+The budgets can be set using the NAPARI_STITCHER_MEMORY_BUDGET and
+NAPARI_STITCHER_DISK_BUDGET environment variables (in GB). By default,
+half of the available memory and the free space of the cache directory
+are used. The output chunk size can be set using the
+NAPARI_STITCHER_OUTPUT_CHUNKSIZE environment variable (in pixels).
+"""
+import os
+import shutil
+
+import numpy as np
+import dask
+import psutil
+
+from multiview_stitcher import fusion, mv_graph, spatial_image_utils
+
+from napari_stitcher import _utils
+
+
+# fraction of the available memory used by default
+DEFAULT_MEMORY_BUDGET_FRACTION = 0.5
+
+# output chunks are not reduced below this size
+MIN_CHUNKSIZE = 64
+
+# planned output chunks contain at most this many pixels
+MAX_CHUNK_PIXELS = 2**24
+
+# planned output chunks per worker (and timepoint), keeping all
+# workers busy without the scheduling overhead of many small chunks
+CHUNKS_PER_WORKER = 4
+
+
+class BudgetExceededError(Exception):
+    """
+    Raised if a fusion doesn't fit into the configured budgets.
+    """
+    pass
+
+
+def _get_env_nbytes(name):
+    value = os.environ.get(name)
+    if not value:
+        return None
+    return int(float(value) * 2**30)
+
+
+def get_memory_budget():
+    """
+    Memory budget for fusion in bytes. Can be set using the
+    NAPARI_STITCHER_MEMORY_BUDGET environment variable (in GB).
+    """
+    budget = _get_env_nbytes('NAPARI_STITCHER_MEMORY_BUDGET')
+    if budget is None:
+        budget = int(psutil.virtual_memory().available
+                     * DEFAULT_MEMORY_BUDGET_FRACTION)
+    return budget
+
+
+def get_disk_budget(path=None):
+    """
+    Disk budget for fusion in bytes. Can be set using the
+    NAPARI_STITCHER_DISK_BUDGET environment variable (in GB) and
+    defaults to the free space at path (by default the cache directory).
+    """
+    budget = _get_env_nbytes('NAPARI_STITCHER_DISK_BUDGET')
+    if budget is None:
+        if path is None:
+            path = _utils.get_cache_dir()
+        # the target may not exist yet
+        path = os.path.abspath(path)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        budget = shutil.disk_usage(path).free
+    return budget
+
+
+def get_default_output_chunksize():
+    """
+    Output chunk size (in pixels) from the NAPARI_STITCHER_OUTPUT_CHUNKSIZE
+    environment variable. None if not set, i.e. the chunks are planned
+    automatically.
+    """
+    chunksize = os.environ.get('NAPARI_STITCHER_OUTPUT_CHUNKSIZE')
+    return int(chunksize) if chunksize else None
+
+
+def _get_n_workers(n_workers=None):
+    if n_workers is None:
+        n_workers = dask.config.get('num_workers', None) or os.cpu_count() or 1
+    return n_workers
+
+
+def get_chunk_memory(chunk_pixels, n_views, n_c, itemsize):
+    """
+    Estimated peak memory in bytes of fusing one output chunk.
+
+    Parameters
+    ----------
+    chunk_pixels : int
+        Number of (spatial) pixels of the chunk.
+    n_views : int
+        Number of views overlapping with the chunk.
+    n_c : int
+        Number of channels fused together.
+    itemsize : int
+        Bytes per pixel of the input data type.
+    """
+
+    # per view: the input slices and float32 transformed slices of all
+    # channels, float32 blending weights (and their normalized copy)
+    # and the valid mask. The float64 sampling coordinates of one view
+    # at a time (at most 3D). Per channel: the float fused result and
+    # the output in the input dtype
+    return int(chunk_pixels * (
+        n_views * (n_c * (itemsize + 4) + 2 * 4 + 1) + 3 * 8
+        + n_c * (4 + itemsize)))
+
+
+def format_nbytes(nbytes):
+    """
+    Human readable number of bytes.
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return '%.1f %s' % (nbytes, unit)
+        nbytes /= 1024
+    return '%.1f TB' % nbytes
+
+
+def estimate_nbytes(sims, output_stack_properties, scale_factors=None):
+    """
+    Uncompressed bytes on disk of the fused image, including all
+    resolution levels.
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+    output_stack_properties : dict
+        Stack properties of the fused image.
+    scale_factors : list of dict, optional
+        Relative scale factors of the stored resolution levels.
+    """
+
+    if scale_factors is None:
+        scale_factors = []
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+    n_t = len(sims[0].coords['t']) if 't' in sims[0].dims else 1
+    n_c = len(sims[0].coords['c']) if 'c' in sims[0].dims else 1
+    itemsize = np.dtype(sims[0].dtype).itemsize
+
+    level_shape = {dim: int(output_stack_properties['shape'][dim])
+                   for dim in spatial_dims}
+    n_pixels = np.prod(list(level_shape.values()))
+    for level_factors in scale_factors:
+        level_shape = {dim: max(1, level_shape[dim] // level_factors[dim])
+                       for dim in spatial_dims}
+        n_pixels += np.prod(list(level_shape.values()))
+
+    return int(n_t * n_c * itemsize * n_pixels)
+
+
+def get_chunk_view_counts(output_chunk_bbs, views_bb, params, tol=1e-6):
+    """
+    Number of views overlapping with each output chunk.
+
+    Equivalent to testing each pair of chunk and view using
+    mv_graph.get_overlap_for_bbs, but the corners of all chunks are
+    projected into each view at once.
+
+    Parameters
+    ----------
+    output_chunk_bbs : list of dict
+        Stack properties of the output chunks.
+    views_bb : list of dict
+        Stack properties of the views.
+    params : list of xarray.DataArray
+        Affine transformations of the views.
+    tol : float, optional
+
+    Returns
+    -------
+    ndarray of int
+        Number of overlapping views for each chunk.
+    """
+
+    spatial_dims = list(views_bb[0]['shape'].keys())
+    ndim = len(spatial_dims)
+
+    def get_chunk_array(key):
+        return np.array([[bb[key][dim] for dim in spatial_dims]
+                         for bb in output_chunk_bbs], dtype=float)
+
+    # corners of all chunks, of shape (n_chunks, 2 ** ndim, ndim)
+    chunk_extents = (get_chunk_array('shape') - 1) * get_chunk_array('spacing')
+    unit_corners = np.array(list(np.ndindex(tuple([2] * ndim))))
+    corners = get_chunk_array('origin')[:, None] \
+        + unit_corners[None] * chunk_extents[:, None]
+
+    counts = np.zeros(len(output_chunk_bbs), dtype=int)
+    for view_bb, param in zip(views_bb, params):
+
+        inv_param = np.linalg.inv(np.asarray(param.data, dtype=float))
+        corners_view = corners @ inv_param[:ndim, :ndim].T \
+            + inv_param[:ndim, ndim]
+
+        spacing = np.array([view_bb['spacing'][dim] for dim in spatial_dims])
+        view_min = np.array([view_bb['origin'][dim] for dim in spatial_dims])
+        view_max = view_min + (np.array(
+            [view_bb['shape'][dim] for dim in spatial_dims]) - 1) * spacing
+
+        # back-projected chunks cover whole pixels of the view
+        chunk_min = corners_view.min(axis=1)
+        chunk_max = chunk_min + np.ceil(
+            (corners_view.max(axis=1) - chunk_min) / spacing) * spacing
+
+        counts += np.all(
+            (chunk_min - tol <= view_max) & (chunk_max >= view_min - tol),
+            axis=1)
+
+    return counts
+
+
+def estimate_fusion(sims, transform_key, output_chunksize=None,
+                    output_stack_properties=None, scale_factors=None,
+                    n_workers=None):
+    """
+    Estimate the resources needed for fusing sims.
+
+    The views contributing to each output chunk are determined from the
+    transformations of the first timepoint (see get_chunk_view_counts).
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+        Tiles to fuse, with the same channels.
+    transform_key : str
+    output_chunksize : int or dict, optional
+        By default determined from the first tile (see fusion.fuse).
+    output_stack_properties : dict, optional
+        By default the union of the tiles.
+    scale_factors : list of dict, optional
+        Relative scale factors of the stored resolution levels.
+    n_workers : int, optional
+        Number of chunks fused in parallel, by default the number
+        of dask workers (or cores).
+
+    Returns
+    -------
+    dict
+        shape: spatial shape of the fused image,
+        chunksize: spatial output chunk size,
+        nbytes: (uncompressed) bytes on disk including all levels,
+        chunk_memory: peak working memory of fusing a single chunk,
+        memory: peak working memory when fusing chunks in parallel,
+        n_views: largest number of views overlapping with a chunk,
+        n_tasks: expected number of dask tasks.
+    """
+
+    if scale_factors is None:
+        scale_factors = []
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+    n_t = len(sims[0].coords['t']) if 't' in sims[0].dims else 1
+    n_c = len(sims[0].coords['c']) if 'c' in sims[0].dims else 1
+    itemsize = np.dtype(sims[0].dtype).itemsize
+
+    output_stack_properties = fusion.process_output_stack_properties(
+        sims=sims,
+        output_spacing=None,
+        output_origin=None,
+        output_shape=None,
+        output_stack_properties=output_stack_properties,
+        output_stack_mode='union',
+        transform_key=transform_key,
+    )
+    output_chunksize = fusion.process_output_chunksize(sims, output_chunksize)
+    shape = {dim: int(output_stack_properties['shape'][dim])
+             for dim in spatial_dims}
+
+    nbytes = estimate_nbytes(sims, output_stack_properties, scale_factors)
+
+    level_shape = dict(shape)
+    level_n_chunks = []
+    for level_factors in scale_factors:
+        level_shape = {dim: max(1, level_shape[dim] // level_factors[dim])
+                       for dim in spatial_dims}
+        level_n_chunks.append(np.prod([
+            int(np.ceil(level_shape[dim] / output_chunksize[dim]))
+            for dim in spatial_dims]))
+
+    views_bb = [spatial_image_utils.get_stack_properties_from_sim(sim)
+                for sim in sims]
+    params = [spatial_image_utils.get_affine_from_sim(sim, transform_key)
+              for sim in sims]
+    params = [param.isel(t=0) if 't' in param.dims else param
+              for param in params]
+
+    output_chunk_bbs, _ = mv_graph.get_chunk_bbs(
+        output_stack_properties, output_chunksize)
+
+    chunk_n_views = get_chunk_view_counts(output_chunk_bbs, views_bb, params)
+    chunk_pixels = [
+        int(np.prod([output_chunk_bb['shape'][dim] for dim in spatial_dims]))
+        for output_chunk_bb in output_chunk_bbs]
+
+    chunk_memory = max(
+        get_chunk_memory(pixels, int(n_views), n_c, itemsize)
+        for pixels, n_views in set(zip(chunk_pixels, chunk_n_views)))
+
+    # reading the slices of each view and fusing the chunk
+    n_tasks = int(n_t * (np.sum(chunk_n_views + 1) + sum(level_n_chunks)))
+
+    n_workers = _get_n_workers(n_workers)
+
+    return {
+        'shape': shape,
+        'chunksize': dict(output_chunksize),
+        'nbytes': nbytes,
+        'chunk_memory': chunk_memory,
+        'memory': chunk_memory * min(n_workers, len(output_chunk_bbs)),
+        'n_views': int(np.max(chunk_n_views)),
+        'n_tasks': n_tasks,
+    }
+
+
+def plan_output_chunksize(sims, output_stack_properties, n_workers=None,
+                          memory_budget=None):
+    """
+    Plan the output chunk size of fusing sims.
+
+    Chunks start at half the tile size (rounded down to a power of two),
+    such that in regular grids a chunk overlaps with at most two tiles
+    along each dimension, which bounds the number of views read and
+    blended per chunk. The largest chunk dimension is
+    then halved while chunks contain more than MAX_CHUNK_PIXELS, fusing
+    a chunk on every worker exceeds the memory budget or there are less
+    than CHUNKS_PER_WORKER chunks per worker, as long as chunks are
+    larger than MIN_CHUNKSIZE.
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+    output_stack_properties : dict
+    n_workers : int, optional
+        By default the number of dask workers (or cores).
+    memory_budget : int, optional
+        In bytes, by default get_memory_budget().
+
+    Returns
+    -------
+    dict
+        Chunk size for each spatial dimension.
+    """
+
+    if memory_budget is None:
+        memory_budget = get_memory_budget()
+    n_workers = _get_n_workers(n_workers)
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+    n_c = len(sims[0].coords['c']) if 'c' in sims[0].dims else 1
+    itemsize = np.dtype(sims[0].dtype).itemsize
+    shape = {dim: int(output_stack_properties['shape'][dim])
+             for dim in spatial_dims}
+
+    # chunks smaller than the tiles overlap with at most
+    # two tiles along each dimension in regular grids
+    n_views = min(len(sims), 2 ** len(spatial_dims))
+
+    chunksize = {
+        dim: min(shape[dim], max(MIN_CHUNKSIZE, 2 ** int(np.log2(
+            max(1, sims[0].sizes[dim] // 2)))))
+        for dim in spatial_dims}
+
+    while True:
+        n_chunks = np.prod([int(np.ceil(shape[dim] / chunksize[dim]))
+                            for dim in spatial_dims])
+        chunk_pixels = np.prod(list(chunksize.values()))
+        chunk_memory = get_chunk_memory(chunk_pixels, n_views, n_c, itemsize)
+
+        if chunk_pixels <= MAX_CHUNK_PIXELS and \
+                chunk_memory * min(n_workers, n_chunks) <= memory_budget and \
+                n_chunks >= CHUNKS_PER_WORKER * n_workers:
+            break
+
+        dim = max(chunksize, key=chunksize.get)
+        if chunksize[dim] < 2 * MIN_CHUNKSIZE:
+            break
+        chunksize[dim] = int(np.ceil(chunksize[dim] / 2))
+
+    return chunksize
+
+
+def plan_fusion(sims, transform_key, output_chunksize=None,
+                output_stack_properties=None, scale_factors=None,
+                n_workers=None, memory_budget=None, disk_budget=None,
+                path=None):
+    """
+    Check that fusing sims fits into the memory and disk budgets.
+
+    If the estimated working memory exceeds the memory budget, the
+    largest dimension of the output chunks is halved until it fits.
+    Smaller chunks don't overlap with more views, so the memory of the
+    halved chunks is bounded using the views overlapping with the
+    initial chunks, and the fusion is only estimated again for the
+    resulting chunk size.
+
+    Parameters
+    ----------
+    sims, transform_key, output_stack_properties, scale_factors, n_workers :
+        See estimate_fusion.
+    output_chunksize : int or dict, optional
+        By default planned using plan_output_chunksize.
+    memory_budget : int, optional
+        In bytes, by default get_memory_budget().
+    disk_budget : int, optional
+        In bytes, by default get_disk_budget(path).
+    path : str or Path, optional
+        Location the fused image will be written to.
+
+    Returns
+    -------
+    dict
+        Estimate (see estimate_fusion) using the chosen chunksize.
+
+    Raises
+    ------
+    BudgetExceededError
+        If the fused image exceeds the disk budget or the memory
+        budget can't be met using chunks of at least MIN_CHUNKSIZE.
+    """
+
+    if memory_budget is None:
+        memory_budget = get_memory_budget()
+    if disk_budget is None:
+        disk_budget = get_disk_budget(path)
+
+    if output_chunksize is None:
+        output_stack_properties = fusion.process_output_stack_properties(
+            sims=sims,
+            output_spacing=None,
+            output_origin=None,
+            output_shape=None,
+            output_stack_properties=output_stack_properties,
+            output_stack_mode='union',
+            transform_key=transform_key,
+        )
+        output_chunksize = plan_output_chunksize(
+            sims, output_stack_properties,
+            n_workers=n_workers, memory_budget=memory_budget)
+
+    estimate = estimate_fusion(
+        sims, transform_key,
+        output_chunksize=output_chunksize,
+        output_stack_properties=output_stack_properties,
+        scale_factors=scale_factors,
+        n_workers=n_workers)
+
+    if estimate['nbytes'] > disk_budget:
+        raise BudgetExceededError(
+            'The fused image of shape %s needs %s on disk, exceeding the '
+            'disk budget of %s (see NAPARI_STITCHER_DISK_BUDGET).'
+            % (tuple(estimate['shape'].values()),
+               format_nbytes(estimate['nbytes']),
+               format_nbytes(disk_budget)))
+
+    n_c = len(sims[0].coords['c']) if 'c' in sims[0].dims else 1
+    itemsize = np.dtype(sims[0].dtype).itemsize
+    shape = estimate['shape']
+    n_workers = _get_n_workers(n_workers)
+
+    def get_memory_bound(chunksize):
+        chunk_shape = {dim: min(chunksize[dim], shape[dim]) for dim in shape}
+        n_chunks = np.prod([int(np.ceil(shape[dim] / chunk_shape[dim]))
+                            for dim in shape])
+        return get_chunk_memory(
+            np.prod(list(chunk_shape.values())), estimate['n_views'],
+            n_c, itemsize) * min(n_workers, n_chunks)
+
+    chunksize = estimate['chunksize']
+    memory = estimate['memory']
+    while estimate['memory'] > memory_budget:
+
+        while memory > memory_budget:
+            dim = max(chunksize, key=lambda dim: min(
+                chunksize[dim], shape[dim]))
+            if min(chunksize[dim], shape[dim]) < 2 * MIN_CHUNKSIZE:
+                raise BudgetExceededError(
+                    'Fusion needs %s of working memory, exceeding the memory '
+                    'budget of %s (see NAPARI_STITCHER_MEMORY_BUDGET).'
+                    % (format_nbytes(memory), format_nbytes(memory_budget)))
+            chunksize = chunksize | {dim: chunksize[dim] // 2}
+            memory = get_memory_bound(chunksize)
+
+        estimate = estimate_fusion(
+            sims, transform_key,
+            output_chunksize=chunksize,
+            output_stack_properties=output_stack_properties,
+            scale_factors=scale_factors,
+            n_workers=n_workers)
+        memory = estimate['memory']
+
+    return estimate
@@ -0,0 +1,272 @@
+"""
+Persistent cache of fused images.
+
+Fused images are stored as zarr stores within the napari-stitcher cache
+directory, named by a fingerprint of the fusion inputs and settings
+(see _checkpoint.get_fusion_fingerprint). Fusing the same tiles with the
+same parameters again loads the stored result, also from other widget
+instances and napari sessions. Before and after fusing, the least
+recently used entries are removed to keep the cache within its size
+limit, except for entries in use by this process and entries being
+written by any process. The latter are marked by a heartbeat file next
+to the entry, which is touched regularly while writing (see
+ActiveEntry).
+
+As fused images can be large, their location can be set separately
+from the other caches using the NAPARI_STITCHER_FUSION_CACHE_DIR
+environment variable, e.g. to use a scratch partition.
+"""
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from napari_stitcher import _utils
+
+
+FUSION_CACHE_SUBDIR = 'fusion'
+COMPLETE_FILENAME = '.napari_stitcher_complete'
+ACTIVE_SUFFIX = '.napari_stitcher_active'
+
+# interval in seconds at which entries being written are marked active
+ACTIVE_INTERVAL = 30
+
+# entries marked active more recently (in seconds) are being written
+ACTIVE_TIMEOUT = 4 * ACTIVE_INTERVAL
+
+# default size limit of the fusion cache in bytes
+DEFAULT_FUSION_CACHE_SIZE = 50 * 2**30
+
+# entries in use (e.g. shown in a viewer), which are not evicted
+_retained = {}
+_retained_lock = threading.Lock()
+
+
+def get_fusion_cache_dir():
+    """
+    Return (and create) the directory of the fusion cache. Can be set
+    using the NAPARI_STITCHER_FUSION_CACHE_DIR environment variable and
+    defaults to the 'fusion' subdirectory of the napari-stitcher cache
+    (see _utils.get_cache_dir).
+    """
+    cache_dir = os.environ.get('NAPARI_STITCHER_FUSION_CACHE_DIR')
+    if cache_dir is None:
+        return _utils.get_cache_dir(FUSION_CACHE_SUBDIR)
+
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    return cache_dir
+
+
+def get_fusion_cache_size():
+    """
+    Size limit of the fusion cache in bytes. Can be set using the
+    NAPARI_STITCHER_FUSION_CACHE_SIZE environment variable (in GB).
+    """
+    cache_size = os.environ.get('NAPARI_STITCHER_FUSION_CACHE_SIZE')
+    if cache_size is None:
+        return DEFAULT_FUSION_CACHE_SIZE
+    return int(float(cache_size) * 2**30)
+
+
+def get_entry_path(fingerprint, cache_dir=None):
+    """
+    Location of the cache entry identified by fingerprint.
+    """
+    if cache_dir is None:
+        cache_dir = get_fusion_cache_dir()
+    return Path(cache_dir) / ('fused_%s.zarr' % fingerprint)
+
+
+def is_complete(path):
+    """
+    Whether the cache entry has been written completely.
+    """
+    return (Path(path) / COMPLETE_FILENAME).exists()
+
+
+def mark_complete(path):
+    """
+    Mark a cache entry as completely written (and recently used).
+    """
+    (Path(path) / COMPLETE_FILENAME).touch()
+
+
+def mark_used(path):
+    """
+    Record the access to a cache entry for least recently used eviction.
+    """
+    os.utime(Path(path) / COMPLETE_FILENAME)
+
+
+def retain(path):
+    """
+    Protect a cache entry from eviction while it is in use. Calls
+    are counted, such that an entry can be retained multiple times.
+    """
+    path = Path(path).resolve()
+    with _retained_lock:
+        _retained[path] = _retained.get(path, 0) + 1
+
+
+def release(path):
+    """
+    Allow evicting a cache entry retained using retain again.
+    """
+    path = Path(path).resolve()
+    with _retained_lock:
+        if path not in _retained:
+            return
+        _retained[path] -= 1
+        if not _retained[path]:
+            del _retained[path]
+
+
+def get_active_path(path):
+    """
+    Location of the heartbeat file of a cache entry being written. It
+    is placed next to the entry, such that writing (and overwriting)
+    the entry doesn't remove it.
+    """
+    path = Path(path)
+    return path.parent / ('.%s%s' % (path.name, ACTIVE_SUFFIX))
+
+
+def is_active(path, timeout=ACTIVE_TIMEOUT):
+    """
+    Whether a cache entry is being written, also by another process.
+    """
+    try:
+        return time.time() - os.stat(get_active_path(path)).st_mtime < timeout
+    except OSError:
+        return False
+
+
+class ActiveEntry(object):
+    """
+    Context manager marking a cache entry as being written, which
+    protects it from eviction by all processes. A background thread
+    touches the heartbeat file of the entry every interval seconds,
+    such that entries of crashed processes become evictable again.
+    """
+
+    def __init__(self, path, interval=ACTIVE_INTERVAL):
+        self.active_path = get_active_path(path)
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _touch(self):
+        try:
+            self.active_path.parent.mkdir(parents=True, exist_ok=True)
+            self.active_path.touch()
+        except OSError:
+            pass
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self._touch()
+
+    def __enter__(self):
+        self._touch()
+        self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop_event.set()
+        self.thread.join()
+        try:
+            self.active_path.unlink()
+        except OSError:
+            pass
+
+
+def get_last_used(path):
+    """
+    Time of the last access to a cache entry. Incomplete entries
+    count as used when they were last modified or marked active.
+    """
+    path = Path(path)
+    if is_complete(path):
+        return os.stat(path / COMPLETE_FILENAME).st_mtime
+    last_used = os.stat(path).st_mtime
+    try:
+        last_used = max(last_used, os.stat(get_active_path(path)).st_mtime)
+    except OSError:
+        pass
+    return last_used
+
+
+def get_nbytes(path):
+    """
+    Size of the files within a directory in bytes.
+    """
+    return sum(
+        os.path.getsize(os.path.join(dirpath, fn))
+        for dirpath, _, filenames in os.walk(path)
+        for fn in filenames)
+
+
+def evict(max_nbytes=None, keep=(), cache_dir=None, reserve_nbytes=0):
+    """
+    Remove the least recently used cache entries until the cache
+    fits into max_nbytes. Retained entries (see retain) and entries
+    being written (see ActiveEntry) are kept. Heartbeat files of
+    entries which are no longer active are removed.
+
+    Parameters
+    ----------
+    max_nbytes : int, optional
+        Size limit in bytes, by default get_fusion_cache_size().
+    keep : list of str or Path, optional
+        Further entries which must not be removed, e.g. because
+        they are being written.
+    cache_dir : str or Path, optional
+        By default get_fusion_cache_dir().
+    reserve_nbytes : int, optional
+        Additional bytes to free within the size limit, e.g. for
+        an entry about to be written.
+
+    Returns
+    -------
+    list of Path
+        Removed entries.
+    """
+
+    if max_nbytes is None:
+        max_nbytes = get_fusion_cache_size()
+
+    if cache_dir is None:
+        cache_dir = get_fusion_cache_dir()
+
+    with _retained_lock:
+        keep = {Path(path).resolve() for path in keep} | set(_retained)
+
+    # heartbeats of processes which stopped without removing them
+    for active_path in Path(cache_dir).glob('.*%s' % ACTIVE_SUFFIX):
+        try:
+            if time.time() - os.stat(active_path).st_mtime >= ACTIVE_TIMEOUT:
+                active_path.unlink()
+        except OSError:
+            pass
+
+    entries = sorted(
+        [path for path in Path(cache_dir).iterdir() if path.is_dir()],
+        key=get_last_used)
+
+    nbytes = {path: get_nbytes(path) for path in entries}
+    total_nbytes = sum(nbytes.values())
+
+    removed = []
+    for path in entries:
+        if total_nbytes + reserve_nbytes <= max_nbytes:
+            break
+        if path.resolve() in keep or is_active(path):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_nbytes -= nbytes[path]
+        removed.append(path)
+
+    return removed
@@ -0,0 +1,555 @@
+"""
+Writing of (fused) multiscale images into zarr stores.
+
+All resolution levels are written in a single pass over the highest
+resolution, such that lower levels don't trigger recomputing (fusing)
+the data they are downsampled from.
+
+Time lapses can be written window by window of timepoints, bounding
+the size of the graphs and making timepoints available as they finish.
+
+Fusing large datasets can take many hours. Instead of writing the
+whole (lazy) image at once, the chunks are computed and written in
+batches and each completed chunk is recorded in a checkpoint file
+next to the data, together with a checksum of its content. When
+writing is interrupted, a subsequent call continues with the chunks
+missing from the checkpoint, after validating the recorded ones.
+"""
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import zarr
+import dask.array as da
+from dask import compute, delayed
+
+from multiview_stitcher import msi_utils, spatial_image_utils
+
+from napari_stitcher import _utils
+
+
+CHECKPOINT_FILENAME = '.napari_stitcher_checkpoint'
+
+
+def get_block_checksum(block):
+    """
+    Checksum of the content of a chunk.
+    """
+    return hashlib.sha1(np.ascontiguousarray(block).tobytes()).hexdigest()
+
+
+def get_block_slices(chunks, block_id, offset=None):
+    """
+    Slices of the block with index block_id in an array with (dask) chunks,
+    optionally shifted by offset (in pixels) in each dimension.
+    """
+    if offset is None:
+        offset = (0,) * len(chunks)
+    return tuple(
+        slice(o + sum(dim_chunks[:ind]), o + sum(dim_chunks[:ind + 1]))
+        for dim_chunks, ind, o in zip(chunks, block_id, offset))
+
+
+def get_region_offset(dims, zarr_chunks, region=None):
+    """
+    Offset of a region within a store, in pixels and in (zarr) blocks.
+
+    Parameters
+    ----------
+    dims : tuple of str
+    zarr_chunks : tuple of int
+        Chunk shape of the stored array.
+    region : dict, optional
+        Start index of the region for (some) dims, e.g. {'t': 10}.
+        Starts need to be aligned with the stored chunks.
+
+    Returns
+    -------
+    tuple, tuple
+        Offsets in pixels and in blocks.
+    """
+
+    if region is None:
+        region = {}
+
+    offset = tuple(int(region.get(dim, 0)) for dim in dims)
+    if any(o % c for o, c in zip(offset, zarr_chunks)):
+        raise ValueError('Region %s is not aligned with the chunks %s.'
+                         % (region, zarr_chunks))
+
+    return offset, tuple(o // c for o, c in zip(offset, zarr_chunks))
+
+
+def read_checkpoint(path, fingerprint):
+    """
+    Read the completed chunks recorded in a checkpoint file.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the checkpoint file.
+    fingerprint : str
+        Identifies the written image. Checkpoints written for
+        another fingerprint are ignored.
+
+    Returns
+    -------
+    dict or None
+        Checksums of the completed chunks, keyed by
+        (array name, block_id). None if there's no valid checkpoint.
+    """
+
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+
+    if not len(lines) or lines[0] != fingerprint:
+        return None
+
+    checksums = {}
+    for line in lines[1:]:
+        # the last line can be incomplete if writing was interrupted
+        try:
+            entry = json.loads(line)
+            checksums[(entry['array'], tuple(entry['block_id']))] = \
+                entry['checksum']
+        except (ValueError, KeyError, TypeError):
+            continue
+
+    return checksums
+
+
+def is_valid_block(zarr_array, slices, checksum):
+    """
+    Whether a stored chunk can be read and matches its recorded checksum.
+    """
+    try:
+        block = zarr_array[slices]
+    except Exception:
+        return False
+    return get_block_checksum(block) == checksum
+
+
+def get_valid_blocks(zarr_array, chunks, checksums, array_name,
+                     offset=None, block_offset=None):
+    """
+    Validate recorded chunks by comparing the checksums of the
+    stored data against the checkpoint. Chunks which cannot be read
+    or whose content changed (e.g. partially written ones) are invalid.
+    Chunks are read and hashed in parallel using the active dask scheduler.
+
+    When writing a region of the store (see get_region_offset), only
+    the chunks within the region are validated and their block indices
+    are returned relative to the region.
+    """
+
+    if block_offset is None:
+        block_offset = (0,) * len(chunks)
+
+    block_ids, is_valid = [], []
+    for (name, block_id), checksum in checksums.items():
+        if name != array_name:
+            continue
+        block_id = tuple(ind - o for ind, o in zip(block_id, block_offset))
+        if any(ind < 0 or ind >= len(dim_chunks)
+               for ind, dim_chunks in zip(block_id, chunks)):
+            continue
+        block_ids.append(block_id)
+        is_valid.append(delayed(is_valid_block)(
+            zarr_array, get_block_slices(chunks, block_id, offset), checksum))
+
+    is_valid = compute(*is_valid)
+
+    return {block_id for block_id, valid in zip(block_ids, is_valid) if valid}
+
+
+def write_msim_metadata_to_zarr(msim, path):
+    """
+    Write metadata and coordinates of an msim into a zarr store,
+    but no image data.
+    """
+    for scale_key in msi_utils.get_sorted_scale_keys(msim):
+        if 'chunks' in msim[scale_key]['image'].encoding:
+            del msim[scale_key]['image'].encoding['chunks']
+    msim.to_zarr(str(path), compute=False)
+
+
+def init_zarr_store(msim, path, fingerprint=None):
+    """
+    Create a zarr store with the metadata of msim into which regions
+    can be written (see write_msim_to_zarr and write_msim_to_zarr_resumable).
+
+    Parameters
+    ----------
+    msim : MultiscaleSpatialImage
+        Lazy msim defining the geometry and chunks of the store.
+        Its data is not computed.
+    path : str or Path
+    fingerprint : str, optional
+        If given, a checkpoint for resumable writing is created. An
+        existing store with a checkpoint for the same fingerprint is kept,
+        such that writing can continue.
+
+    Returns
+    -------
+    bool
+        Whether a new store was created.
+    """
+
+    path = Path(path)
+
+    if fingerprint is not None and \
+            read_checkpoint(path / CHECKPOINT_FILENAME, fingerprint) is not None:
+        return False
+
+    if path.exists():
+        shutil.rmtree(path)
+
+    write_msim_metadata_to_zarr(msim, path)
+
+    if fingerprint is not None:
+        with open(path / CHECKPOINT_FILENAME, 'w') as f:
+            f.write(fingerprint + '\n')
+
+    return True
+
+
+def write_msim_to_zarr(msim, path, region=None):
+    """
+    Write a (lazy) msim into a zarr store, computing all resolution
+    levels in a single pass.
+
+    Lower resolution levels of an msim obtained from
+    msi_utils.get_msim_from_sim are downsampled from the graph of the
+    highest resolution. Storing all levels within the same computation
+    computes each chunk of the highest resolution only once.
+
+    Parameters
+    ----------
+    msim : MultiscaleSpatialImage
+        Image to write, dask backed.
+    path : str or Path
+        Path of the zarr store. Existing stores are overwritten,
+        unless region is given.
+    region : dict, optional
+        Start index of msim within an existing store (see init_zarr_store)
+        along non-spatial dims, e.g. {'t': 10}.
+
+    Returns
+    -------
+    MultiscaleSpatialImage
+        msim backed by the zarr store.
+    """
+
+    path = Path(path)
+    if region is None:
+        init_zarr_store(msim, path)
+
+    scale_keys = msi_utils.get_sorted_scale_keys(msim)
+    sources, targets, regions = [], [], []
+    for scale_key in scale_keys:
+        xdata = msim[scale_key]['image']
+        zarr_array = zarr.open_array(
+            str(path / ('%s/image' % scale_key)), mode='r+')
+        offset, _ = get_region_offset(xdata.dims, zarr_array.chunks, region)
+        sources.append(xdata.data)
+        targets.append(zarr_array)
+        regions.append(tuple(
+            slice(o, o + s) for o, s in zip(offset, xdata.shape)))
+
+    da.store(sources, targets, regions=regions, lock=False)
+
+    return msi_utils.multiscale_spatial_image_from_zarr(str(path), chunks={})
+
+
+def get_level_data_from_stored_level(msim, stored_msim, scale_key, prev_scale_key,
+                                     region=None):
+    """
+    Data of a resolution level of msim, downsampled from the previous
+    level stored in stored_msim instead of from the graph of msim.
+
+    Parameters
+    ----------
+    msim : MultiscaleSpatialImage
+        Lazy msim defining the geometry and chunks of the level.
+    stored_msim : MultiscaleSpatialImage
+        Zarr backed msim containing the previous level.
+    scale_key : str
+    prev_scale_key : str
+    region : dict, optional
+        Start index of msim within stored_msim along non-spatial dims.
+
+    Returns
+    -------
+    dask.array.Array
+    """
+
+    sim = msi_utils.get_sim_from_msim(msim, scale=scale_key)
+    prev_sim = msi_utils.get_sim_from_msim(stored_msim, scale=prev_scale_key)
+
+    if region is not None:
+        prev_sim = prev_sim.isel({
+            dim: slice(start, start + sim.sizes[dim])
+            for dim, start in region.items()})
+
+    spacing = spatial_image_utils.get_spacing_from_sim(sim)
+    prev_spacing = spatial_image_utils.get_spacing_from_sim(prev_sim)
+    scale_factor = {dim: int(round(spacing[dim] / prev_spacing[dim]))
+                    for dim in spacing}
+
+    level_sim = msi_utils.get_sim_from_msim(
+        msi_utils.get_msim_from_sim(prev_sim, scale_factors=[scale_factor]),
+        scale='scale1')
+
+    return level_sim.data.rechunk(sim.data.chunks)
+
+
+def write_msim_to_zarr_resumable(
+        msim, path, fingerprint, n_batch=None, desc='Writing chunks',
+        region=None):
+    """
+    Write a (lazy) msim into a zarr store chunk by chunk, continuing
+    a previously interrupted write with the same fingerprint.
+
+    Resolution levels are written one after the other, each lower
+    level being downsampled from the stored previous one.
+
+    Parameters
+    ----------
+    msim : MultiscaleSpatialImage
+        Image to write, dask backed.
+    path : str or Path
+        Path of the zarr store.
+    fingerprint : str
+        Identifies the content of msim, e.g. a hash of the fusion inputs
+        and settings. Existing stores with a different fingerprint are
+        overwritten.
+    n_batch : int, optional
+        Number of chunks computed in parallel, by default the number of cores.
+    desc : str, optional
+        Description shown in the progress bar.
+    region : dict, optional
+        Start index of msim within a store initialized for the same
+        fingerprint (see init_zarr_store) along non-spatial dims,
+        e.g. {'t': 10}.
+
+    Returns
+    -------
+    MultiscaleSpatialImage
+        msim backed by the zarr store.
+    """
+
+    path = Path(path)
+    checkpoint_path = path / CHECKPOINT_FILENAME
+
+    if n_batch is None:
+        n_batch = os.cpu_count() or 1
+
+    if region is None:
+        init_zarr_store(msim, path, fingerprint)
+
+    checksums = read_checkpoint(checkpoint_path, fingerprint)
+    if checksums is None:
+        raise ValueError('No checkpoint for fingerprint %s found in %s.'
+                         % (fingerprint, path))
+
+    stored_msim = msi_utils.multiscale_spatial_image_from_zarr(
+        str(path), chunks={})
+
+    todo_groups = {}
+    scale_keys = msi_utils.get_sorted_scale_keys(msim)
+    for iscale, scale_key in enumerate(scale_keys):
+        array_name = '%s/image' % scale_key
+        xdata = msim[scale_key]['image']
+        if iscale:
+            # read when computed, i.e. after the previous level was written
+            data = get_level_data_from_stored_level(
+                msim, stored_msim, scale_key, scale_keys[iscale - 1], region)
+        else:
+            data = xdata.data
+        zarr_array = zarr.open_array(str(path / array_name), mode='r+')
+        offset, block_offset = get_region_offset(
+            xdata.dims, zarr_array.chunks, region)
+
+        valid_blocks = get_valid_blocks(
+            zarr_array, data.chunks, checksums, array_name,
+            offset, block_offset)
+
+        # group the blocks of all channels of a spatial chunk, as they
+        # can share computations (e.g. fusion weights)
+        for block_id in np.ndindex(data.numblocks):
+            if block_id in valid_blocks:
+                continue
+            group_key = (array_name,) + tuple(
+                ind for dim, ind in zip(xdata.dims, block_id) if dim != 'c')
+            todo_groups.setdefault(group_key, []).append(
+                (array_name, data, zarr_array, block_id, offset, block_offset))
+
+    # batches don't mix resolution levels, as lower levels
+    # are read from the stored higher ones
+    batches = [[]]
+    for group_key, group in todo_groups.items():
+        if len(batches[-1]) >= n_batch or \
+                (len(batches[-1]) and batches[-1][0][0] != group_key[0]):
+            batches.append([])
+        batches[-1] += group
+
+    with open(checkpoint_path, 'a') as f, \
+            _utils.progress(total=sum(len(b) for b in batches), desc=desc) as pbar:
+
+        for batch in batches:
+            if not len(batch):
+                continue
+
+            # compute a batch of chunks in parallel
+            blocks = compute(*[data.blocks[block_id]
+                               for _, data, _, block_id, _, _ in batch])
+
+            for (array_name, data, zarr_array, block_id, offset, block_offset),\
+                    block in zip(batch, blocks):
+                zarr_array[get_block_slices(data.chunks, block_id, offset)] = block
+                f.write(json.dumps({
+                    'array': array_name,
+                    'block_id': [int(ind + o) for ind, o
+                                 in zip(block_id, block_offset)],
+                    'checksum': get_block_checksum(block),
+                }) + '\n')
+                pbar.update(1)
+
+            # make sure completed chunks are recorded before continuing
+            f.flush()
+            os.fsync(f.fileno())
+
+    return msi_utils.multiscale_spatial_image_from_zarr(str(path), chunks={})
+
+
+def write_timepoints_to_zarr(
+        get_sim, t_coords, path, scale_factors=None, n_timepoints=1,
+        fingerprint=None, desc='Writing timepoints'):
+    """
+    Write a lazy image into a zarr store window by window of timepoints,
+    yielding after each window such that the written timepoints can be
+    shown while the remaining ones are computed.
+
+    The graph of each window only covers its timepoints, such that its
+    size doesn't grow with the number of timepoints.
+
+    Parameters
+    ----------
+    get_sim : callable
+        Returns the lazy sim of the given timepoint coordinates (e.g.
+        by fusing them). All windows need to share the same geometry.
+    t_coords : array-like
+        Coordinates of all timepoints.
+    path : str or Path
+        Path of the zarr store, chunked by single timepoints.
+    scale_factors : list, optional
+        Resolution levels, see msi_utils.get_msim_from_sim.
+        By default no lower resolution levels are written.
+    n_timepoints : int, optional
+        Number of timepoints written together, by default 1.
+    fingerprint : str, optional
+        If given, writing is resumable (see write_msim_to_zarr_resumable).
+    desc : str, optional
+        Description shown in the progress bar.
+
+    Yields
+    ------
+    int
+        Number of timepoints written so far.
+
+    Returns
+    -------
+    MultiscaleSpatialImage
+        Image backed by the zarr store.
+    """
+
+    if scale_factors is None:
+        scale_factors = []
+
+    t_coords = np.asarray(t_coords)
+
+    # store for all timepoints with the geometry of the first window
+    sim = get_sim(t_coords[:n_timepoints])
+    template_sim = sim.isel(t=np.zeros(len(t_coords), dtype=int))\
+        .assign_coords(t=t_coords)
+    template_sim = template_sim.copy(data=da.zeros(
+        template_sim.shape, dtype=sim.dtype,
+        chunks=tuple((1,) * len(t_coords) if dim == 't' else dim_chunks
+                     for dim, dim_chunks in zip(sim.dims, sim.data.chunks))))
+
+    init_zarr_store(
+        msi_utils.get_msim_from_sim(template_sim, scale_factors=scale_factors),
+        path, fingerprint)
+
+    with _utils.progress(total=len(t_coords), desc=desc) as pbar:
+        for it in range(0, len(t_coords), n_timepoints):
+
+            if it:
+                sim = get_sim(t_coords[it: it + n_timepoints])
+            sim = sim.chunk({'t': 1})
+
+            msim = msi_utils.get_msim_from_sim(sim, scale_factors=scale_factors)
+
+            if fingerprint is None:
+                with _utils.TqdmCallback(tqdm_class=_utils.progress, bar_format=" ",
+                                         desc='%s (timepoint %s)' % (desc, it)):
+                    write_msim_to_zarr(msim, path, region={'t': it})
+            else:
+                write_msim_to_zarr_resumable(
+                    msim, path, fingerprint, region={'t': it},
+                    desc='%s (timepoint %s)' % (desc, it))
+
+            pbar.update(len(sim.coords['t']))
+            yield it + len(sim.coords['t'])
+
+    return msi_utils.multiscale_spatial_image_from_zarr(str(path), chunks={})
+
+
+def get_fusion_fingerprint(sims, transform_key, **fusion_kwargs):
+    """
+    Identify a fusion by the names, geometry and transformation
+    parameters of its input tiles and the fusion settings.
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+        Input tiles (already restricted to the fused channel and timepoints).
+    transform_key : str
+        Transform key used for fusion.
+    **fusion_kwargs
+        Further (json serializable) fusion settings.
+
+    Returns
+    -------
+    str
+    """
+
+    tiles = []
+    for sim in sims:
+        spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sim)
+        tiles.append({
+            'name': str(sim.name),
+            'dims': list(sim.dims),
+            'shape': [int(s) for s in sim.shape],
+            'dtype': str(sim.dtype),
+            'spacing': [float(spatial_image_utils.get_spacing_from_sim(sim)[dim])
+                        for dim in spatial_dims],
+            'origin': [float(spatial_image_utils.get_origin_from_sim(sim)[dim])
+                       for dim in spatial_dims],
+            'coords': {dim: [str(c) for c in np.atleast_1d(sim.coords[dim].values)]
+                       for dim in ['t', 'c'] if dim in sim.coords},
+            'params': np.asarray(spatial_image_utils.get_affine_from_sim(
+                sim, transform_key)).round(10).tolist(),
+        })
+
+    return hashlib.sha1(json.dumps({
+        'tiles': tiles,
+        'transform_key': transform_key,
+        'fusion_kwargs': fusion_kwargs,
+    }, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,408 @@
+"""
+On-disk index of CZI mosaic metadata.
+
+Determining the number of scenes and the tile layout of a CZI mosaic
+requires parsing the file's metadata and its whole subblock directory,
+which takes a long time for large acquisitions. The information needed
+to lazily rebuild the tiles is therefore stored in a small json file,
+keyed by the path, size and modification time of the CZI file.
+
+The index contains the file position and size of each subblock segment,
+so that tiles are read with a single read of their segment, without
+opening the file through czifile (which parses the subblock directory).
+Contrast limits estimated the first time a scene is loaded are stored
+along with it, so that reopening a file doesn't read pixel data.
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+import dask.array as da
+from dask import delayed
+from tifffile import FileHandle
+
+from multiview_stitcher import czi_utils, spatial_image_utils
+from multiview_stitcher.io import METADATA_TRANSFORM_KEY
+
+from napari_stitcher import _utils
+
+
+# increase when the layout of the index changes to invalidate old entries
+CZI_INDEX_VERSION = 3
+
+# maximum number of files kept in the index cache
+CZI_INDEX_MAX_ENTRIES = 64
+
+# size of the header preceding the data of each segment
+CZI_SEGMENT_HEADER_SIZE = 32
+
+# serializes updates of index files from threads loading several scenes
+_index_lock = threading.Lock()
+
+
+def _get_index_path(path, cache_dir):
+    key = hashlib.sha1(str(Path(path).resolve()).encode()).hexdigest()
+    return Path(cache_dir) / ('%s.json' % key)
+
+
+def _load_index_entry(index_path):
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_valid_index_entry(entry):
+    if entry is None or entry.get('version') != CZI_INDEX_VERSION:
+        return False
+    try:
+        return entry['signature'] == _utils.get_file_signature(
+            entry['signature']['path'])
+    except OSError:
+        return False
+
+
+def get_czi_scene_names(path, n_scenes):
+    """
+    Get the scene names of a CZI file.
+
+    Scenes without (unique) name are named by their index.
+    """
+
+    metadata = czi_utils.open_czi(path).metadata(raw=False)
+
+    try:
+        meta_scenes = metadata['ImageDocument']['Metadata']['Information'][
+            'Image']['Dimensions']['S']['Scenes']['Scene']
+    except (KeyError, TypeError):
+        meta_scenes = []
+
+    if isinstance(meta_scenes, dict):
+        meta_scenes = [meta_scenes]
+
+    scene_names = ['scene_%03d' % iscene for iscene in range(n_scenes)]
+    for iscene, meta_scene in enumerate(meta_scenes):
+        iscene = int(meta_scene.get('Index', iscene))
+        if iscene < n_scenes and meta_scene.get('Name'):
+            scene_names[iscene] = str(meta_scene['Name'])
+
+    if len(set(scene_names)) < n_scenes:
+        scene_names = ['%s_%03d' % (name, iscene)
+                       for iscene, name in enumerate(scene_names)]
+
+    return scene_names
+
+
+def build_czi_index(path):
+    """
+    Parse the metadata and subblock directory of a CZI mosaic.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the CZI file.
+
+    Returns
+    -------
+    dict
+        json serializable index containing the number and names of
+        scenes, spacing, dtype, channel names, the tile positions of
+        each scene and the subblock entries (including the position
+        and size of their segments in the file) needed to read the
+        tiles lazily.
+    """
+
+    from czifile.czifile import Segment
+
+    czifile_file = czi_utils.open_czi(path)
+    directory = czifile_file.filtered_subblock_directory
+
+    shape = czi_utils.get_czi_shape(path)
+    spacing = {k.upper(): v
+               for k, v in czi_utils.get_spacing_from_czi(path).items()}
+
+    axes = directory[0].axes
+    valid_axes = [dim for dim in axes if dim not in ['0', 'M']]
+
+    entries = []
+    intervals = {}
+    for directory_entry in directory:
+
+        pos = {dim.dimension: int(dim.start)
+               if dim.dimension not in ['Y', 'X'] else 0
+               for dim in directory_entry.dimension_entries}
+
+        segment = Segment(czifile_file._fh, directory_entry.file_position)
+
+        entries.append({
+            'file_position': int(directory_entry.file_position),
+            'segment_size': CZI_SEGMENT_HEADER_SIZE + int(segment.used_size),
+            'pos': pos,
+            'shape': [int(directory_entry.stored_shape[i])
+                      for i, dim in enumerate(axes) if dim in valid_axes],
+        })
+
+        # tile intervals in physical coordinates for each scene
+        scene_intervals = intervals.setdefault(str(pos.get('S', 0)), {})
+        tile_intervals = scene_intervals.setdefault(
+            str(pos['M']),
+            {dim: [np.inf, -np.inf] for dim in spacing})
+
+        for dim in directory_entry.dimension_entries:
+            if dim.dimension not in spacing:
+                continue
+            tile_intervals[dim.dimension] = [
+                min(tile_intervals[dim.dimension][0],
+                    dim.start * spacing[dim.dimension]),
+                max(tile_intervals[dim.dimension][1],
+                    (dim.start + dim.size - 1) * spacing[dim.dimension]),
+            ]
+
+    n_scenes = int(shape.get('S', 1))
+
+    return {
+        'n_scenes': n_scenes,
+        'scene_names': get_czi_scene_names(path, n_scenes),
+        'shape': {k: int(v) for k, v in shape.items()},
+        'axes': axes,
+        'dtype': np.dtype(directory[0].dtype).name,
+        'spacing': spacing,
+        'channel_names': [str(c)
+                          for c in czi_utils.get_czi_channel_names(path)],
+        'intervals': intervals,
+        'entries': entries,
+        'contrast_limits': {},
+    }
+
+
+def evict_czi_index_cache(cache_dir=None, max_entries=CZI_INDEX_MAX_ENTRIES):
+    """
+    Remove stale index entries and keep at most max_entries,
+    evicting the least recently used ones first.
+    """
+
+    if cache_dir is None:
+        cache_dir = _utils.get_cache_dir('czi_index')
+
+    index_paths = []
+    for index_path in Path(cache_dir).glob('*.json'):
+        if not _is_valid_index_entry(_load_index_entry(index_path)):
+            index_path.unlink(missing_ok=True)
+        else:
+            index_paths.append(index_path)
+
+    index_paths = sorted(index_paths, key=lambda p: p.stat().st_mtime)
+    for index_path in index_paths[:max(0, len(index_paths) - max_entries)]:
+        index_path.unlink(missing_ok=True)
+
+
+def get_czi_index(path, cache_dir=None):
+    """
+    Get the index of a CZI mosaic, using the on-disk cache if possible.
+
+    Entries are invalidated when the size or modification time of
+    the file changes.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the CZI file.
+    cache_dir : str or Path, optional
+        Directory containing the index cache. By default
+        the 'czi_index' subdirectory of the napari-stitcher cache.
+
+    Returns
+    -------
+    dict
+        Index as returned by `build_czi_index`.
+    """
+
+    if cache_dir is None:
+        cache_dir = _utils.get_cache_dir('czi_index')
+
+    index_path = _get_index_path(path, cache_dir)
+    signature = _utils.get_file_signature(path)
+
+    entry = _load_index_entry(index_path)
+    if entry is not None \
+            and entry.get('version') == CZI_INDEX_VERSION \
+            and entry.get('signature') == signature:
+        # mark entry as recently used
+        os.utime(index_path)
+        return entry['index']
+
+    index = build_czi_index(path)
+
+    tmp_index_path = index_path.with_suffix('.json.tmp')
+    with open(tmp_index_path, 'w') as f:
+        json.dump({
+            'version': CZI_INDEX_VERSION,
+            'signature': signature,
+            'index': index,
+        }, f)
+    os.replace(tmp_index_path, index_path)
+
+    evict_czi_index_cache(cache_dir)
+
+    return index
+
+
+def set_czi_index_contrast_limits(
+        path, scene_index, contrast_limits, cache_dir=None):
+    """
+    Store the contrast limits of a scene in the index of a CZI file.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the CZI file.
+    scene_index : int
+    contrast_limits : dict
+        Contrast limits [lower, upper] for each channel name.
+    cache_dir : str or Path, optional
+        Directory containing the index cache. By default
+        the 'czi_index' subdirectory of the napari-stitcher cache.
+    """
+
+    if cache_dir is None:
+        cache_dir = _utils.get_cache_dir('czi_index')
+
+    index_path = _get_index_path(path, cache_dir)
+
+    with _index_lock:
+        entry = _load_index_entry(index_path)
+        if not _is_valid_index_entry(entry):
+            return
+
+        entry['index'].setdefault('contrast_limits', {})[str(scene_index)] = \
+            contrast_limits
+
+        tmp_index_path = index_path.with_suffix('.json.tmp')
+        with open(tmp_index_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_index_path, index_path)
+
+
+def read_czi_subblock(path, file_position, segment_size, slices=None):
+    """
+    Read the data of a subblock from its segment in a CZI file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the CZI file.
+    file_position : int
+        Position of the subblock segment in the file.
+    segment_size : int
+        Size of the segment including its header.
+    slices : tuple of slice, optional
+        Applied to the subblock data.
+
+    Returns
+    -------
+    ndarray
+    """
+
+    from czifile.czifile import Segment
+
+    with open(path, 'rb') as f:
+        f.seek(file_position)
+        segment_bytes = f.read(segment_size)
+
+    subblock = Segment(FileHandle(io.BytesIO(segment_bytes)), 0).data()
+    plane = subblock.data(resize=True, order=1)
+
+    if slices is not None:
+        plane = plane[slices]
+
+    return plane
+
+
+def read_mosaic_into_sims_from_czi_index(path, index, scene_index=0):
+    """
+    Lazily read the tiles of a CZI mosaic scene into a list of sims.
+
+    Equivalent to `multiview_stitcher.io.read_mosaic_into_sims`, but
+    uses a previously built index instead of parsing the file.
+    """
+
+    path = str(path)
+    axes = index['axes']
+    shape = index['shape']
+    spacing = index['spacing']
+
+    valid_axes = [dim for dim in axes if dim not in ['0', 'M']]
+
+    # there's a dimension "0" appended to the axes of the data segment
+    if '0' in axes:
+        slices = [slice(None) for _ in axes]
+        slices[axes.index('0')] = 0
+        slices = tuple(slices)
+    else:
+        slices = None
+
+    m_planes = {}
+    for entry in index['entries']:
+        pos = entry['pos']
+        if 'S' in pos and pos['S'] != scene_index:
+            continue
+
+        data = da.from_delayed(
+            delayed(read_czi_subblock)(
+                path, entry['file_position'], entry['segment_size'], slices),
+            shape=entry['shape'],
+            dtype=index['dtype'],
+        )
+
+        coords = {
+            k: [v] if k not in ['Y', 'X']
+            else np.linspace(v, v + shape[k] - 1, shape[k]) * spacing[k]
+            for k, v in pos.items() if k in valid_axes
+        }
+
+        m_planes.setdefault(pos['M'], []).append(
+            xr.DataArray(data, dims=valid_axes, coords=coords))
+
+    xims = []
+    for m in sorted(m_planes.keys()):
+        xim = xr.combine_by_coords([p.rename(None) for p in m_planes[m]])
+        xims.append(xim.assign_coords(C=index['channel_names']))
+
+    dims_to_drop = [dim for idim, dim in enumerate(xims[0].dims)
+                    if xims[0].shape[idim] == 1 and dim not in ['C']]
+
+    intervals = index['intervals'][str(scene_index)]
+
+    sims = []
+    for m, xim in zip(sorted(m_planes.keys()), xims):
+        xim = xim.squeeze(dims_to_drop, drop=True)
+        xim = xim.rename({dim: dim.lower() for dim in xim.dims})
+
+        spatial_dims = [dim for dim in xim.dims
+                        if dim in spatial_image_utils.SPATIAL_DIMS]
+
+        sim = spatial_image_utils.get_sim_from_array(
+            xim.data,
+            dims=xim.dims,
+            scale=spatial_image_utils.get_spacing_from_sim(xim),
+            translation=spatial_image_utils.get_origin_from_sim(xim),
+            transform_key=METADATA_TRANSFORM_KEY,
+            c_coords=xim.coords['c'].values if 'c' in xim.dims else None,
+            t_coords=xim.coords['t'].values if 't' in xim.dims else None,
+        )
+
+        # set tile positions
+        sim = sim.assign_coords(
+            {sdim: sim.coords[sdim].values
+             + intervals[str(m)][sdim.upper()][0]
+             for sdim in spatial_dims})
+
+        sims.append(sim)
+
+    return sims
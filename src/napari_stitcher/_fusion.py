@@ -0,0 +1,642 @@
+"""
+Fusion of multi-channel tiles.
+
+multiview_stitcher's fusion processes each channel separately, so that
+blending weights are computed again for every channel. Here, all
+channels of an output chunk are fused in one task, computing the
+blending weights and sampling coordinates of the contributing tiles
+only once.
+
+Tiles translated by multiples of the output spacing (e.g. regular grids
+registered to integer shifts) are pasted into output chunks without
+resampling, and blending weights are only computed where tiles overlap.
+Other transformations fall back to resampling.
+"""
+import numpy as np
+from scipy import ndimage
+
+import dask.array as da
+from dask import delayed
+
+from multiview_stitcher import (
+    fusion,
+    mv_graph,
+    spatial_image_utils,
+    weights,
+)
+
+
+def get_grid_shifts(param, view_bb, output_stack_properties):
+    """
+    Position (in output pixels) of the first pixel of a tile within the
+    output, for each dimension in which the tile is translated by a
+    multiple of the output spacing. None for the other dimensions.
+    """
+
+    spatial_dims = [dim for dim in spatial_image_utils.SPATIAL_DIMS
+                    if dim in view_bb['spacing']]
+    ndim = len(spatial_dims)
+    param = np.asarray(param)
+
+    is_translation = np.allclose(param[:ndim, :ndim], np.eye(ndim))
+
+    shifts = {}
+    for idim, dim in enumerate(spatial_dims):
+        spacing = output_stack_properties['spacing'][dim]
+        shift = (view_bb['origin'][dim] + param[idim, ndim]
+                 - output_stack_properties['origin'][dim]) / spacing
+        is_aligned = is_translation and \
+            np.isclose(view_bb['spacing'][dim], spacing) and \
+            np.isclose(shift, np.round(shift), rtol=0, atol=1e-6)
+        shifts[dim] = int(np.round(shift)) if is_aligned else None
+
+    return shifts
+
+
+def get_interpolation_extent(
+        param, view_bb, output_stack_properties, interpolation_order=1):
+    """
+    Extent (in pixels) by which tile slices need to be padded to
+    interpolate the output. Dimensions in which the tile is translated
+    by a multiple of the output spacing need no padding, which reduces
+    the data loaded per chunk. Such tiles are still resampled by
+    fuse_chunk_channels; resampling is only skipped when all tiles lie
+    on the output grid (see get_pasted_chunk).
+    """
+
+    return {
+        dim: 0 if shift is not None else int(interpolation_order)
+        for dim, shift in get_grid_shifts(
+            param, view_bb, output_stack_properties).items()}
+
+
+def is_on_output_grid(sims, transform_key, output_stack_properties):
+    """
+    Whether all tiles are translated by multiples of the output spacing
+    at all timepoints, such that they can be fused without resampling.
+    """
+
+    for sim in sims:
+        view_bb = spatial_image_utils.get_stack_properties_from_sim(sim)
+        param = spatial_image_utils.get_affine_from_sim(sim, transform_key)
+        tparams = [param.sel(t=t) for t in param.coords['t'].values] \
+            if 't' in param.dims else [param]
+        for tparam in tparams:
+            if None in get_grid_shifts(
+                    tparam, view_bb, output_stack_properties).values():
+                return False
+
+    return True
+
+
+def get_translation_blending_weights(
+        target_bb, source_bb, translation, blending_widths=None):
+    """
+    Blending weights of a translated tile, equal to those of
+    weights.get_blending_weights. As the target pixels form a grid
+    aligned with the tile, the interpolation of the weight support is
+    separated into one linear interpolation per dimension, avoiding
+    the overhead of resampling.
+
+    Parameters
+    ----------
+    target_bb : dict
+        Stack properties of the target region.
+    source_bb : dict
+        Stack properties of the full tile.
+    translation : dict
+        Physical translation of the tile for each spatial dimension.
+    blending_widths : dict, optional
+        Physical blending widths for each spatial dimension.
+
+    Returns
+    -------
+    ndarray
+        Weights of shape target_bb['shape'] (float32).
+    """
+
+    if blending_widths is None:
+        blending_widths = {'z': 3, 'y': 10, 'x': 10}
+
+    spatial_dims = [dim for dim in spatial_image_utils.SPATIAL_DIMS
+                    if dim in source_bb['shape']]
+
+    # distance transform on a coarse support slightly larger than the tile
+    support_spacing = {
+        dim: (source_bb['shape'][dim] - 1) / 4 * source_bb['spacing'][dim]
+        * (source_bb['shape'][dim] + 1) / (source_bb['shape'][dim] - 1)
+        for dim in spatial_dims}
+    support_origin = {
+        dim: source_bb['origin'][dim] - source_bb['spacing'][dim]
+        for dim in spatial_dims}
+
+    mask = np.zeros([5] * len(spatial_dims))
+    mask[(slice(1, -1),) * len(spatial_dims)] = 1
+    support = ndimage.distance_transform_edt(
+        mask,
+        sampling=[support_spacing[dim] / blending_widths[dim]
+                  for dim in spatial_dims]).astype(np.float32)
+
+    # multilinear interpolation at the target pixels, zero outside,
+    # as one interpolation matrix per dimension
+    target_weights = support
+    for idim, dim in enumerate(spatial_dims):
+        coords = (target_bb['origin'][dim] - translation[dim]
+                  + np.arange(target_bb['shape'][dim]) * target_bb['spacing'][dim]
+                  - support_origin[dim]) / support_spacing[dim]
+        interpolation = np.stack([
+            np.interp(coords, np.arange(5), np.eye(5)[i], left=0, right=0)
+            for i in range(5)], axis=-1)
+        target_weights = np.moveaxis(np.tensordot(
+            interpolation, target_weights, axes=([1], [idim])), 0, idim)
+
+    target_weights = target_weights.astype(np.float32)
+    mask = target_weights < 1
+    target_weights[mask] = (np.cos((1 - target_weights[mask]) * np.pi) + 1) / 2
+
+    return np.clip(target_weights, 0, 1)
+
+
+def _get_region_slices(start, stop, offset=0):
+    return tuple(slice(int(b - o), int(e - o))
+                 for b, e, o in zip(start, stop, np.broadcast_to(offset, len(start))))
+
+
+def paste_chunk_channels(
+        view_slices, slice_starts, params, output_properties, full_view_bbs,
+        blending_widths=None):
+    """
+    Fuse all channels of one output chunk from tiles translated by
+    multiples of the output spacing. The tiles are pasted into the
+    chunk and only the regions in which tiles overlap are blended,
+    using weighted average fusion as in fuse_chunk_channels.
+
+    Parameters
+    ----------
+    view_slices : list of ndarray
+        Parts of the tiles overlapping with the chunk, of shape
+        (c, *spatial_shape).
+    slice_starts : list of tuple
+        Position of the first pixel of each slice within the chunk.
+    params : list of xarray.DataArray
+        Affine transformations of the tiles.
+    output_properties : dict
+        Stack properties of the output chunk.
+    full_view_bbs : list of dict
+        Stack properties of the full tiles.
+    blending_widths : dict, optional
+        Physical blending widths for each spatial dimension.
+
+    Returns
+    -------
+    ndarray
+        Fused chunk of shape (c, *spatial_shape).
+    """
+
+    spatial_dims = [dim for dim in spatial_image_utils.SPATIAL_DIMS
+                    if dim in output_properties['shape']]
+    chunk_shape = tuple(int(output_properties['shape'][dim])
+                        for dim in spatial_dims)
+    dtype = view_slices[0].dtype
+
+    translations = [
+        {dim: float(np.asarray(param)[idim, len(spatial_dims)])
+         for idim, dim in enumerate(spatial_dims)}
+        for param in params]
+
+    starts = [np.array(start) for start in slice_starts]
+    stops = [start + view_slice.shape[1:]
+             for start, view_slice in zip(starts, view_slices)]
+
+    fused = np.zeros((view_slices[0].shape[0],) + chunk_shape, dtype=dtype)
+    for start, stop, view_slice in zip(starts, stops, view_slices):
+        fused[(slice(None),) + _get_region_slices(start, stop)] = view_slice
+
+    # regions in which pairs of tiles overlap, without
+    # those contained in others (e.g. where more tiles meet)
+    overlaps = set()
+    for iview in range(len(view_slices)):
+        for jview in range(iview + 1, len(view_slices)):
+            start = np.maximum(starts[iview], starts[jview])
+            stop = np.minimum(stops[iview], stops[jview])
+            if np.all(stop > start):
+                overlaps.add((tuple(start), tuple(stop)))
+    overlaps = [
+        (start, stop) for start, stop in overlaps
+        if not any(np.all(np.array(other_start) <= start)
+                   and np.all(np.array(other_stop) >= stop)
+                   for other_start, other_stop in overlaps
+                   if (other_start, other_stop) != (start, stop))]
+
+    for overlap_start, overlap_stop in overlaps:
+
+        overlap_properties = {
+            'spacing': output_properties['spacing'],
+            'origin': {dim: output_properties['origin'][dim]
+                       + overlap_start[idim] * output_properties['spacing'][dim]
+                       for idim, dim in enumerate(spatial_dims)},
+            'shape': {dim: int(overlap_stop[idim] - overlap_start[idim])
+                      for idim, dim in enumerate(spatial_dims)},
+        }
+
+        # tiles pasted into the overlap region, NaN where invalid
+        iviews, transformed_views = [], []
+        for iview, (start, stop) in enumerate(zip(starts, stops)):
+            local_start = np.maximum(start, overlap_start)
+            local_stop = np.minimum(stop, overlap_stop)
+            if np.any(local_stop <= local_start):
+                continue
+            transformed = np.full(
+                (fused.shape[0],) + tuple(overlap_properties['shape'].values()),
+                np.nan, dtype=np.float32)
+            transformed[(slice(None),) + _get_region_slices(
+                local_start, local_stop, overlap_start)] = \
+                view_slices[iview][(slice(None),) + _get_region_slices(
+                    local_start, local_stop, start)]
+            iviews.append(iview)
+            transformed_views.append(transformed)
+        transformed_views = np.stack(transformed_views)
+
+        blending_weights = weights.normalize_weights(np.stack([
+            get_translation_blending_weights(
+                target_bb=overlap_properties,
+                source_bb=full_view_bbs[iview],
+                translation=translations[iview],
+                blending_widths=blending_widths,
+            )
+            for iview in iviews]) * ~np.isnan(transformed_views[:, 0]))
+
+        with np.errstate(invalid='ignore'):
+            fused_overlap = np.stack([
+                fusion.weighted_average_fusion(
+                    transformed_views[:, ich], blending_weights)
+                for ich in range(fused.shape[0])])
+
+        fused[(slice(None),) + _get_region_slices(overlap_start, overlap_stop)] = \
+            np.nan_to_num(fused_overlap).astype(dtype)
+
+    return fused
+
+
+def get_pasted_chunk(
+        view_data, view_starts, params, views_bb, output_chunk_bb,
+        chunk_start, blending_widths=None):
+    """
+    Lazily fused output chunk of tiles translated by multiples of the
+    output spacing. Chunks within a single tile are sliced from the
+    tile, others are fused using paste_chunk_channels.
+
+    Parameters
+    ----------
+    view_data : list of dask.array.Array
+        Tiles of shape (c, *spatial_shape).
+    view_starts : list of tuple
+        Position of the first pixel of each tile within the output.
+    params : list of xarray.DataArray
+    views_bb : list of dict
+    output_chunk_bb : dict
+        Stack properties of the output chunk.
+    chunk_start : tuple
+        Position of the first pixel of the chunk within the output.
+    blending_widths : dict, optional
+
+    Returns
+    -------
+    dask.array.Array
+        Chunk of shape (c, *spatial_shape).
+    """
+
+    spatial_dims = [dim for dim in spatial_image_utils.SPATIAL_DIMS
+                    if dim in output_chunk_bb['shape']]
+    chunk_start = np.array(chunk_start)
+    chunk_stop = chunk_start + [int(output_chunk_bb['shape'][dim])
+                                for dim in spatial_dims]
+    chunk_shape = (view_data[0].shape[0],) + tuple(chunk_stop - chunk_start)
+
+    iviews, starts, stops = [], [], []
+    for iview, (data, view_start) in enumerate(zip(view_data, view_starts)):
+        start = np.maximum(view_start, chunk_start)
+        stop = np.minimum(np.array(view_start) + data.shape[1:], chunk_stop)
+        if np.any(stop <= start):
+            continue
+        iviews.append(iview)
+        starts.append(start)
+        stops.append(stop)
+
+    if not len(iviews):
+        return da.zeros(chunk_shape, dtype=view_data[0].dtype)
+
+    view_slices = [
+        view_data[iview][(slice(None),) + _get_region_slices(
+            start, stop, view_starts[iview])]
+        for iview, start, stop in zip(iviews, starts, stops)]
+
+    # chunks within a single tile are copied from it
+    if len(iviews) == 1 and np.all(starts[0] == chunk_start) \
+            and np.all(stops[0] == chunk_stop):
+        return view_slices[0].rechunk(-1)
+
+    return da.from_delayed(
+        delayed(paste_chunk_channels)(
+            view_slices,
+            [tuple(start - chunk_start) for start in starts],
+            [params[iview] for iview in iviews],
+            output_chunk_bb,
+            [views_bb[iview] for iview in iviews],
+            blending_widths=blending_widths,
+        ),
+        shape=chunk_shape,
+        dtype=view_data[0].dtype,
+    )
+
+
+def get_sampling_coordinates(
+        view_slice, param, output_properties, input_spacing):
+    """
+    Pixel coordinates within view_slice at which the output chunk samples
+    it, as used by transformation.transform_sim. None if the output
+    samples the pixels of view_slice exactly.
+
+    Parameters
+    ----------
+    view_slice : xarray.DataArray
+        Part of a tile, with dims ('c', *spatial_dims).
+    param : xarray.DataArray
+        Affine transformation of the tile.
+    output_properties : dict
+        Stack properties of the output chunk.
+    input_spacing : dict
+        Spacing of the tile.
+
+    Returns
+    -------
+    ndarray or None
+        Coordinates of shape (ndim, *spatial_shape).
+    """
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(view_slice)
+    ndim = len(spatial_dims)
+
+    inv_param = np.linalg.inv(np.asarray(param))
+    matrix = inv_param[:ndim, :ndim]
+    offset = inv_param[:ndim, ndim]
+
+    Sx = np.diag([output_properties['spacing'][dim] for dim in spatial_dims])
+    Sy = np.diag([input_spacing[dim] for dim in spatial_dims])
+    Ox = np.array([output_properties['origin'][dim] for dim in spatial_dims])
+    Oy = spatial_image_utils.get_origin_from_sim(view_slice, asarray=True)
+
+    # map output pixels into input pixels relative to the output origin,
+    # rounded like in transformation.transform_sim
+    matrix_prime = np.around(
+        np.linalg.solve(Sy, np.dot(matrix, Sx)), decimals=10)
+    offset_prime = np.around(np.linalg.solve(
+        Sy, offset + np.dot(matrix - np.eye(ndim), Ox) - (Oy - Ox)),
+        decimals=10)
+    nearest_integer = np.round(offset_prime)
+    near_integer = np.isclose(offset_prime, nearest_integer, rtol=0, atol=1e-6)
+    offset_prime[near_integer] = nearest_integer[near_integer]
+
+    output_shape = tuple(
+        output_properties['shape'][dim] for dim in spatial_dims)
+    input_shape = tuple(view_slice.sizes[dim] for dim in spatial_dims)
+
+    if output_shape == input_shape \
+            and np.allclose(matrix_prime, np.eye(ndim), rtol=0, atol=1e-10) \
+            and np.allclose(offset_prime, 0, rtol=0, atol=1e-10):
+        return None
+
+    return np.tensordot(
+        matrix_prime, np.indices(output_shape, dtype=np.float64), axes=1) \
+        + offset_prime.reshape((ndim,) + (1,) * ndim)
+
+
+def fuse_chunk_channels(
+        view_slices, params, output_properties, full_view_bbs,
+        blending_widths=None, interpolation_order=1):
+    """
+    Fuse all channels of one output chunk using weighted average fusion.
+
+    The blending weights, valid regions and sampling coordinates of each
+    view don't depend on the channel and are computed only once.
+
+    Parameters
+    ----------
+    view_slices : list of xarray.DataArray
+        Parts of the tiles overlapping with the chunk, with dims
+        ('c', *spatial_dims).
+    params : list of xarray.DataArray
+        Affine transformations of the tiles.
+    output_properties : dict
+        Stack properties of the output chunk.
+    full_view_bbs : list of dict
+        Stack properties of the full tiles.
+    blending_widths : dict, optional
+        Physical blending widths for each spatial dimension.
+    interpolation_order : int, optional
+        By default 1.
+
+    Returns
+    -------
+    ndarray
+        Fused chunk of shape (c, *spatial_shape).
+    """
+
+    # blending weights don't depend on the channel
+    blending_weights = np.stack([
+        weights.get_blending_weights(
+            target_bb=output_properties,
+            source_bb=full_view_bb,
+            affine=param,
+            blending_widths=blending_widths,
+        )
+        for param, full_view_bb in zip(params, full_view_bbs)])
+
+    n_c = view_slices[0].shape[0]
+    transformed_views = np.empty(
+        (len(view_slices), n_c) + blending_weights.shape[1:], dtype=np.float32)
+    for iview, (view_slice, param, full_view_bb) in enumerate(
+            zip(view_slices, params, full_view_bbs)):
+
+        coordinates = get_sampling_coordinates(
+            view_slice, param, output_properties, full_view_bb['spacing'])
+
+        view_data = np.asarray(view_slice.data)
+        for ich in range(n_c):
+            if coordinates is None:
+                transformed_views[iview, ich] = view_data[ich]
+            else:
+                transformed_views[iview, ich] = ndimage.map_coordinates(
+                    view_data[ich].astype(np.float32),
+                    coordinates,
+                    order=interpolation_order,
+                    mode='constant',
+                    cval=np.nan,
+                )
+
+    # the valid regions are the same for all channels
+    blending_weights = weights.normalize_weights(
+        blending_weights * ~np.isnan(transformed_views[:, 0]))
+
+    fused = []
+    for ich in range(n_c):
+        with np.errstate(invalid='ignore'):
+            fused.append(fusion.weighted_average_fusion(
+                transformed_views[:, ich], blending_weights))
+
+    return np.nan_to_num(np.stack(fused)).astype(view_slices[0].dtype)
+
+
+def fuse_channels(
+        sims, transform_key, output_chunksize=None,
+        blending_widths=None, interpolation_order=1,
+        output_stack_properties=None):
+    """
+    Fuse multi-channel tiles, sharing the computation of transformed
+    coordinates and blending weights between channels.
+
+    Parameters
+    ----------
+    sims : list of SpatialImage
+        Tiles with dims ('t', 'c', *spatial_dims) and the same channels.
+    transform_key : str
+        Transform key used for fusion.
+    output_chunksize : int or dict, optional
+        By default determined from the first tile.
+    blending_widths : dict, optional
+        Physical blending widths for each spatial dimension.
+    interpolation_order : int, optional
+        By default 1.
+    output_stack_properties : dict, optional
+        Spacing, origin and shape of the fused image. By default the
+        union of the tiles (over all timepoints).
+
+    Returns
+    -------
+    SpatialImage
+        Lazily fused image, chunked by channel.
+    """
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+    c_coords = sims[0].coords['c'].values
+    t_coords = sims[0].coords['t'].values
+
+    output_chunksize = fusion.process_output_chunksize(sims, output_chunksize)
+    output_stack_properties = fusion.process_output_stack_properties(
+        sims=sims,
+        output_spacing=None,
+        output_origin=None,
+        output_shape=None,
+        output_stack_properties=output_stack_properties,
+        output_stack_mode='union',
+        transform_key=transform_key,
+    )
+
+    output_chunk_bbs, block_indices = mv_graph.get_chunk_bbs(
+        output_stack_properties, output_chunksize)
+    nblocks = tuple(np.max(block_indices, 0) + 1)
+
+    views_bb = [spatial_image_utils.get_stack_properties_from_sim(sim)
+                for sim in sims]
+
+    tol = 1e-6
+
+    fused_tps = []
+    for t in t_coords:
+
+        params = [spatial_image_utils.get_affine_from_sim(sim, transform_key)
+                  for sim in sims]
+        params = [param.sel(t=t) if 't' in param.dims else param
+                  for param in params]
+
+        additional_extents = [
+            get_interpolation_extent(
+                param, view_bb, output_stack_properties, interpolation_order)
+            for param, view_bb in zip(params, views_bb)]
+
+        # tiles translated by multiples of the output spacing are pasted
+        grid_shifts = [
+            get_grid_shifts(param, view_bb, output_stack_properties)
+            for param, view_bb in zip(params, views_bb)]
+        on_grid = not any(None in shifts.values() for shifts in grid_shifts)
+        if on_grid:
+            view_data = [
+                sim.sel(t=t).transpose('c', *spatial_dims).data for sim in sims]
+            view_starts = [tuple(shifts[dim] for dim in spatial_dims)
+                           for shifts in grid_shifts]
+
+        fused_chunks = np.empty(nblocks, dtype=object)
+        for block_index, output_chunk_bb in zip(block_indices, output_chunk_bbs):
+
+            if on_grid:
+                fused_chunks[tuple(block_index)] = get_pasted_chunk(
+                    view_data, view_starts, params, views_bb, output_chunk_bb,
+                    chunk_start=tuple(
+                        int(np.round(
+                            (output_chunk_bb['origin'][dim]
+                             - output_stack_properties['origin'][dim])
+                            / output_stack_properties['spacing'][dim]))
+                        for dim in spatial_dims),
+                    blending_widths=blending_widths,
+                )
+                continue
+
+            chunk_shape = tuple([len(c_coords)] +
+                                [output_chunk_bb['shape'][dim] for dim in spatial_dims])
+
+            iviews, view_slices = [], []
+            for iview, (sim, param) in enumerate(zip(sims, params)):
+                overlap_bb = mv_graph.get_overlap_for_bbs(
+                    target_bb=output_chunk_bb,
+                    query_bbs=[views_bb[iview]],
+                    param=param,
+                    additional_extent_in_pixels=additional_extents[iview],
+                )[0]
+                if overlap_bb is None:
+                    continue
+                iviews.append(iview)
+                view_slices.append(sim.sel(
+                    {'t': t} | {
+                        dim: slice(
+                            overlap_bb['origin'][dim] - tol,
+                            overlap_bb['origin'][dim]
+                            + (overlap_bb['shape'][dim] - 1)
+                            * overlap_bb['spacing'][dim] + tol)
+                        for dim in spatial_dims},
+                    drop=True))
+
+            if not len(iviews):
+                fused_chunks[tuple(block_index)] = da.zeros(
+                    chunk_shape, dtype=sims[0].dtype)
+                continue
+
+            fused_chunks[tuple(block_index)] = da.from_delayed(
+                delayed(fuse_chunk_channels)(
+                    view_slices,
+                    [params[iview] for iview in iviews],
+                    output_chunk_bb,
+                    [views_bb[iview] for iview in iviews],
+                    blending_widths=blending_widths,
+                    interpolation_order=interpolation_order,
+                ),
+                shape=chunk_shape,
+                dtype=sims[0].dtype,
+            )
+
+        # the nested blocks are concatenated along the (last) spatial dims
+        fused_tps.append(da.block(fused_chunks.tolist()))
+
+    fused = da.stack(fused_tps)
+
+    # chunk by channel, so that channels can be read separately
+    fused = fused.rechunk({1: 1})
+
+    return spatial_image_utils.get_sim_from_array(
+        fused,
+        dims=['t', 'c'] + list(spatial_dims),
+        scale=output_stack_properties['spacing'],
+        translation=output_stack_properties['origin'],
+        transform_key=transform_key,
+        c_coords=c_coords,
+        t_coords=t_coords,
+    )
@@ -0,0 +1,343 @@
+"""
+On-demand fusion preview.
+
+The fused image is represented lazily, and the chunks napari requests
+for displaying the current viewport and timepoint are fused when
+needed. Fused chunks are kept in a least recently used cache of
+bounded size, so that browsing around a region doesn't fuse the same
+chunks repeatedly.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import dask.array as da
+from dask import compute
+
+from multiview_stitcher import fusion, msi_utils, spatial_image_utils
+
+from napari_stitcher import _utils, viewer_utils
+
+
+# default size of the cache of fused preview chunks in bytes
+DEFAULT_PREVIEW_CACHE_NBYTES = 2**29
+
+
+class ChunkCache(object):
+    """
+    Thread-safe least recently used cache of computed chunks
+    with a limit on the total number of bytes.
+    """
+    def __init__(self, max_nbytes=DEFAULT_PREVIEW_CACHE_NBYTES):
+        self.max_nbytes = max_nbytes
+        self.nbytes = 0
+        self.chunks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.chunks:
+                return None
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+
+    def put(self, key, chunk):
+        with self.lock:
+            if key in self.chunks:
+                return
+            self.chunks[key] = chunk
+            self.nbytes += chunk.nbytes
+            while self.nbytes > self.max_nbytes and len(self.chunks) > 1:
+                _, evicted_chunk = self.chunks.popitem(last=False)
+                self.nbytes -= evicted_chunk.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+            self.nbytes = 0
+
+
+class ChunkCachedArray(object):
+    """
+    Array-like wrapping a lazy (dask) array. Indexing computes only
+    the chunks overlapping with the requested region (in one batched
+    computation) and keeps them in a ChunkCache.
+
+    The dask array can also be given as a function creating it, which
+    is called on first access (shape and dtype are required then).
+    """
+    def __init__(self, array, cache, shape=None, dtype=None):
+        self.cache = cache
+        if callable(array):
+            self._get_array = array
+            self._array = None
+            self.shape = tuple(shape)
+            self.dtype = np.dtype(dtype)
+        else:
+            self._array = array
+            self.shape = array.shape
+            self.dtype = array.dtype
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+        self._lock = threading.Lock()
+
+    @property
+    def array(self):
+        with self._lock:
+            if self._array is None:
+                self._array = self._get_array()
+        return self._array
+
+    @property
+    def chunk_bounds(self):
+        return [np.cumsum((0,) + c) for c in self.array.chunks]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+    def _get_bounds(self, key):
+        """
+        Bounds of the region selected by key in each dimension. None if
+        the key is not a combination of integers and slices.
+        """
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            iel = [k is Ellipsis for k in key].index(True)
+            key = key[:iel] + (slice(None),) * (self.ndim - len(key) + 1)\
+                + key[iel + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        bounds, local_key = [], []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) + n if k < 0 else int(k)
+                bounds.append((k, k + 1))
+                local_key.append(0)
+            elif isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step < 1:
+                    return None, None
+                stop = max(start, stop)
+                bounds.append((start, stop))
+                local_key.append(slice(0, stop - start, step))
+            else:
+                return None, None
+
+        return bounds, tuple(local_key)
+
+    def __getitem__(self, key):
+
+        bounds, local_key = self._get_bounds(key)
+        if bounds is None or any(start == stop for start, stop in bounds):
+            return np.asarray(self.array[key])
+
+        chunk_bounds = self.chunk_bounds
+
+        # blocks overlapping with the requested region
+        block_ranges = [
+            range(np.searchsorted(cb, start, side='right') - 1,
+                  np.searchsorted(cb, stop, side='left'))
+            for cb, (start, stop) in zip(chunk_bounds, bounds)]
+        block_ids = list(np.ndindex(*[len(r) for r in block_ranges]))
+        block_ids = [tuple(r[i] for r, i in zip(block_ranges, block_id))
+                     for block_id in block_ids]
+
+        blocks = {block_id: self.cache.get((self.array.name, block_id))
+                  for block_id in block_ids}
+
+        missing = [block_id for block_id, block in blocks.items() if block is None]
+        if len(missing):
+            computed = compute(*[self.array.blocks[block_id] for block_id in missing])
+            for block_id, block in zip(missing, computed):
+                self.cache.put((self.array.name, block_id), block)
+                blocks[block_id] = block
+
+        # assemble the region covered by the blocks and crop it
+        region = np.empty(
+            [cb[r[-1] + 1] - cb[r[0]]
+             for cb, r in zip(chunk_bounds, block_ranges)],
+            dtype=self.dtype)
+        for block_id, block in blocks.items():
+            region[tuple(
+                slice(cb[i] - cb[r[0]], cb[i + 1] - cb[r[0]])
+                for cb, r, i in zip(chunk_bounds, block_ranges, block_id))] = block
+
+        region = region[tuple(
+            slice(start - cb[r[0]], stop - cb[r[0]])
+            for cb, r, (start, stop) in zip(chunk_bounds, block_ranges, bounds))]
+
+        return region[local_key]
+
+
+def get_preview_levels(msims, transform_key, cache):
+    """
+    Resolution levels of the lazily fused image.
+
+    The fusion graph of a level is only built when napari first
+    accesses the level, and each level is fused from the input
+    resolution levels matching its spacing.
+
+    Parameters
+    ----------
+    msims : list of MultiscaleSpatialImage
+        Single channel tiles.
+    transform_key : str
+    cache : ChunkCache
+
+    Returns
+    -------
+    list of (ChunkCachedArray, dict)
+        Data and stack properties of each level.
+    """
+
+    scale0_sims = [msi_utils.get_sim_from_msim(msim) for msim in msims]
+    t_coords = scale0_sims[0].coords['t'].values
+
+    scale0_stack_properties = fusion.process_output_stack_properties(
+        sims=scale0_sims,
+        output_spacing=None,
+        output_origin=None,
+        output_shape=None,
+        output_stack_properties=None,
+        output_stack_mode='union',
+        transform_key=transform_key,
+    )
+
+    res_shapes, _, res_abs_factors = msi_utils.calc_resolution_levels(
+        scale0_stack_properties['shape'])
+
+    levels = []
+    for shape, abs_factors in zip(res_shapes, res_abs_factors):
+
+        # pixels of lower resolution levels are centered on the
+        # pixels of the highest resolution they were binned from
+        stack_properties = {
+            'shape': {dim: int(shape[dim]) for dim in shape},
+            'spacing': {
+                dim: scale0_stack_properties['spacing'][dim] * abs_factors[dim]
+                for dim in shape},
+            'origin': {
+                dim: scale0_stack_properties['origin'][dim]
+                + (abs_factors[dim] - 1)
+                * scale0_stack_properties['spacing'][dim] / 2
+                for dim in shape},
+        }
+
+        def fuse_level(stack_properties=stack_properties):
+            level_sims = [
+                msi_utils.get_sim_from_msim(
+                    msim, scale='scale%s' % msi_utils.get_res_level_from_spacing(
+                        msim, stack_properties['spacing']))
+                for msim in msims]
+            return fusion.fuse(
+                level_sims,
+                transform_key=transform_key,
+                output_stack_properties=stack_properties,
+            ).data
+
+        levels.append((
+            ChunkCachedArray(
+                fuse_level, cache,
+                shape=(len(t_coords),) + tuple(stack_properties['shape'].values()),
+                dtype=scale0_sims[0].dtype),
+            stack_properties))
+
+    return levels
+
+
+def get_preview_level_index(levels, viewer_spacing=None):
+    """
+    Index of the coarsest level resolving the given spacing, i.e. whose
+    pixels are not larger than the size of a screen pixel in world units.
+    By default the coarsest level.
+    """
+
+    if viewer_spacing is None:
+        return len(levels) - 1
+
+    level_index = 0
+    for ilevel, (_, stack_properties) in enumerate(levels):
+        if max(stack_properties['spacing'].values()) <= viewer_spacing:
+            level_index = ilevel
+
+    return level_index
+
+
+def get_preview_layer_tuples(msims, channels, transform_key, cache,
+                             contrast_limits=None, viewer_spacing=None):
+    """
+    Layer tuples of lazily fused (multiscale) images, one per channel.
+
+    Parameters
+    ----------
+    msims : dict
+        Single or multi-channel msims of the tiles keyed by layer name.
+    channels : list of str
+    transform_key : str
+    cache : ChunkCache
+        Cache for the fused chunks, shared between channels.
+    contrast_limits : dict, optional
+        Contrast limits for each channel. By default estimated
+        from the tiles.
+    viewer_spacing : float, optional
+        Size of a screen pixel in world units. napari doesn't support
+        scaled multiscale layers in 3D, so 3D previews contain a single
+        level: the coarsest one resolving viewer_spacing (by default
+        the coarsest level).
+
+    Returns
+    -------
+    list of tuple
+        napari layer tuples.
+    """
+
+    if contrast_limits is None:
+        contrast_limits = viewer_utils.estimate_contrast_limits(
+            list(msims.values()))
+
+    layer_tuples = []
+    for ch in channels:
+
+        ch_msims = [
+            msi_utils.multiscale_sel_coords(
+                msim, _utils.get_ch_sel_dict(msi_utils.get_sim_from_msim(msim), ch))
+            for msim in msims.values()
+            if ch in _utils.get_ch_coords_from_sim_coords(
+                msi_utils.get_sim_from_msim(msim).coords)]
+
+        levels = get_preview_levels(ch_msims, transform_key, cache)
+
+        if len(levels[0][1]['shape']) == 3:
+            levels = [levels[get_preview_level_index(levels, viewer_spacing)]]
+
+        # create the layer from a placeholder with the geometry of the
+        # fused image, replacing its data by the lazily fused levels
+        placeholder_msim = msi_utils.get_msim_from_sims([
+            spatial_image_utils.get_sim_from_array(
+                da.zeros(level_data.shape, dtype=level_data.dtype),
+                dims=['t'] + list(stack_properties['shape'].keys()),
+                scale=stack_properties['spacing'],
+                translation=stack_properties['origin'],
+                transform_key=transform_key,
+                c_coords=[ch],
+                t_coords=msi_utils.get_sim_from_msim(ch_msims[0]).coords['t'].values,
+            )
+            for level_data, stack_properties in levels])
+
+        for data, kwargs, layer_type in \
+                viewer_utils.create_image_layer_tuples_from_msim(
+                    placeholder_msim,
+                    name_prefix='preview',
+                    contrast_limits=contrast_limits,
+                    data_as_array=True,
+                ):
+            level_data_by_shape = {
+                level_data.shape: level_data for level_data, _ in levels}
+            layer_tuples.append((
+                [level_data_by_shape[d.shape] for d in data],
+                kwargs | {'cache': False},
+                layer_type))
+
+    return layer_tuples
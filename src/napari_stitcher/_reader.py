@@ -6,14 +6,34 @@ implement multiple readers or even other plugin contributions. see:
 https://napari.org/stable/plugins/guides.html?#readers
 """
 
-from multiview_stitcher import msi_utils
+import glob
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import dask.array as da
+from dask import delayed
+from dask.base import tokenize
+import tifffile
+import zarr
+
+from multiview_stitcher import (
+    msi_utils, ngff_utils, param_utils, spatial_image_utils)
 from multiview_stitcher.io import (
     read_mosaic_into_sims,
-    get_number_of_scenes_in_mosaic,
     METADATA_TRANSFORM_KEY,
 )
 
-from napari_stitcher import viewer_utils
+from napari_stitcher import viewer_utils, _cache, _czi_index, _utils, _writer
+
+
+PYRAMID_CACHE_SUBDIR = 'pyramids'
+
+# default size limit of the pyramid cache in bytes
+DEFAULT_PYRAMID_CACHE_SIZE = 10 * 2**30
 
 
 def napari_get_reader(path):
@@ -30,21 +50,35 @@ def napari_get_reader(path):
         If the path is a recognized format, return a function that accepts the
         same path or list of paths, and returns a list of layer data tuples.
     """
+    # a list of tif files is read as one file per tile, while
+    # single tif files are left to other readers
+    if isinstance(path, list) and len(path) > 1 and \
+            len(get_tif_tile_paths(path, TIF_FILENAME_PATTERN)) == len(path):
+        return read_tif_tiles
+
     if isinstance(path, list):
         # reader plugins may be handed single path, or a list of paths.
         # if it is a list, it is assumed to be an image stack...
         # so we are only going to look at the first file.
         path = path[0]
 
+    path = str(path)
+
     # if we know we cannot read the file, we immediately return None.
     # otherwise we return the *function* that can read ``path``.
     if path.endswith(".czi"):
         return read_mosaic
+    elif len(get_zarr_tile_paths(path)):
+        return read_zarr_tiles
+    elif not os.path.isfile(path) and \
+            len(get_tif_tile_paths(path, TIF_FILENAME_PATTERN)):
+        return read_tif_tiles
     else:
         return None
     
 
-def read_mosaic(path, scene_index=None):
+def read_mosaic(path, scene_index=None, max_workers=None,
+                cache_pyramids=False):
     """
     Read in tiles as layers.
     
@@ -58,6 +92,18 @@ def read_mosaic(path, scene_index=None):
     ----------
     path : str or list of str
         Path to file, or list of paths.
+    scene_index : int, list of int or 'all', optional
+        Scene(s) to load. If several scenes are loaded, the layers of
+        each scene are prefixed with the scene name. By default the user
+        is asked which scene to load if the file contains more than one.
+    max_workers : int, optional
+        Number of threads used to load several scenes in parallel.
+        By default the number of CPUs.
+    cache_pyramids : bool, optional
+        Persist the resolution pyramids of the tiles into zarr stores
+        within the napari-stitcher cache directory, by default False.
+        The least recently used pyramids are removed to keep the cache
+        within get_pyramid_cache_size().
 
     Returns
     -------
@@ -72,26 +118,556 @@ def read_mosaic(path, scene_index=None):
     # handle both a string and a list of strings
     paths = [path] if isinstance(path, str) else path
 
-    N_scenes = get_number_of_scenes_in_mosaic(paths[0])
+    # scene count and tile layout are read from the on-disk index
+    # if the file has been opened before
+    index = _czi_index.get_czi_index(paths[0])
+
+    N_scenes = index['n_scenes']
+
+    if scene_index is None:
+        if N_scenes > 1:
+            from magicgui.widgets import request_values
+
+            values = request_values(
+                scene_index={
+                    "annotation": int,
+                    "label": "Which scene should be loaded?",
+                    "options": {"min": 0, "max": N_scenes - 1},
+                },
+                all_scenes={
+                    "annotation": bool,
+                    "label": "Load all scenes",
+                    "value": False,
+                },
+            )
+            if values is None:
+                return []
+            scene_index = 'all' if values["all_scenes"] \
+                else values["scene_index"]
+        else:
+            scene_index = 0
+
+    if isinstance(scene_index, str) and scene_index == 'all':
+        scene_indices = list(range(N_scenes))
+    elif np.isscalar(scene_index):
+        scene_indices = [int(scene_index)]
+    else:
+        scene_indices = list(dict.fromkeys(int(si) for si in scene_index))
+
+    for si in scene_indices:
+        if si < 0 or si >= N_scenes:
+            raise ValueError(
+                'Scene index %s out of range, file contains %s scene(s).'
+                % (si, N_scenes))
+
+    # a single scene keeps the default layer naming
+    if len(scene_indices) == 1:
+        out_layers = _read_scene_layer_tuples(
+            paths[0], index, scene_indices[0], name_prefix='tile',
+            cache_pyramids=cache_pyramids)
+
+    else:
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        with ThreadPoolExecutor(
+                max_workers=min(max_workers, len(scene_indices))) as executor:
+            scenes_layers = executor.map(
+                lambda si: _read_scene_layer_tuples(
+                    paths[0], index, si,
+                    name_prefix=index['scene_names'][si],
+                    cache_pyramids=cache_pyramids),
+                scene_indices,
+            )
+
+        out_layers = [ld for scene_layers in scenes_layers
+                      for ld in scene_layers]
+
+    if cache_pyramids:
+        _cache.evict(
+            max_nbytes=get_pyramid_cache_size(),
+            cache_dir=_utils.get_cache_dir(PYRAMID_CACHE_SUBDIR))
+
+    return out_layers
+
+
+def get_pyramid_cache_size():
+    """
+    Size limit of the pyramid cache in bytes. Can be set using the
+    NAPARI_STITCHER_PYRAMID_CACHE_SIZE environment variable (in GB).
+    """
+    cache_size = os.environ.get('NAPARI_STITCHER_PYRAMID_CACHE_SIZE')
+    if cache_size is None:
+        return DEFAULT_PYRAMID_CACHE_SIZE
+    return int(float(cache_size) * 2**30)
+
+
+def _get_pyramid_store_path(path, scene_index, tile_index):
+    """
+    Location of the cached pyramid of a tile, which changes
+    when the file is modified.
+    """
+    key = hashlib.sha1(json.dumps([
+        _utils.get_file_signature(path), scene_index, tile_index,
+    ]).encode()).hexdigest()
+    return str(_utils.get_cache_dir(PYRAMID_CACHE_SUBDIR) / ('%s.zarr' % key))
+
+
+def _get_tile_msim(sim, store_path=None):
+    """
+    Build a lazy resolution pyramid for a tile.
+    """
+
+    # in 3D, napari layers are created using a single resolution level
+    # (see viewer_utils.create_image_layer_tuples_from_msim)
+    if spatial_image_utils.get_ndim_from_sim(sim) == 3:
+        scale_factors = []
+    else:
+        scale_factors = None
+
+    return viewer_utils.get_msim_pyramid(
+        sim, scale_factors=scale_factors, store_path=store_path)
+
+
+def _read_scene_layer_tuples(path, index, scene_index, name_prefix,
+                             cache_pyramids=False):
+    """
+    Build the layer tuples of all tiles contained in a scene.
+    """
+
+    sims = _czi_index.read_mosaic_into_sims_from_czi_index(
+        path, index, scene_index=scene_index)
+
+    store_paths = [_get_pyramid_store_path(path, scene_index, isim)
+                   if cache_pyramids else None
+                   for isim in range(len(sims))]
+
+    msims = [_get_tile_msim(sim, store_path=store_path)
+             for sim, store_path in zip(sims, store_paths)]
+
+    # protect the pyramids shown by layers from eviction for the rest of
+    # the session, as layers don't notify the reader when they are removed
+    for store_path in store_paths:
+        if store_path is not None:
+            _cache.retain(store_path)
+
+    # pixel data is only read to estimate the contrast limits
+    # the first time a scene is loaded
+    contrast_limits = index.get('contrast_limits', {}).get(str(scene_index))
+    if contrast_limits is None:
+        contrast_limits = viewer_utils.estimate_contrast_limits(msims)
+        _czi_index.set_czi_index_contrast_limits(
+            path, scene_index, contrast_limits)
+
+    out_layers = viewer_utils.create_image_layer_tuples_from_msims(
+        msims,
+        name_prefix=name_prefix,
+        transform_key=METADATA_TRANSFORM_KEY,
+        contrast_limits=contrast_limits,
+        data_as_array=False)
+
+    return out_layers
+
+
+def _is_msim_zarr_store(path):
+    return os.path.isdir(os.path.join(path, 'scale0'))
+
+
+def _is_ngff_zarr_store(path):
+    """
+    Whether path is an OME-Zarr (NGFF) image, i.e. its group attributes
+    contain multiscales metadata (zarr v2 or v3).
+    """
+    for attrs_filename in ['.zattrs', 'zarr.json']:
+        try:
+            with open(os.path.join(path, attrs_filename)) as f:
+                attrs = json.load(f)
+        except (OSError, ValueError):
+            continue
+        # zarr v3 nests the attributes, NGFF 0.5 nests them under 'ome'
+        attrs = attrs.get('attributes', attrs)
+        attrs = attrs.get('ome', attrs)
+        if 'multiscales' in attrs:
+            return True
+    return False
+
+
+def _is_zarr_tile_store(path):
+    return _is_msim_zarr_store(path) or _is_ngff_zarr_store(path)
+
+
+def _read_zarr_tile_msim(path):
+    """
+    Lazily read a multiview-stitcher or OME-Zarr store into a msim
+    containing all resolution levels.
+    """
+    if _is_msim_zarr_store(path):
+        msim = msi_utils.multiscale_spatial_image_from_zarr(path)
+    else:
+        msim = ngff_utils.read_msim_from_ome_zarr(
+            path, transform_key=METADATA_TRANSFORM_KEY, array_backend='dask')
+
+        # affine of single layers written by _writer.write_single_image
+        spatial_metadata = zarr.open_group(path, mode='r').attrs.get(
+            _writer.ZARR_SPATIAL_METADATA_ATTR)
+        if spatial_metadata is not None:
+            msi_utils.set_affine_transform(
+                msim,
+                param_utils.affine_to_xaffine(
+                    np.array(spatial_metadata['affine'])),
+                transform_key=METADATA_TRANSFORM_KEY)
+
+    return msi_utils.ensure_dim(msim, 't')
+
+
+def get_zarr_tile_paths(path):
+    """
+    Get the tile stores contained in a path.
+
+    The path can either be a single multiscale zarr store, written by
+    multiview-stitcher (containing one group per resolution level) or
+    as OME-Zarr (NGFF), or a directory containing one such store per tile.
+
+    Parameters
+    ----------
+    path : str
+        Path to a zarr store or a directory of zarr stores.
+
+    Returns
+    -------
+    list of str
+        Sorted paths of the tile stores, empty if path contains none.
+    """
+
+    if not os.path.isdir(path):
+        return []
+
+    if _is_zarr_tile_store(path):
+        return [path]
+
+    return sorted([
+        os.path.join(path, p) for p in os.listdir(path)
+        if p.endswith('.zarr') and _is_zarr_tile_store(os.path.join(path, p))
+    ])
+
+
+def _get_dtype_contrast_limits(dtype):
+    """
+    Contrast limits spanning the range of a dtype,
+    for when pixel data should not be read.
+    """
+    if np.issubdtype(dtype, np.integer):
+        return [np.iinfo(dtype).min, np.iinfo(dtype).max]
+    else:
+        return [0, 1]
+
+
+def read_zarr_tiles(path):
+    """
+    Read tiles stored as multiscale zarr stores into layers.
+
+    Tiles are read lazily, i.e. no pixel data is loaded at open time,
+    and all resolution levels present in the stores are passed to napari.
+    Tile positions are taken from the transforms stored in the metadata,
+    or from the scale and translation of OME-Zarr stores.
+
+    Parameters
+    ----------
+    path : str or list of str
+        Path to a tile store or a directory containing tile stores.
+
+    Returns
+    -------
+    layer_data : list of tuples
+        A list of LayerData tuples.
+    """
+
+    paths = [path] if isinstance(path, str) else path
+
+    tile_paths = get_zarr_tile_paths(str(paths[0]))
+
+    msims = [_read_zarr_tile_msim(tile_path) for tile_path in tile_paths]
+
+    transform_keys = [
+        data_var for data_var in msims[0]['scale0'].data_vars
+        if data_var != 'image']
+
+    if METADATA_TRANSFORM_KEY in transform_keys:
+        transform_key = METADATA_TRANSFORM_KEY
+    elif len(transform_keys):
+        transform_key = transform_keys[0]
+    else:
+        transform_key = None
+
+    out_layers = viewer_utils.create_image_layer_tuples_from_msims(
+        msims,
+        transform_key=transform_key,
+        contrast_limits=_get_dtype_contrast_limits(
+            msims[0]['scale0/image'].dtype),
+        data_as_array=False)
+
+    return out_layers
+
+
+# Default pattern for deriving tile and channel from tif filenames,
+# e.g. 'tile_003.tif' or 'tile_003_chGFP.tif'. Supported named groups:
+# 'tile' (linear tile index), 'row' and 'col' (grid position) and 'channel'.
+TIF_FILENAME_PATTERN = r'.*?(?P<tile>\d+)(?:_ch(?P<channel>[^_.]+))?\.tiff?$'
+
+
+def _is_tif_path(path):
+    return str(path).lower().endswith(('.tif', '.tiff'))
+
+
+def get_tif_tile_paths(path, filename_pattern=None):
+    """
+    Get the tif files contained in a path.
+
+    Parameters
+    ----------
+    path : str or list of str
+        A directory, a glob pattern, a tif file or a list of tif files.
+    filename_pattern : str, optional
+        If given, only return files whose names match this
+        regular expression.
+
+    Returns
+    -------
+    list of str
+        Sorted tif file paths, empty if path contains none.
+    """
+
+    if isinstance(path, (list, tuple)):
+        paths = [str(p) for p in path]
+    elif os.path.isdir(path):
+        paths = [os.path.join(path, p) for p in os.listdir(path)]
+    elif glob.has_magic(str(path)):
+        paths = glob.glob(str(path))
+    else:
+        paths = [str(path)]
+
+    paths = [p for p in paths if _is_tif_path(p) and os.path.isfile(p)]
+
+    if filename_pattern is not None:
+        pattern = re.compile(filename_pattern)
+        paths = [p for p in paths
+                 if pattern.match(os.path.basename(p)) is not None]
+
+    return sorted(paths)
+
+
+def _read_tif_header(path):
+    """
+    Read shape, dtype, byte order, axes, spacing and data offset
+    of a tif file.
+    """
+
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        page = tif.pages[0]
+
+        spacing = {}
+        for dim, tag_name in zip(['y', 'x'], ['YResolution', 'XResolution']):
+            tag = page.tags.get(tag_name)
+            if tag is not None and tag.value[0] > 0:
+                spacing[dim] = tag.value[1] / tag.value[0]
+
+        if tif.imagej_metadata is not None \
+                and 'spacing' in tif.imagej_metadata:
+            spacing['z'] = float(tif.imagej_metadata['spacing'])
+
+        return {
+            'shape': tuple(series.shape),
+            'dtype': series.dtype,
+            'byteorder': tif.byteorder,
+            'axes': series.axes.lower(),
+            'spacing': spacing,
+            'dataoffset': series.dataoffset,
+        }
+
 
-    if N_scenes > 1 and scene_index is None:
-        from magicgui.widgets import request_values
+class _TifMemmap(object):
+    """
+    Array-like memory-mapping uncompressed contiguous tif data on access.
+    The file is only opened while reading, such that large numbers of
+    tiles don't hold open file descriptors.
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.offset = header['dataoffset']
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.file_dtype = self.dtype.newbyteorder(header['byteorder'])
+        self.ndim = len(self.shape)
 
-        scene_index = request_values(
-            scene_index={
-                "annotation": int,
-                "label": "Which scene should be loaded?",
-                "options": {"min": 0, "max": N_scenes - 1},
-            },
-        )["scene_index"]
+    def __getitem__(self, key):
+        data = np.memmap(
+            self.path, dtype=self.file_dtype, mode='r',
+            offset=self.offset, shape=self.shape)
+        # copy into memory in native byte order, closing the memmap
+        block = np.array(data[key], dtype=self.dtype)
+        del data
+        return block
+
+
+def _get_lazy_tif_data(path, header):
+    """
+    Memory-map uncompressed contiguous tif data, otherwise read it lazily.
+    """
+
+    if header['dataoffset'] is not None:
+        data = _TifMemmap(path, header)
+        # one chunk per plane
+        return da.from_array(
+            data,
+            chunks=(1,) * (data.ndim - 2) + data.shape[-2:],
+            name='tif-memmap-%s' % tokenize(
+                _utils.get_file_signature(path), header['dataoffset']),
+            meta=np.empty((0,) * data.ndim, dtype=data.dtype),
+        )
     else:
-        scene_index = 0
+        return da.from_delayed(
+            delayed(tifffile.imread)(path),
+            shape=header['shape'], dtype=header['dtype'])
+
 
-    sims = read_mosaic_into_sims(paths[0], scene_index=scene_index)
+def read_tif_tiles(
+        path,
+        filename_pattern=TIF_FILENAME_PATTERN,
+        spacing=None,
+        overlap=0.,
+        max_workers=None,
+        ):
+    """
+    Read a set of tif files, each containing one tile (and channel).
+
+    Tile indices and channels are derived from the filenames using
+    filename_pattern. Files are read lazily using memory mapping
+    where possible and the tif headers are parsed in parallel.
 
-    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[])
-             for sim in sims]
+    If the pattern contains the named groups 'row' and 'col', tiles are
+    positioned on a grid using the given overlap. Otherwise all tiles are
+    placed at the origin and can be arranged using the mosaic widget.
 
+    Parameters
+    ----------
+    path : str or list of str
+        Directory, glob pattern or list of tif files.
+    filename_pattern : str, optional
+        Regular expression matched against the filenames, containing
+        the named groups 'tile' or 'row' and 'col', and optionally
+        'channel'. By default TIF_FILENAME_PATTERN.
+    spacing : dict, optional
+        Pixel spacing for each spatial dimension. By default
+        read from the tif metadata.
+    overlap : float, optional
+        Relative overlap between neighboring tiles when positioning
+        them on a grid, by default 0.
+    max_workers : int, optional
+        Number of threads parsing the tif headers. By default the
+        number of CPUs times 4, as reading headers is I/O bound.
+
+    Returns
+    -------
+    layer_data : list of tuples
+        A list of LayerData tuples.
+    """
+
+    file_paths = get_tif_tile_paths(path)
+
+    pattern = re.compile(filename_pattern)
+
+    # group files by tile
+    tiles = {}
+    for file_path in file_paths:
+        match = pattern.match(os.path.basename(file_path))
+        if match is None:
+            continue
+        groups = match.groupdict()
+        if groups.get('row') is not None and groups.get('col') is not None:
+            tile_key = (int(groups['row']), int(groups['col']))
+        elif groups.get('tile') is not None:
+            tile_key = (int(groups['tile']),)
+        else:
+            raise ValueError(
+                "filename_pattern needs to contain the named group 'tile' "
+                "or the named groups 'row' and 'col'.")
+        channel = groups.get('channel')
+        tiles.setdefault(tile_key, {})[
+            channel if channel is not None else 'default_channel'] = file_path
+
+    if not len(tiles):
+        raise ValueError(
+            'No tif files matching the filename pattern found in %s' % path)
+
+    tile_keys = sorted(tiles.keys())
+    channels = sorted({ch for tile_key in tile_keys for ch in tiles[tile_key]})
+
+    if max_workers is None:
+        max_workers = 4 * (os.cpu_count() or 1)
+
+    paths_to_read = [tiles[tile_key][ch]
+                     for tile_key in tile_keys for ch in tiles[tile_key]]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        headers = dict(zip(paths_to_read,
+                           executor.map(_read_tif_header, paths_to_read)))
+
+    msims = []
+    for tile_key in tile_keys:
+
+        tile_channels = [ch for ch in channels if ch in tiles[tile_key]]
+        tile_headers = [headers[tiles[tile_key][ch]] for ch in tile_channels]
+
+        axes = tile_headers[0]['axes']
+        for header in tile_headers:
+            if header['axes'] != axes or \
+                    header['shape'] != tile_headers[0]['shape']:
+                raise ValueError(
+                    'All channels of a tile need to have the same shape.')
+
+        data = da.stack([
+            _get_lazy_tif_data(tiles[tile_key][ch], header)
+            for ch, header in zip(tile_channels, tile_headers)])
+
+        # drop singleton axes that are not supported
+        dims = ['c'] + list(axes)
+        for idim, dim in reversed(list(enumerate(dims))):
+            if dim not in ['t', 'z', 'y', 'x'] and idim > 0:
+                if data.shape[idim] != 1:
+                    raise ValueError(
+                        'Unsupported axis %s in %s.' % (
+                            dim, tiles[tile_key][tile_channels[0]]))
+                data = data[(slice(None),) * idim + (0,)]
+                dims.pop(idim)
+
+        sdims = [dim for dim in dims if dim in ['z', 'y', 'x']]
+
+        if spacing is None:
+            tile_spacing = {dim: tile_headers[0]['spacing'].get(dim, 1.)
+                            for dim in sdims}
+        else:
+            tile_spacing = {dim: spacing[dim] for dim in sdims}
+
+        origin = {dim: 0. for dim in sdims}
+        if len(tile_key) == 2:
+            for dim, grid_index in zip(['y', 'x'], tile_key):
+                origin[dim] = grid_index * (1 - overlap) \
+                    * data.shape[dims.index(dim)] * tile_spacing[dim]
+
+        sim = spatial_image_utils.get_sim_from_array(
+            data,
+            dims=dims,
+            scale=tile_spacing,
+            translation=origin,
+            transform_key=METADATA_TRANSFORM_KEY,
+            c_coords=tile_channels,
+        )
+
+        msims.append(_get_tile_msim(sim))
+
+    # contrast limits are estimated from a subset of tiles
     out_layers = viewer_utils.create_image_layer_tuples_from_msims(
         msims,
         transform_key=METADATA_TRANSFORM_KEY,
@@ -108,8 +684,6 @@ if __name__ == "__main__":
 
     sims = read_mosaic_into_sims(filename)
 
-    from multiview_stitcher import msi_utils
-
     msim = msi_utils.get_msim_from_sim(sims[0], scale_factors=[])
 
     msim_sel = msi_utils.multiscale_sel_coords(msim, {'c':'EGFP'})
\ No newline at end of file
@@ -18,7 +18,6 @@ from napari_stitcher._reader import read_mosaic
 from multiview_stitcher.sample_data import get_mosaic_sample_data_path
 from multiview_stitcher.io import METADATA_TRANSFORM_KEY
 from multiview_stitcher.sample_data import generate_tiled_dataset
-from multiview_stitcher.msi_utils import get_msim_from_sim
 
 
 def make_sample_data():
@@ -42,7 +41,7 @@ def drifting_timelapse_with_stage_shifts_no_overlap_2d():
         drift_scale=2., shift_scale=2.,
         overlap=0, zoom=8, dtype=np.uint8)
     
-    msims = [get_msim_from_sim(sim) for sim in sims]
+    msims = [viewer_utils.get_msim_pyramid(sim) for sim in sims]
 
     layer_tuples = viewer_utils.create_image_layer_tuples_from_msims(
         msims, transform_key=METADATA_TRANSFORM_KEY)
@@ -58,7 +57,7 @@ def timelapse_with_stage_shifts_with_overlap_3d():
         drift_scale=0., shift_scale=2.,
         overlap=3, zoom=8, dtype=np.uint8)
     
-    msims = [get_msim_from_sim(sim) for sim in sims]
+    msims = [viewer_utils.get_msim_pyramid(sim) for sim in sims]
 
     layer_tuples = viewer_utils.create_image_layer_tuples_from_msims(
         msims, transform_key=METADATA_TRANSFORM_KEY)
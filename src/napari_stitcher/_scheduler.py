@@ -0,0 +1,160 @@
+"""
+Dask schedulers used for registration and fusion.
+
+By default, dask's threaded scheduler is used. Parts of the pipeline
+holding the GIL then only use a single core. These can run in parallel
+using processes instead, either with dask's multiprocessing scheduler
+or with a local distributed cluster (requires the distributed package),
+which additionally allows limiting the memory of each worker.
+
+The settings default to the NAPARI_STITCHER_SCHEDULER,
+NAPARI_STITCHER_N_WORKERS and NAPARI_STITCHER_MEMORY_LIMIT environment
+variables, such that they also apply when running headless.
+"""
+import os
+import warnings
+from contextlib import contextmanager
+
+import dask
+
+
+SCHEDULER_THREADS = 'threads'
+SCHEDULER_PROCESSES = 'processes'
+SCHEDULER_DISTRIBUTED = 'distributed'
+
+SCHEDULERS = [SCHEDULER_THREADS, SCHEDULER_PROCESSES, SCHEDULER_DISTRIBUTED]
+
+# local clusters are expensive to start and are reused
+# between computations, keyed by their settings
+_local_clusters = {}
+
+
+def get_default_scheduler_settings():
+    """
+    Scheduler settings from the environment.
+
+    Returns
+    -------
+    dict
+        scheduler, n_workers (None for the number of cores) and
+        memory_limit per worker (None for no limit, e.g. '4GB').
+    """
+
+    n_workers = os.environ.get('NAPARI_STITCHER_N_WORKERS')
+
+    return {
+        'scheduler': os.environ.get(
+            'NAPARI_STITCHER_SCHEDULER', SCHEDULER_THREADS),
+        'n_workers': int(n_workers) if n_workers else None,
+        'memory_limit': os.environ.get('NAPARI_STITCHER_MEMORY_LIMIT') or None,
+    }
+
+
+def get_local_cluster(n_workers=None, memory_limit=None):
+    """
+    Local distributed cluster with single-threaded worker processes.
+
+    Parameters
+    ----------
+    n_workers : int, optional
+        Number of workers, by default the number of cores.
+    memory_limit : str or int, optional
+        Memory limit per worker, e.g. '4GB'. By default the
+        available memory is split between the workers.
+
+    Returns
+    -------
+    distributed.LocalCluster
+    """
+
+    try:
+        from distributed import LocalCluster
+    except ImportError:
+        raise ImportError(
+            "The distributed scheduler requires the 'distributed' package. "
+            "Install it using 'pip install distributed'.")
+
+    key = (n_workers, memory_limit)
+    if key not in _local_clusters:
+        _local_clusters[key] = LocalCluster(
+            n_workers=n_workers or os.cpu_count() or 1,
+            threads_per_worker=1,
+            processes=True,
+            memory_limit=memory_limit or 'auto',
+        )
+
+    return _local_clusters[key]
+
+
+def close_local_clusters():
+    """
+    Shut down the local clusters started by get_local_cluster.
+    """
+    for cluster in _local_clusters.values():
+        cluster.close()
+    _local_clusters.clear()
+
+
+def cancel_distributed_computations():
+    """
+    Cancel the computations of the default distributed client, if any.
+    Computations waiting for their results raise a CancelledError.
+    """
+
+    try:
+        from distributed import Future, default_client
+    except ImportError:
+        return
+
+    try:
+        client = default_client()
+    except ValueError:
+        return
+
+    client.cancel([Future(key, client) for key in list(client.futures)])
+
+
+@contextmanager
+def scheduler_context(scheduler=None, n_workers=None, memory_limit=None):
+    """
+    Context within which dask computations use the given scheduler.
+
+    Parameters
+    ----------
+    scheduler : str, optional
+        One of SCHEDULERS, by default from get_default_scheduler_settings.
+    n_workers : int, optional
+        Number of threads, processes or distributed workers.
+        By default from get_default_scheduler_settings, falling back
+        to the number of cores.
+    memory_limit : str or int, optional
+        Memory limit per worker (distributed scheduler only).
+        By default from get_default_scheduler_settings.
+    """
+
+    defaults = get_default_scheduler_settings()
+    if scheduler is None:
+        scheduler = defaults['scheduler']
+    if n_workers is None:
+        n_workers = defaults['n_workers']
+
+    if scheduler not in SCHEDULERS:
+        raise ValueError('Unknown scheduler %s, choose one of %s.'
+                         % (scheduler, SCHEDULERS))
+
+    if memory_limit is None and scheduler == SCHEDULER_DISTRIBUTED:
+        memory_limit = defaults['memory_limit']
+
+    if scheduler == SCHEDULER_DISTRIBUTED:
+        cluster = get_local_cluster(n_workers, memory_limit)
+        from distributed import Client
+        with Client(cluster, set_as_default=True):
+            yield
+        return
+
+    if memory_limit is not None:
+        warnings.warn('Memory limits are only supported by the %s scheduler.'
+                      % SCHEDULER_DISTRIBUTED)
+
+    with dask.config.set(scheduler=scheduler, num_workers=n_workers):
+        yield
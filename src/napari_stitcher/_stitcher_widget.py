@@ -7,12 +7,15 @@ see: https://napari.org/stable/plugins/guides.html?#widgets
 Replace code below according to your needs.
 """
 from typing import TYPE_CHECKING
-import os, tempfile, sys, shutil
+import sys
+import inspect, threading, warnings
 from collections.abc import Iterable
+from functools import partial
 
 import numpy as np
 
 from napari.utils import notifications
+from napari.qt.threading import create_worker
 
 from magicgui import widgets
 from qtpy.QtWidgets import QVBoxLayout, QHBoxLayout, QWidget, QTabWidget, QLabel
@@ -27,7 +30,9 @@ from multiview_stitcher import (
     )
 from napari.layers import Image, Labels
 
-from napari_stitcher import _reader, viewer_utils, _utils
+from napari_stitcher import (
+    _reader, viewer_utils, _utils, _checkpoint, _fusion, _cache, _preview,
+    _scheduler, _budget)
 
 if TYPE_CHECKING:
     import napari
@@ -37,6 +42,10 @@ if TYPE_CHECKING:
 CHOICE_METADATA = 'Original'
 CHOICE_REGISTERED = 'Registered'
 
+# number of timepoints fused together. Fusing few timepoints at once
+# shows results early and keeps the size of the dask graphs bounded
+FUSION_TIMEPOINT_WINDOW = 1
+
 
 class StitcherQWidget(QWidget):
     # your QWidget.__init__ can optionally request the napari viewer instance
@@ -121,6 +130,41 @@ class StitcherQWidget(QWidget):
         self.reg_method.changed.connect(self._on_reg_method_changed)
         self._on_reg_method_changed()
 
+        scheduler_settings = _scheduler.get_default_scheduler_settings()
+
+        self.scheduler = widgets.ComboBox(
+            choices=_scheduler.SCHEDULERS,
+            value=scheduler_settings['scheduler'],
+            label='Scheduler:',
+            tooltip='Dask scheduler used for registration and fusion.\n'
+                    '"threads" (default) shares memory between workers, but steps '
+                    'holding the GIL use a single core.\n'
+                    '"processes" and "distributed" (local cluster, requires the '
+                    'distributed package) run such steps in parallel.')
+
+        self.n_workers = widgets.SpinBox(
+            value=scheduler_settings['n_workers'] or 0,
+            min=0, max=1024,
+            label='Workers:',
+            tooltip='Number of workers (0: default, i.e. the number of cores).')
+
+        self.memory_limit = widgets.LineEdit(
+            value=scheduler_settings['memory_limit'] or '',
+            label='Memory per worker:',
+            tooltip='Memory limit of each distributed worker, e.g. "4GB".\n'
+                    'By default the available memory is split between the workers.')
+
+        self.scheduler.changed.connect(self._on_scheduler_changed)
+        self._on_scheduler_changed()
+
+        self.output_chunksize = widgets.SpinBox(
+            value=_budget.get_default_output_chunksize() or 0,
+            min=0, max=8192, step=64,
+            label='Output chunk size:',
+            tooltip='Size of the chunks fused in parallel in pixels along each '
+                    'dimension.\n0: planned from the tile size, data type, number '
+                    'of workers and available memory.')
+
         self.button_stitch = widgets.Button(text='Register',
             tooltip='Use the overlaps between tiles to determine their relative positions.')
         
@@ -140,6 +184,20 @@ class StitcherQWidget(QWidget):
                     'tiles and timepoints into a single image, smoothly'+\
                     'blending the overlaps and filling in gaps.')
 
+        self.button_preview = widgets.Button(text='Preview fusion',
+            tooltip='Add lazily fused layers for inspecting the result.\n'+\
+                    'Only the chunks shown in the viewer (current region, '+\
+                    'resolution and timepoint) are fused.')
+
+        self.resumable_fusion = widgets.CheckBox(
+            value=False, text='Resumable fusion',
+            tooltip='Write fused images chunk by chunk into the napari-stitcher '+\
+                    'cache, recording completed chunks.\nFusing the same tiles '+\
+                    'again continues an interrupted fusion where it stopped.')
+
+        self.button_cancel = widgets.Button(text='Cancel',
+            tooltip='Cancel the running registration or fusion.')
+
         self.loading_widgets = [
                             self.load_layers_box,
                             ]
@@ -163,7 +221,14 @@ class StitcherQWidget(QWidget):
                             self.antspy_transform_types,
         ]
 
-        self.reg_config_widgets = self.reg_config_widgets_basic + self.reg_config_widgets_advanced + self.reg_config_widgets_method
+        self.reg_config_widgets_compute = [
+                            self.scheduler,
+                            self.n_workers,
+                            self.memory_limit,
+                            self.output_chunksize,
+        ]
+
+        self.reg_config_widgets = self.reg_config_widgets_basic + self.reg_config_widgets_advanced + self.reg_config_widgets_method + self.reg_config_widgets_compute
 
         # Initialize tab screen 
         self.reg_config_widgets_tabs = QTabWidget() 
@@ -176,6 +241,8 @@ class StitcherQWidget(QWidget):
             widgets.VBox(widgets=self.reg_config_widgets_advanced).native, "More")
         self.reg_config_widgets_tabs.addTab(
             widgets.VBox(widgets=self.reg_config_widgets_method).native, "Method")
+        self.reg_config_widgets_tabs.addTab(
+            widgets.VBox(widgets=self.reg_config_widgets_compute).native, "Compute")
 
         self.visualization_widgets = [
                             self.visualization_type_rbuttons,
@@ -185,7 +252,7 @@ class StitcherQWidget(QWidget):
             self.loading_widgets +\
             self.reg_config_widgets +\
             [self.button_stitch] +\
-            [self.button_fuse] +\
+            [self.button_preview, self.resumable_fusion, self.button_fuse] +\
             self.visualization_widgets
 
         self.container = QWidget()
@@ -199,7 +266,10 @@ class StitcherQWidget(QWidget):
 
         self.container.layout().addWidget(self.reg_config_widgets_tabs)
         self.container.layout().addWidget(self.button_stitch.native)
+        self.container.layout().addWidget(self.button_preview.native)
+        self.container.layout().addWidget(self.resumable_fusion.native)
         self.container.layout().addWidget(self.button_fuse.native)
+        self.container.layout().addWidget(self.button_cancel.native)
 
         # add horizontal widget with visualization options
         self.visualization_widgets_qt = QWidget()
@@ -214,7 +284,8 @@ class StitcherQWidget(QWidget):
 
         # disable all widgets (apart from loading) until layers are loaded
         for w in self.reg_config_widgets + self.visualization_widgets +\
-            [self.button_stitch, self.button_fuse]:
+            [self.button_stitch, self.button_preview, self.resumable_fusion, self.button_fuse,
+             self.button_cancel]:
             w.enabled = False
             if isinstance(w, Iterable):
                 for sw in w:
@@ -225,22 +296,36 @@ class StitcherQWidget(QWidget):
         self.input_layers= []
         self.msims = {}
         self.fused_layers = []
+        # cache entries of the fused layers
+        self.fused_paths = []
+        # fused layers by cache entry, while timepoints are being fused
+        self.streamed_fused_layers = {}
+        self.preview_layers = []
+        # fused chunks of the preview layers
+        self.preview_cache = _preview.ChunkCache()
         self.params = dict()
+        # running background computation and its cancellation flag
+        self.worker = None
+        self.cancel_event = threading.Event()
+        # bytes of in-memory layer data copied when loading layers
+        self.duplicated_nbytes = 0
 
         # flag to suppress watch_layer_changes during programmatic affine updates
         self._updating_viewer = False
         # last timepoint that was applied to the viewer; used to skip no-op current_step events
         self._last_applied_tp = None
 
-        # create temporary directory for storing dask arrays
-        self.tmpdir = tempfile.TemporaryDirectory()
-        
         self.visualization_type_rbuttons.changed.connect(self.update_viewer_transformations)
         self.viewer.dims.events.current_step.connect(self.update_viewer_transformations)
 
-        self.button_stitch.clicked.connect(self.run_registration)
+        # buttons run computations in the background
+        self.button_stitch.clicked.connect(
+            partial(self.run_registration, background=True))
         # self.button_stabilize.clicked.connect(self.run_stabilization)
-        self.button_fuse.clicked.connect(self.run_fusion)
+        self.button_fuse.clicked.connect(
+            partial(self.run_fusion, background=True))
+        self.button_cancel.clicked.connect(self.cancel_task)
+        self.button_preview.clicked.connect(self.run_preview)
 
         self.button_load_layers_all.clicked.connect(self.load_layers_all)
         self.button_load_layers_sel.clicked.connect(self.load_layers_sel)
@@ -250,6 +335,21 @@ class StitcherQWidget(QWidget):
         """Show/hide transform type widget based on the selected method."""
         self.antspy_transform_types.visible = self.reg_method.value == 'ITKElastix'
 
+    def _on_scheduler_changed(self, event=None):
+        """Show the memory limit only for the distributed scheduler."""
+        self.memory_limit.visible = \
+            self.scheduler.value == _scheduler.SCHEDULER_DISTRIBUTED
+
+    def _get_scheduler_settings(self):
+        """Arguments of _scheduler.scheduler_context chosen in the widget."""
+        return dict(
+            scheduler=self.scheduler.value,
+            n_workers=self.n_workers.value or None,
+            memory_limit=self.memory_limit.value or None
+                if self.scheduler.value == _scheduler.SCHEDULER_DISTRIBUTED
+                else None,
+        )
+
     def update_viewer_transformations(self, event=None):
         """
         set transformations
@@ -276,9 +376,8 @@ class StitcherQWidget(QWidget):
                            for l in self.viewer.layers if l.name in self.msims]
             if not _sims_check:
                 return
-            _highest_sdim = max(
-                len(spatial_image_utils.get_spatial_dims_from_sim(s))
-                for s in _sims_check)
+            # dimensions following time, i.e. spatial and channel dims
+            _highest_sdim = max(len(s.dims) - 1 for s in _sims_check)
             _candidate_tp = (
                 self.viewer.dims.current_step[-_highest_sdim - 1]
                 if len(self.viewer.dims.current_step) > _highest_sdim
@@ -296,12 +395,9 @@ class StitcherQWidget(QWidget):
         sims = [msi_utils.get_sim_from_msim(self.msims[l.name])
                 for l in compatible_layers]
 
-        # determine spatial dimensions from layers
-        all_spatial_dims = [spatial_image_utils.get_spatial_dims_from_sim(
-            sims[il])
-            for il, l in enumerate(compatible_layers)]
-        
-        highest_sdim = max([len(sdim) for sdim in all_spatial_dims])
+        # determine dimensions following time from layers,
+        # i.e. spatial dims and the channel dim of multi-channel layers
+        highest_sdim = max([len(sim.dims) - 1 for sim in sims])
 
         # get curr tp
         # handle possibility that there had been no T dimension
@@ -382,9 +478,9 @@ class StitcherQWidget(QWidget):
         ndim = spatial_image_utils.get_ndim_from_sim(sim)
 
         # Determine current timepoint (mirrors the logic in update_viewer_transformations)
-        sdims = spatial_image_utils.get_spatial_dims_from_sim(sim)
-        if len(self.viewer.dims.current_step) > len(sdims):
-            curr_tp = self.viewer.dims.current_step[-len(sdims) - 1]
+        n_non_t_dims = len(sim.dims) - 1
+        if len(self.viewer.dims.current_step) > n_non_t_dims:
+            curr_tp = self.viewer.dims.current_step[-n_non_t_dims - 1]
         else:
             curr_tp = 0
 
@@ -420,7 +516,16 @@ class StitcherQWidget(QWidget):
             msi_utils.set_affine_transform(
                 msim, registered_params.copy(), transform_key='affine_metadata')
 
-    def run_registration(self):            
+    def run_registration(self, background=False):
+
+        """
+        Register the tiles of the registration channel.
+
+        Parameters
+        ----------
+        background : bool, optional
+            If True, register in a background thread (see _run_task).
+        """
 
         # Promote the current starting-point transforms into affine_metadata so
         # that registration always uses the most up-to-date positions:
@@ -435,51 +540,75 @@ class StitcherQWidget(QWidget):
         # select layers corresponding to the chosen registration channel
         msims_dict = {_utils.get_str_unique_to_view_from_layer_name(lname): msim
                       for lname, msim in self.msims.items()
-                      if self.reg_ch_picker.value in msi_utils.get_sim_from_msim(msim).coords['c']}
+                      if self.reg_ch_picker.value in _utils.get_ch_coords_from_sim_coords(
+                          msi_utils.get_sim_from_msim(msim).coords)}
         
         # sort layers by name
         sorted_lnames = sorted(list(msims_dict.keys()))
 
         msims = [msims_dict[lname] for lname in sorted_lnames]
 
+        # select the registration channel of multi-channel layers
         msims = [msi_utils.multiscale_sel_coords(msim,
                 {'t': [msi_utils.get_sim_from_msim(msim).coords['t'][it]
                          for it in range(self.times_slider.value[0] + 1,
-                                         self.times_slider.value[1] + 1)]})
+                                         self.times_slider.value[1] + 1)],
+                 **_utils.get_ch_sel_dict(
+                     msi_utils.get_sim_from_msim(msim),
+                     self.reg_ch_picker.value)})
                   for msim in msims]
 
-        # with _utils.TemporarilyDisabledWidgets([self.container]),\
-        with _utils.TemporarilyDisabledWidgets(self.all_widgets),\
-            _utils.VisibleActivityDock(self.viewer),\
+        if self.custom_reg_binning.value:
+            registration_binning = {'y': self.x_reg_binning.value, 'x': self.y_reg_binning.value}
+        else:
+            registration_binning = None
+
+        if self.reg_method.value == 'ITKElastix':
+            pairwise_reg_func = registration.registration_ITKElastix
+            transform_types = list(self.antspy_transform_types.value)
+            pairwise_reg_func_kwargs = {'transform_types': transform_types}
+            groupwise_resolution_kwargs = {'transform': transform_types[-1].lower()}
+        else:
+            pairwise_reg_func = registration.phase_correlation_registration
+            pairwise_reg_func_kwargs = None
+            groupwise_resolution_kwargs = None
+
+        registration_kwargs = dict(
+            registration_binning=registration_binning,
+            pairwise_reg_func=pairwise_reg_func,
+            pairwise_reg_func_kwargs=pairwise_reg_func_kwargs,
+            groupwise_resolution_kwargs=groupwise_resolution_kwargs,
+            pre_registration_pruning_method=self.pair_pruning_method_mapping[self.pair_pruning_method.value],
+            post_registration_do_quality_filter=self.do_quality_filter.value,
+            post_registration_quality_threshold=self.quality_threshold.value,
+            transform_key='affine_metadata',
+        )
+
+        return self._run_task(
+            self._compute_registration, msims, registration_kwargs, self._get_scheduler_settings(),
+            on_returned=partial(self._apply_registration_params, sorted_lnames),
+            background=background,
+        )
+
+    def _compute_registration(self, msims, registration_kwargs,
+                              scheduler_settings):
+
+        """
+        Register msims. Can run in a worker thread (see _run_task).
+        """
+
+        with _scheduler.scheduler_context(**scheduler_settings),\
             _utils.TqdmCallback(tqdm_class=_utils.progress,
                                 desc='Registering tiles', bar_format=" "):
-            
-            if self.custom_reg_binning.value:
-                registration_binning = {'y': self.x_reg_binning.value, 'x': self.y_reg_binning.value}
-            else:
-                registration_binning = None
+            params = registration.register(msims, **registration_kwargs)
 
-            if self.reg_method.value == 'ITKElastix':
-                pairwise_reg_func = registration.registration_ITKElastix
-                transform_types = list(self.antspy_transform_types.value)
-                pairwise_reg_func_kwargs = {'transform_types': transform_types}
-                groupwise_resolution_kwargs = {'transform': transform_types[-1].lower()}
-            else:
-                pairwise_reg_func = registration.phase_correlation_registration
-                pairwise_reg_func_kwargs = None
-                groupwise_resolution_kwargs = None
-
-            params = registration.register(
-                msims,
-                registration_binning=registration_binning,
-                pairwise_reg_func=pairwise_reg_func,
-                pairwise_reg_func_kwargs=pairwise_reg_func_kwargs,
-                groupwise_resolution_kwargs=groupwise_resolution_kwargs,
-                pre_registration_pruning_method=self.pair_pruning_method_mapping[self.pair_pruning_method.value],
-                post_registration_do_quality_filter=self.do_quality_filter.value,
-                post_registration_quality_threshold=self.quality_threshold.value,
-                transform_key='affine_metadata',
-            )
+        return params
+
+    def _apply_registration_params(self, sorted_lnames, params):
+
+        """
+        Set the obtained parameters to the msims and layers and show them.
+        """
 
         for lname, msim in self.msims.items():
             params_index = sorted_lnames.index(_utils.get_str_unique_to_view_from_layer_name(lname))
@@ -503,11 +632,146 @@ class StitcherQWidget(QWidget):
         self._last_applied_tp = None
         self.update_viewer_transformations()
 
+    def _run_task(self, func, *args, on_yielded=None, on_returned=None,
+                  background=False):
 
-    def run_fusion(self):
+        """
+        Run a long computation, disabling the widgets meanwhile.
+
+        Blocking, values yielded (if func is a generator function) and
+        returned by func are passed to on_yielded and on_returned directly
+        and errors are raised. In the background, func runs in a worker
+        thread such that the viewer stays responsive. The callbacks are then
+        called on the main thread, errors are shown as notifications and
+        the computation can be cancelled using the cancel button.
+
+        Returns
+        -------
+        napari worker or None
+            The started worker if background is True.
+        """
+
+        disabled_widgets = _utils.TemporarilyDisabledWidgets(self.all_widgets)
+        activity_dock = _utils.VisibleActivityDock(self.viewer)
+
+        if not background:
+            with disabled_widgets, activity_dock:
+                result = func(*args)
+                if inspect.isgenerator(result):
+                    try:
+                        while True:
+                            value = next(result)
+                            if on_yielded is not None:
+                                on_yielded(value)
+                    except StopIteration as stop:
+                        result = stop.value
+            if on_returned is not None:
+                on_returned(result)
+            return None
+
+        self.cancel_event.clear()
+        cancel_event = self.cancel_event
+
+        # abort the dask computations of the worker thread when cancelling
+        if inspect.isgeneratorfunction(func):
+            def work():
+                with _utils.CancellationCallback(cancel_event):
+                    return (yield from func(*args))
+        else:
+            def work():
+                with _utils.CancellationCallback(cancel_event):
+                    return func(*args)
+
+        worker = create_worker(work, _start_thread=False, _ignore_errors=True)
+        if on_yielded is not None:
+            worker.yielded.connect(on_yielded)
+        if on_returned is not None:
+            worker.returned.connect(on_returned)
+        worker.errored.connect(self._on_task_errored)
+
+        def on_finished():
+            self.worker = None
+            self.button_cancel.enabled = False
+            activity_dock.__exit__(None, None, None)
+            disabled_widgets.__exit__(None, None, None)
+
+        worker.finished.connect(on_finished)
+
+        disabled_widgets.__enter__()
+        activity_dock.__enter__()
+        self.button_cancel.enabled = True
+        self.worker = worker
+        worker.start()
+
+        return worker
+
+    def _on_task_errored(self, exc):
+        if self.cancel_event.is_set():
+            notifications.notification_manager.receive_info(
+                'Computation cancelled.')
+        elif isinstance(exc, _budget.BudgetExceededError):
+            notifications.show_warning(str(exc))
+        else:
+            notifications.notification_manager.receive_error(
+                type(exc), exc, exc.__traceback__)
+
+    def cancel_task(self):
 
         """
-        Split layers into channel groups and fuse each group separately.
+        Cancel the running background computation. Its results are
+        discarded and no further chunks are computed.
+        """
+
+        if self.worker is None:
+            return
+
+        self.cancel_event.set()
+        _scheduler.cancel_distributed_computations()
+        self.worker.quit()
+
+    def _get_fusion_transform_key(self):
+        return 'affine_registered'\
+            if self.visualization_type_rbuttons.value == CHOICE_REGISTERED\
+            else 'affine_metadata'
+
+    def run_preview(self):
+
+        """
+        Add lazily fused layers (replacing previous previews), of which
+        only the chunks requested by napari for display are fused.
+        """
+
+        if not (self.visualization_type_rbuttons.enabled and
+                self.visualization_type_rbuttons.value == CHOICE_REGISTERED):
+            self._capture_layer_transforms_to_msims()
+
+        for l in self.preview_layers:
+            if l in self.viewer.layers:
+                self.viewer.layers.remove(l)
+        self.preview_layers = []
+        self.preview_cache.clear()
+
+        for ltuple in _preview.get_preview_layer_tuples(
+                self.msims,
+                self.reg_ch_picker.choices,
+                transform_key=self._get_fusion_transform_key(),
+                cache=self.preview_cache,
+                viewer_spacing=1 / self.viewer.camera.zoom,
+                ):
+            self.preview_layers.append(self.viewer.add_image(ltuple[0], **ltuple[1]))
+
+    def run_fusion(self, background=False):
+
+        """
+        Fuse all channels at once, sharing the transformed coordinates
+        and blending weights between them. If the channels of the views
+        don't match, split layers into channel groups and fuse each
+        group separately.
+
+        Parameters
+        ----------
+        background : bool, optional
+            If True, fuse in a background thread (see _run_task).
         """
 
         # Capture manual layer adjustments if fusing with original transforms
@@ -517,53 +781,253 @@ class StitcherQWidget(QWidget):
 
         channels = self.reg_ch_picker.choices
 
-        for _, ch in enumerate(channels):
+        transform_key = self._get_fusion_transform_key()
+
+        sims = {lname: msi_utils.get_sim_from_msim(msim)
+                for lname, msim in self.msims.items()}
+
+        sims = {lname: spatial_image_utils.sim_sel_coords(sim,
+                {'t': [sim.coords['t'][it]
+                       for it in range(self.times_slider.value[0] + 1,
+                                       self.times_slider.value[1] + 1)]})
+                for lname, sim in sims.items()}
+
+        # identify the input data for caching the fused images
+        layer_ids = {l.name: viewer_utils.get_layer_identity(l)
+                     for l in self.input_layers}
+
+        # fuse all channels together if possible
+        combined_sims = _utils.combine_channels_per_view(sims, channels)
+        if combined_sims is not None:
+            fusion_groups = [(list(channels), sorted(sims), combined_sims)]
+        else:
+            # fall back to fusing each channel separately
+            fusion_groups = []
+            for ch in channels:
+                lnames = [lname for lname, sim in sims.items()
+                          if ch in _utils.get_ch_coords_from_sim_coords(sim.coords)]
+                # select the channel from multi-channel layers
+                fusion_groups.append(([ch], lnames,
+                    [spatial_image_utils.sim_sel_coords(
+                        sims[lname], _utils.get_ch_sel_dict(sims[lname], ch))
+                     for lname in lnames]))
+
+        return self._run_task(
+            self._compute_fusion, fusion_groups, transform_key, layer_ids,
+            self.resumable_fusion.value, self._get_scheduler_settings(),
+            self.output_chunksize.value or None,
+            on_yielded=self._add_fused_layers,
+            background=background,
+        )
+
+    def _compute_fusion(self, fusion_groups, transform_key, layer_ids,
+                        resumable, scheduler_settings, output_chunksize=None):
+
+        """
+        Fuse channel groups into the fusion cache (unless they're cached
+        already). Yields the cache entry of a group and whether it is
+        complete whenever timepoints have been written. Can run in a
+        worker thread (see _run_task).
+        """
 
-            msims = [msim for _, msim in self.msims.items()
-                    if ch in msi_utils.get_sim_from_msim(msim).coords['c']]
+        # fused images of this run must not be evicted from the cache.
+        # Fused images shown in the viewer are retained (see _add_fused_layers)
+        keep_paths = []
 
-            sims = [msi_utils.get_sim_from_msim(msim) for msim in msims]
+        for chs, lnames, group_sims in fusion_groups:
 
-            sims = [spatial_image_utils.sim_sel_coords(sim,
-                    {'t': [sim.coords['t'][it]
-                            for it in range(self.times_slider.value[0] + 1,
-                                            self.times_slider.value[1] + 1)]})
-                    for sim in sims]
+            ch = ', '.join(chs)
 
-            fused = fusion.fuse(
-                sims,
-                transform_key='affine_registered'
-                if self.visualization_type_rbuttons.value == CHOICE_REGISTERED
-                else 'affine_metadata',
+            # fused images are cached by the input tiles, their
+            # transformations, the time range and the fusion settings
+            fingerprint = _checkpoint.get_fusion_fingerprint(
+                group_sims, transform_key,
+                layer_ids=[layer_ids.get(lname) for lname in sorted(lnames)],
+                multiscale=True)
+            fused_path = _cache.get_entry_path(fingerprint)
+            keep_paths.append(fused_path)
+
+            if _cache.is_complete(fused_path):
+                _cache.mark_used(fused_path)
+                yield fused_path, True
+                continue
+
+            t_coords = group_sims[0].coords['t'].values
+
+            # all timepoints are fused into the union of the tiles over time
+            output_stack_properties = fusion.process_output_stack_properties(
+                sims=group_sims,
+                transform_key=transform_key,
             )
 
-            fused = fused.expand_dims({'c': [sims[0].coords['c'].values]})
+            # resolution levels are chosen from the output size. In 3D,
+            # napari layers are created using a single resolution level
+            # (see viewer_utils.create_image_layer_tuples_from_msim)
+            if len(output_stack_properties['shape']) == 3:
+                scale_factors = []
+            else:
+                scale_factors = viewer_utils.get_pyramid_scale_factors(
+                    output_stack_properties['shape'])
+
+            with _scheduler.scheduler_context(**scheduler_settings), \
+                    _cache.ActiveEntry(fused_path):
+
+                # make room for the fused image within the cache size limit.
+                # Evicting first frees disk space for the disk budget check
+                _cache.evict(keep=keep_paths, reserve_nbytes=_budget.estimate_nbytes(
+                    group_sims, output_stack_properties, scale_factors))
+
+                # plan the output chunks (unless given), refuse fusions not
+                # fitting on disk and reduce the chunk size if needed to
+                # fit into the memory budget
+                estimate = _budget.plan_fusion(
+                    group_sims, transform_key,
+                    output_chunksize=output_chunksize,
+                    output_stack_properties=output_stack_properties,
+                    scale_factors=scale_factors,
+                    path=fused_path,
+                )
+
+                if output_chunksize is not None and estimate['chunksize'] != \
+                        fusion.process_output_chunksize(group_sims, output_chunksize):
+                    warnings.warn(
+                        'Fusing channel(s) %s using output chunks of %s '
+                        'to fit into the memory budget.'
+                        % (ch, tuple(estimate['chunksize'].values())))
+
+                # tiles translated by multiples of the output spacing are
+                # pasted instead of resampled (see _fusion.fuse_channels)
+                on_grid = _fusion.is_on_output_grid(
+                    group_sims, transform_key, output_stack_properties)
+
+                def fuse_timepoints(
+                        t_window, group_sims=group_sims,
+                        output_stack_properties=output_stack_properties,
+                        output_chunksize=estimate['chunksize'],
+                        on_grid=on_grid):
+                    window_sims = [
+                        spatial_image_utils.sim_sel_coords(sim, {'t': t_window})
+                        for sim in group_sims]
+                    if 'c' not in window_sims[0].dims and on_grid:
+                        return _fusion.fuse_channels(
+                            [sim.expand_dims('c').transpose('t', 'c', ...)
+                             for sim in window_sims],
+                            transform_key=transform_key,
+                            output_stack_properties=output_stack_properties,
+                            output_chunksize=output_chunksize,
+                        ).transpose('c', 't', ...)
+                    if 'c' in window_sims[0].dims:
+                        return _fusion.fuse_channels(
+                            window_sims,
+                            transform_key=transform_key,
+                            output_stack_properties=output_stack_properties,
+                            output_chunksize=output_chunksize,
+                        )
+                    fused = fusion.fuse(
+                        window_sims,
+                        transform_key=transform_key,
+                        output_stack_properties=output_stack_properties,
+                        output_chunksize=output_chunksize,
+                    )
+                    return fused.expand_dims(
+                        {'c': [window_sims[0].coords['c'].values]})
 
-            mfused = msi_utils.get_msim_from_sim(fused, scale_factors=[])
+                # fuse timepoint by timepoint, such that fused timepoints
+                # can be shown while the others are fused. If resumable,
+                # interrupted fusions continue where they stopped. The
+                # checkpoint is only valid for the same chunks
+                for _ in _checkpoint.write_timepoints_to_zarr(
+                        fuse_timepoints, t_coords, fused_path,
+                        scale_factors=scale_factors,
+                        n_timepoints=FUSION_TIMEPOINT_WINDOW,
+                        fingerprint='%s_%s' % (fingerprint, '_'.join(
+                            str(c) for c in estimate['chunksize'].values()))
+                        if resumable else None,
+                        desc='Fusing tiles of channel(s) %s' %ch):
+                    yield fused_path, False
 
-            tmp_fused_path = os.path.join(self.tmpdir.name, 'fused_%s.zarr' %ch)
-            if os.path.exists(tmp_fused_path):
-                shutil.rmtree(tmp_fused_path)
+            _cache.mark_complete(fused_path)
 
-            with _utils.TemporarilyDisabledWidgets(self.all_widgets),\
-                _utils.VisibleActivityDock(self.viewer),\
-                _utils.TqdmCallback(tqdm_class=_utils.progress,
-                                    desc='Fusing tiles of channel %s' %ch, bar_format=" "):
-                
-                mfused.to_zarr(tmp_fused_path)
+            # keep the cache within its size limit, without
+            # removing fused images shown in any viewer
+            _cache.evict(keep=keep_paths)
 
-            mfused = msi_utils.multiscale_spatial_image_from_zarr(tmp_fused_path, chunks={})
+            yield fused_path, True
 
-            fused_ch_layer_tuple = viewer_utils.create_image_layer_tuples_from_msim(
-                mfused,
-                colormap=None,
-                name_prefix='fused',
-            )[0]
+    def _add_fused_layers(self, fused_result):
 
-            fused_layer = self.viewer.add_image(fused_ch_layer_tuple[0], **fused_ch_layer_tuple[1])
-        
-            self.fused_layers.append(fused_layer)
+        """
+        Add one layer per channel of a fused image when its first
+        timepoints have been written, and update the layers when
+        further timepoints are written.
+        """
 
+        fused_path, complete = fused_result
+        fused_path = str(fused_path)
+
+        # layers of an interrupted fusion of the same image are continued
+        layers = [l for l in self.streamed_fused_layers.get(fused_path, [])
+                  if l in self.viewer.layers]
+
+        if not len(layers):
+            mfused = msi_utils.multiscale_spatial_image_from_zarr(
+                fused_path, chunks={})
+
+            layers = []
+            for fused_ch_layer_tuple in viewer_utils.create_image_layer_tuples_from_msim(
+                    mfused,
+                    colormap=None,
+                    name_prefix='fused',
+                    ):
+
+                # don't cache chunks of timepoints which are still being fused
+                fused_layer = self.viewer.add_image(
+                    fused_ch_layer_tuple[0],
+                    **(fused_ch_layer_tuple[1] | {'cache': complete}))
+
+                layers.append(fused_layer)
+
+            self.fused_layers += layers
+            self.fused_paths.append(fused_path)
+            # protect the shown fused image from cache eviction
+            _cache.retain(fused_path)
+            if not complete:
+                self.streamed_fused_layers[fused_path] = layers
+
+        else:
+            for fused_layer in layers:
+                fused_layer.refresh()
+
+        if complete:
+            # napari layers can't enable caching after their creation,
+            # so layers of timepoints fused in the meantime are replaced
+            if fused_path in self.streamed_fused_layers:
+                self.fused_layers = [
+                    self._replace_by_cached_layer(l)
+                    if l in self.streamed_fused_layers[fused_path] else l
+                    for l in self.fused_layers]
+                del self.streamed_fused_layers[fused_path]
+
+    def _replace_by_cached_layer(self, layer):
+        """Replace a layer by one caching its data, in the same position."""
+
+        if layer not in self.viewer.layers:
+            return layer
+
+        index = self.viewer.layers.index(layer)
+        data, state, _ = layer.as_layer_data_tuple()
+        self.viewer.layers.remove(layer)
+
+        cached_layer = self.viewer.add_image(data, **(state | {'cache': True}))
+        self.viewer.layers.move(len(self.viewer.layers) - 1, index)
+
+        return cached_layer
+
+    def _release_fused_paths(self):
+        """Allow evicting the fused images added by this widget."""
+        for fused_path in self.fused_paths:
+            _cache.release(fused_path)
+        self.fused_paths = []
 
     def reset(self):
             
@@ -575,6 +1039,10 @@ class StitcherQWidget(QWidget):
         self.times_slider.value = (-1, 0)
         self.input_layers = []
         self.fused_layers = []
+        self._release_fused_paths()
+        self.streamed_fused_layers = {}
+        self.preview_layers = []
+        self.preview_cache.clear()
         self._last_applied_tp = None
 
 
@@ -590,11 +1058,12 @@ class StitcherQWidget(QWidget):
 
         if 'c' in reference_sim.coords.keys():
             self.reg_ch_picker.choices = np.unique([
-                _utils.get_str_unique_to_ch_from_sim_coords(msi_utils.get_sim_from_msim(msim).coords)
-                for l_name, msim in self.msims.items()])
+                ch for l_name, msim in self.msims.items()
+                for ch in _utils.get_ch_coords_from_sim_coords(
+                    msi_utils.get_sim_from_msim(msim).coords)])
             self.reg_ch_picker.value = self.reg_ch_picker.choices[0]
 
-        for w in self.reg_config_widgets + [self.button_stitch, self.button_fuse]:
+        for w in self.reg_config_widgets + [self.button_stitch, self.button_preview, self.resumable_fusion, self.button_fuse]:
             if isinstance(w, Iterable):
                 for sw in w:
                     sw.enabled = True
@@ -641,25 +1110,22 @@ class StitcherQWidget(QWidget):
         self.layers_selection.choices = sorted([l.name for l in layers])
 
         # load in layers as msims
+        self.duplicated_nbytes = 0
         for l in self.input_layers:
             msim = viewer_utils.image_layer_to_msim(l, self.viewer)
-            
-            if 'c' in msim['scale0/image'].dims:
-                notifications.notification_manager.receive_info(
-                    "Layer '%s' has more than one channel. Consider splitting the stack (right click on layer -> 'Split Stack')." %l.name
-                )
-                self.layers_selection.choices = []
-                self.reset()
-                return
-            
+            self.duplicated_nbytes += viewer_utils.get_duplicated_nbytes(
+                l, msim)
+
+            # multi-channel layers are kept as a single msim, channels
+            # are selected when registering and fusing
             msim = msi_utils.ensure_dim(msim, 't')
             self.msims[l.name] = msim
 
         sims = [msi_utils.get_sim_from_msim(msim) for l.name, msim in self.msims.items()]
 
         number_of_channels = len(np.unique([
-            _utils.get_str_unique_to_ch_from_sim_coords(sim.coords)
-                for sim in sims]))
+            ch for sim in sims
+                for ch in _utils.get_ch_coords_from_sim_coords(sim.coords)]))
         
         if len(layers) and number_of_channels > 1:
             self.link_channel_layers(layers)
@@ -667,6 +1133,12 @@ class StitcherQWidget(QWidget):
         if len(layers) / number_of_channels > 1:
             self.link_view_layers(layers)
 
+        if self.duplicated_nbytes:
+            notifications.notification_manager.receive_info(
+                'Loading layers duplicated %.1f MB of in-memory image data.'
+                % (self.duplicated_nbytes / 1e6)
+            )
+
         # if loaded layer changes, update msim
         for l in self.input_layers:
             l.events.connect(self.watch_layer_changes)
@@ -747,6 +1219,8 @@ class StitcherQWidget(QWidget):
 
         print('Deleting napari-stitcher widget')
 
+        self._release_fused_paths()
+
         # clean up callbacks
         self.viewer.dims.events.current_step.disconnect(self.update_viewer_transformations)
 
@@ -0,0 +1,158 @@
+import numpy as np
+
+from multiview_stitcher import (
+    fusion, mv_graph, param_utils, spatial_image_utils)
+from multiview_stitcher.sample_data import generate_tiled_dataset
+
+from napari_stitcher import _budget, _fusion
+
+import pytest
+
+
+def get_sims(N_c=2):
+    return generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=N_c, tile_size=200, overlap=40,
+        tiles_x=2, tiles_y=2, dtype=np.uint16)
+
+
+def test_estimate_fusion():
+
+    sims = get_sims()
+
+    estimate = _budget.estimate_fusion(
+        sims, transform_key='affine_metadata', output_chunksize=128,
+        scale_factors=[{'y': 2, 'x': 2}], n_workers=2)
+
+    fused = _fusion.fuse_channels(
+        sims, transform_key='affine_metadata', output_chunksize=128)
+
+    assert tuple(estimate['shape'].values()) == fused.shape[-2:]
+    assert estimate['chunksize'] == {'y': 128, 'x': 128}
+
+    # fused image and its second level
+    assert estimate['nbytes'] == fused.nbytes \
+        + fused.nbytes // fused.shape[-1] // fused.shape[-2] \
+        * (fused.shape[-2] // 2) * (fused.shape[-1] // 2)
+
+    # chunks in the center of the output overlap with all four tiles
+    assert estimate['chunk_memory'] >= 128 ** 2 * 4 * 2 * 2
+    assert estimate['memory'] == 2 * estimate['chunk_memory']
+
+    # at least one task per output chunk and timepoint
+    assert estimate['n_tasks'] > 2 * np.prod(fused.data.numblocks[-2:])
+
+
+@pytest.mark.parametrize('ndim', [2, 3])
+def test_get_chunk_view_counts(ndim):
+
+    sims = generate_tiled_dataset(
+        ndim=ndim, N_t=1, N_c=1, tile_size=100, overlap=10,
+        tiles_x=3, tiles_y=2, tiles_z=1, dtype=np.uint16)
+
+    # rotate one of the tiles within the yx plane
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+    rotation = np.eye(ndim + 1)
+    rotation[ndim - 2:ndim, ndim - 2:ndim] = [
+        [np.cos(0.3), -np.sin(0.3)], [np.sin(0.3), np.cos(0.3)]]
+    spatial_image_utils.set_sim_affine(
+        sims[1], param_utils.matmul_xparams(
+            param_utils.affine_to_xaffine(rotation),
+            spatial_image_utils.get_affine_from_sim(
+                sims[1], 'affine_metadata')),
+        transform_key='affine_metadata')
+
+    output_stack_properties = fusion.process_output_stack_properties(
+        sims, transform_key='affine_metadata')
+    output_chunk_bbs, _ = mv_graph.get_chunk_bbs(
+        output_stack_properties, {dim: 32 for dim in spatial_dims})
+    views_bb = [spatial_image_utils.get_stack_properties_from_sim(sim)
+                for sim in sims]
+    params = [spatial_image_utils.get_affine_from_sim(
+        sim, 'affine_metadata').squeeze(drop=True) for sim in sims]
+
+    counts = _budget.get_chunk_view_counts(output_chunk_bbs, views_bb, params)
+
+    assert list(counts) == [
+        sum(mv_graph.get_overlap_for_bbs(
+            target_bb=output_chunk_bb, query_bbs=[view_bb], param=param,
+        )[0] is not None for view_bb, param in zip(views_bb, params))
+        for output_chunk_bb in output_chunk_bbs]
+
+
+def test_plan_fusion(monkeypatch):
+
+    sims = get_sims(N_c=1)
+    estimate = _budget.estimate_fusion(
+        sims, transform_key='affine_metadata', n_workers=1)
+
+    # fits into the budgets
+    assert _budget.plan_fusion(
+        sims, transform_key='affine_metadata', n_workers=1,
+        output_chunksize=estimate['chunksize'],
+        memory_budget=estimate['memory'],
+        disk_budget=estimate['nbytes']) == estimate
+
+    # smaller chunks are used if the memory budget is exceeded
+    reduced = _budget.plan_fusion(
+        sims, transform_key='affine_metadata', n_workers=1,
+        output_chunksize=estimate['chunksize'],
+        memory_budget=estimate['memory'] // 3,
+        disk_budget=estimate['nbytes'])
+    assert reduced['memory'] <= estimate['memory'] // 3
+    assert reduced['nbytes'] == estimate['nbytes']
+
+    fused = fusion.fuse(
+        sims, transform_key='affine_metadata',
+        output_chunksize=reduced['chunksize'])
+    assert max(fused.data.chunksize[-2:]) < max(estimate['shape'].values())
+
+    with pytest.raises(_budget.BudgetExceededError):
+        _budget.plan_fusion(
+            sims, transform_key='affine_metadata', n_workers=1,
+            memory_budget=1, disk_budget=estimate['nbytes'])
+
+    # budgets are read from the environment
+    monkeypatch.setenv('NAPARI_STITCHER_DISK_BUDGET', '%s' % (
+        (estimate['nbytes'] - 1) / 2**30))
+    with pytest.raises(_budget.BudgetExceededError):
+        _budget.plan_fusion(sims, transform_key='affine_metadata')
+
+
+@pytest.mark.parametrize('ndim', [2, 3])
+def test_plan_output_chunksize(ndim):
+
+    sims = generate_tiled_dataset(
+        ndim=ndim, N_t=1, N_c=1, tile_size=300, overlap=20,
+        tiles_x=3, tiles_y=3, tiles_z=1, dtype=np.uint16)
+    output_stack_properties = fusion.process_output_stack_properties(
+        sims, transform_key='affine_metadata')
+    shape = output_stack_properties['shape']
+
+    def plan(**kwargs):
+        chunksize = _budget.plan_output_chunksize(
+            sims, output_stack_properties, **kwargs)
+        n_chunks = np.prod([np.ceil(shape[dim] / chunksize[dim])
+                            for dim in chunksize])
+        return chunksize, n_chunks
+
+    # chunks of half the tile size
+    chunksize, n_chunks = plan(n_workers=1, memory_budget=2**40)
+    assert all(chunksize[dim] == min(128, shape[dim]) for dim in chunksize)
+
+    # there are enough chunks for all workers
+    chunksize, n_chunks = plan(n_workers=8, memory_budget=2**40)
+    assert n_chunks >= _budget.CHUNKS_PER_WORKER * 8
+
+    # chunks are reduced to fit into the memory budget, which can be
+    # met by chunks of twice the minimal size
+    def get_memory(chunksize):
+        return 2 * _budget.get_chunk_memory(
+            np.prod(list(chunksize.values())), 2 ** ndim, 1, 2)
+
+    memory_budget = get_memory({
+        dim: (2 if dim == 'x' else 1) * _budget.MIN_CHUNKSIZE
+        for dim in shape})
+    assert get_memory(plan(n_workers=2, memory_budget=2**40)[0]) > memory_budget
+
+    chunksize, n_chunks = plan(n_workers=2, memory_budget=memory_budget)
+    assert get_memory(chunksize) <= memory_budget
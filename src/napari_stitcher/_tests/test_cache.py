@@ -0,0 +1,83 @@
+import os
+
+from napari_stitcher import _cache
+
+
+def test_evict(tmp_path, monkeypatch):
+
+    monkeypatch.setenv('NAPARI_STITCHER_CACHE_DIR', str(tmp_path))
+
+    paths = []
+    for i in range(4):
+        path = _cache.get_entry_path('fp%s' % i)
+        os.makedirs(path)
+        with open(path / 'data', 'wb') as f:
+            f.write(b'0' * 1000)
+        _cache.mark_complete(path)
+        # entries were used in order
+        os.utime(path / _cache.COMPLETE_FILENAME, (i, i))
+        paths.append(path)
+
+    assert _cache.is_complete(paths[0])
+    assert not _cache.is_complete(tmp_path / 'missing')
+
+    # use the oldest entry again
+    _cache.mark_used(paths[0])
+
+    removed = _cache.evict(max_nbytes=3000, keep=[paths[1]])
+
+    assert removed == [paths[2]]
+    assert [path.exists() for path in paths] == [True, True, False, True]
+
+    # retained entries are kept, also when making room for a new entry
+    _cache.retain(paths[3])
+    _cache.retain(paths[3])
+    _cache.release(paths[3])
+    removed = _cache.evict(max_nbytes=3000, reserve_nbytes=1500)
+    assert removed == [paths[1], paths[0]]
+    assert paths[3].exists()
+
+    _cache.release(paths[3])
+    monkeypatch.setenv('NAPARI_STITCHER_FUSION_CACHE_SIZE', '0')
+    _cache.evict()
+    assert not any(path.exists() for path in paths)
+
+
+def test_evict_active(tmp_path, monkeypatch):
+
+    monkeypatch.setenv('NAPARI_STITCHER_CACHE_DIR', str(tmp_path))
+
+    # an incomplete entry which another process started writing long ago
+    path = _cache.get_entry_path('fp')
+    os.makedirs(path / 'image')
+    with open(path / 'image' / 'data', 'wb') as f:
+        f.write(b'0' * 1000)
+    os.utime(path, (0, 0))
+
+    # entries being written are kept, also by other processes
+    with _cache.ActiveEntry(path, interval=0.01):
+        assert _cache.is_active(path)
+        assert _cache.evict(max_nbytes=0) == []
+        assert path.exists()
+
+    assert not _cache.is_active(path)
+    assert not _cache.get_active_path(path).exists()
+
+    # heartbeats of processes which stopped are ignored and removed
+    _cache.get_active_path(path).touch()
+    os.utime(_cache.get_active_path(path), (0, 0))
+    assert not _cache.is_active(path)
+    assert _cache.evict(max_nbytes=0) == [path]
+    assert not _cache.get_active_path(path).exists()
+
+
+def test_get_fusion_cache_dir(tmp_path, monkeypatch):
+
+    monkeypatch.setenv('NAPARI_STITCHER_CACHE_DIR', str(tmp_path / 'cache'))
+    assert _cache.get_entry_path('fp').parent == \
+        tmp_path / 'cache' / _cache.FUSION_CACHE_SUBDIR
+
+    # fused images can be stored separately from the other caches
+    monkeypatch.setenv('NAPARI_STITCHER_FUSION_CACHE_DIR', str(tmp_path / 'spill'))
+    assert _cache.get_entry_path('fp').parent == tmp_path / 'spill'
+    assert (tmp_path / 'spill').is_dir()
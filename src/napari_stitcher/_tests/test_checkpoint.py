@@ -0,0 +1,178 @@
+import glob
+import os
+
+import numpy as np
+import dask.array as da
+
+from multiview_stitcher import msi_utils, spatial_image_utils
+
+from napari_stitcher import _checkpoint
+
+import pytest
+
+
+def get_msim(computed_blocks, fail=False, scale_factors=()):
+    """
+    Lazy msim recording the computed blocks. If fail is True,
+    computing the blocks of the last rows raises an error.
+    """
+
+    def f(x, block_info=None):
+        block_id = block_info[0]['chunk-location']
+        computed_blocks.append(block_id)
+        if fail and block_id[-2] >= 2:
+            raise RuntimeError('Interrupted')
+        return x + block_id[-1]
+
+    data = da.ones((1, 1, 100, 70), chunks=(1, 1, 32, 32), dtype=np.uint16)
+    sim = spatial_image_utils.get_sim_from_array(
+        data.map_blocks(f, dtype=np.uint16), dims=['t', 'c', 'y', 'x'])
+
+    return msi_utils.get_msim_from_sim(sim, scale_factors=list(scale_factors))
+
+
+def test_write_msim_to_zarr_resumable(tmp_path):
+
+    path = tmp_path / 'fused.zarr'
+    computed_blocks = []
+
+    with pytest.raises(RuntimeError):
+        _checkpoint.write_msim_to_zarr_resumable(
+            get_msim(computed_blocks, fail=True), path, 'fp1', n_batch=3)
+
+    # only the blocks missing from the checkpoint are computed
+    computed_blocks.clear()
+    mfused = _checkpoint.write_msim_to_zarr_resumable(
+        get_msim(computed_blocks), path, 'fp1', n_batch=3)
+    assert len(computed_blocks) == 6
+
+    expected = get_msim([])['scale0/image'].data.compute()
+    assert np.array_equal(mfused['scale0/image'].data.compute(), expected)
+
+    # damaged chunks are detected and rewritten
+    chunk_files = sorted(
+        fn for fn in glob.glob(str(path / 'scale0' / 'image' / '**' / '*'),
+                               recursive=True)
+        if os.path.isfile(fn) and not os.path.basename(fn).startswith(('.', 'zarr')))
+    with open(chunk_files[0], 'wb') as f:
+        f.write(b'damaged')
+
+    computed_blocks.clear()
+    mfused = _checkpoint.write_msim_to_zarr_resumable(
+        get_msim(computed_blocks), path, 'fp1', n_batch=3)
+    assert len(computed_blocks) == 1
+    assert np.array_equal(mfused['scale0/image'].data.compute(), expected)
+
+    # a different fingerprint rewrites everything
+    computed_blocks.clear()
+    _checkpoint.write_msim_to_zarr_resumable(
+        get_msim(computed_blocks), path, 'fp2', n_batch=3)
+    assert len(computed_blocks) == 12
+
+
+@pytest.mark.parametrize('resumable', [False, True])
+def test_write_msim_pyramid_to_zarr(tmp_path, resumable):
+
+    path = tmp_path / 'fused.zarr'
+    computed_blocks = []
+    scale_factors = [{'y': 2, 'x': 2}, {'y': 2, 'x': 2}]
+
+    msim = get_msim(computed_blocks, scale_factors=scale_factors)
+    if resumable:
+        mfused = _checkpoint.write_msim_to_zarr_resumable(
+            msim, path, 'fp1', n_batch=3)
+    else:
+        mfused = _checkpoint.write_msim_to_zarr(msim, path)
+
+    # lower resolution levels don't recompute the highest one
+    assert len(computed_blocks) == 12
+
+    expected_msim = get_msim([], scale_factors=scale_factors)
+    scale_keys = msi_utils.get_sorted_scale_keys(expected_msim)
+    assert msi_utils.get_sorted_scale_keys(mfused) == scale_keys
+    for scale_key in scale_keys:
+        assert np.array_equal(
+            mfused[scale_key]['image'].data.compute(),
+            expected_msim[scale_key]['image'].data.compute())
+
+
+def get_timelapse_sim(t_coords, computed_blocks):
+    """
+    Lazy sim with the value t at timepoint t, recording the computed blocks.
+    """
+
+    def f(x, block_info=None):
+        computed_blocks.append(block_info[0]['chunk-location'])
+        return x
+
+    data = da.concatenate([
+        da.full((1, 1, 100, 70), t, chunks=(1, 1, 32, 32), dtype=np.uint16)
+        for t in t_coords]).map_blocks(f, dtype=np.uint16)
+
+    return spatial_image_utils.get_sim_from_array(
+        data, dims=['t', 'c', 'y', 'x'], t_coords=t_coords)
+
+
+@pytest.mark.parametrize('fingerprint', [None, 'fp1'])
+def test_write_timepoints_to_zarr(tmp_path, fingerprint):
+
+    path = tmp_path / 'fused.zarr'
+    t_coords = np.arange(5)
+    scale_factors = [{'y': 2, 'x': 2}]
+    computed_blocks, windows = [], []
+
+    def get_sim(t_window):
+        windows.append(list(t_window))
+        return get_timelapse_sim(t_window, computed_blocks)
+
+    def get_writer():
+        return _checkpoint.write_timepoints_to_zarr(
+            get_sim, t_coords, path, scale_factors=scale_factors,
+            n_timepoints=2, fingerprint=fingerprint)
+
+    # timepoints can be read as soon as their window is written
+    writer = get_writer()
+    assert next(writer) == 2
+    stored = msi_utils.multiscale_spatial_image_from_zarr(str(path))
+    assert np.array_equal(
+        stored['scale0/image'].data[:2].compute(),
+        get_timelapse_sim(t_coords[:2], []).data.compute())
+    writer.close()
+
+    computed_blocks.clear()
+    windows.clear()
+    n_written = []
+    writer = get_writer()
+    try:
+        while True:
+            n_written.append(next(writer))
+    except StopIteration as stop:
+        mfused = stop.value
+
+    # the graphs only cover single windows
+    assert n_written == [2, 4, 5]
+    assert windows == [[0, 1], [2, 3], [4]]
+
+    # resuming skips the timepoints written before
+    assert len(computed_blocks) == (3 if fingerprint else 5) * 12
+
+    expected_msim = msi_utils.get_msim_from_sim(
+        get_timelapse_sim(t_coords, []), scale_factors=scale_factors)
+    for scale_key in ['scale0', 'scale1']:
+        assert np.array_equal(
+            mfused[scale_key]['image'].data.compute(),
+            expected_msim[scale_key]['image'].data.compute())
+
+
+def test_get_fusion_fingerprint():
+
+    sim = spatial_image_utils.get_sim_from_array(
+        np.zeros((10, 10)), dims=['y', 'x'], transform_key='affine_metadata')
+
+    fp = _checkpoint.get_fusion_fingerprint([sim], 'affine_metadata')
+    assert fp == _checkpoint.get_fusion_fingerprint([sim.copy()], 'affine_metadata')
+
+    shifted_sim = spatial_image_utils.get_sim_from_array(
+        np.zeros((10, 10)), dims=['y', 'x'], translation={'y': 1, 'x': 0},
+        transform_key='affine_metadata')
+    assert fp != _checkpoint.get_fusion_fingerprint([shifted_sim], 'affine_metadata')
@@ -0,0 +1,150 @@
+import numpy as np
+
+from multiview_stitcher import fusion, param_utils, spatial_image_utils
+from multiview_stitcher.sample_data import generate_tiled_dataset
+
+from napari_stitcher import _fusion, _utils
+
+import pytest
+
+
+@pytest.mark.parametrize("ndim, shift", [(2, 0), (2, 0.3), (3, 0)])
+def test_fuse_channels(ndim, shift):
+
+    sims = generate_tiled_dataset(
+        ndim=ndim, N_t=1, N_c=2, tile_size=60, overlap=10,
+        tiles_x=2, tiles_y=1)
+    sims = [sim.copy(data=sim.data.persist()) for sim in sims]
+
+    # non-integer translations require interpolation
+    affine = param_utils.affine_from_translation([shift] * ndim)
+    spatial_image_utils.set_sim_affine(
+        sims[1],
+        param_utils.rebase_affine(
+            param_utils.affine_to_xaffine(affine),
+            spatial_image_utils.get_affine_from_sim(sims[1], 'affine_metadata')),
+        transform_key='affine_metadata')
+
+    # one single channel layer per view and channel
+    sims_by_layer = {
+        'tile%s :: %s' % (iview, ch): spatial_image_utils.sim_sel_coords(sim, {'c': ch})
+        for iview, sim in enumerate(sims)
+        for ch in sim.coords['c'].values}
+    channels = [str(ch) for ch in sims[0].coords['c'].values]
+
+    combined_sims = _utils.combine_channels_per_view(sims_by_layer, channels)
+    assert len(combined_sims) == len(sims)
+
+    fused = _fusion.fuse_channels(combined_sims, transform_key='affine_metadata')
+
+    for ch in channels:
+        fused_ch = fusion.fuse(
+            [sim for lname, sim in sims_by_layer.items() if lname.endswith(ch)],
+            transform_key='affine_metadata').compute()
+        # tiles on the output grid are pasted instead of resampled,
+        # which can change the rounding of blended pixels
+        assert np.allclose(fused.sel(c=ch).values, fused_ch.values,
+                           rtol=0, atol=0 if shift else 1)
+
+
+def test_fuse_chunk_channels_shares_coordinates(monkeypatch):
+
+    n_sampled = {}
+    get_sampling_coordinates = _fusion.get_sampling_coordinates
+
+    def counting_get_sampling_coordinates(*args, **kwargs):
+        n_sampled[N_c] = n_sampled.get(N_c, 0) + 1
+        return get_sampling_coordinates(*args, **kwargs)
+
+    monkeypatch.setattr(
+        _fusion, 'get_sampling_coordinates', counting_get_sampling_coordinates)
+
+    # sampling coordinates are computed once per view and chunk,
+    # independently of the number of channels
+    for N_c in [1, 4]:
+        sims = generate_tiled_dataset(
+            ndim=2, N_t=1, N_c=N_c, tile_size=60, overlap=10,
+            tiles_x=2, tiles_y=1)
+        affine = param_utils.affine_from_translation([0.3, 0.3])
+        spatial_image_utils.set_sim_affine(
+            sims[1],
+            param_utils.rebase_affine(
+                param_utils.affine_to_xaffine(affine),
+                spatial_image_utils.get_affine_from_sim(sims[1], 'affine_metadata')),
+            transform_key='affine_metadata')
+
+        _fusion.fuse_channels(
+            sims, transform_key='affine_metadata', output_chunksize=32).compute()
+
+    assert n_sampled[4] == n_sampled[1] > 0
+
+
+@pytest.mark.parametrize("rotation", [0, 5])
+def test_paste_chunk_channels(monkeypatch, rotation):
+
+    sims = generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=2, tile_size=100, overlap=20,
+        tiles_x=2, tiles_y=2, dtype=np.uint16)
+    sims = [sim.copy(data=sim.data.persist()) for sim in sims]
+
+    # general affine transformations are resampled
+    angle = np.deg2rad(rotation)
+    affine = np.array([[np.cos(angle), -np.sin(angle), 0],
+                       [np.sin(angle), np.cos(angle), 0],
+                       [0, 0, 1]])
+    spatial_image_utils.set_sim_affine(
+        sims[3],
+        param_utils.rebase_affine(
+            param_utils.affine_to_xaffine(affine),
+            spatial_image_utils.get_affine_from_sim(sims[3], 'affine_metadata')),
+        transform_key='affine_metadata')
+
+    output_stack_properties = fusion.process_output_stack_properties(
+        sims, transform_key='affine_metadata')
+    assert _fusion.is_on_output_grid(
+        sims, 'affine_metadata', output_stack_properties) == (not rotation)
+
+    n_resampled = []
+    fuse_chunk_channels = _fusion.fuse_chunk_channels
+
+    def counting_fuse_chunk_channels(*args, **kwargs):
+        n_resampled.append(1)
+        return fuse_chunk_channels(*args, **kwargs)
+
+    monkeypatch.setattr(
+        _fusion, 'fuse_chunk_channels', counting_fuse_chunk_channels)
+
+    fused = _fusion.fuse_channels(
+        sims, transform_key='affine_metadata', output_chunksize=64).compute()
+    expected = np.stack([
+        fusion.fuse([sim.sel(c=ch) for sim in sims],
+                    transform_key='affine_metadata', output_chunksize=64).data
+        for ch in sims[0].coords['c'].values], axis=1).compute()
+
+    assert np.abs(fused.values.astype(float) - expected).max() <= 1
+
+    if rotation:
+        # general transformations fall back to resampling
+        assert len(n_resampled)
+    else:
+        assert not len(n_resampled)
+
+        # pixels outside of the overlaps are copied from the tiles
+        assert np.array_equal(
+            fused.values[:, :, :80, :80], sims[0].values[:, :, :80, :80])
+
+
+def test_combine_channels_per_view_incomplete():
+
+    sims = generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=2, tile_size=30, overlap=5, tiles_x=2, tiles_y=1)
+
+    # the second view lacks a channel
+    sims_by_layer = {
+        'tile0 :: channel 0': spatial_image_utils.sim_sel_coords(sims[0], {'c': 'channel 0'}),
+        'tile0 :: channel 1': spatial_image_utils.sim_sel_coords(sims[0], {'c': 'channel 1'}),
+        'tile1 :: channel 0': spatial_image_utils.sim_sel_coords(sims[1], {'c': 'channel 0'}),
+    }
+
+    assert _utils.combine_channels_per_view(
+        sims_by_layer, ['channel 0', 'channel 1']) is None
@@ -0,0 +1,102 @@
+import numpy as np
+import dask.array as da
+
+from multiview_stitcher import fusion
+from multiview_stitcher.sample_data import generate_tiled_dataset
+
+from napari_stitcher import _preview, viewer_utils
+
+
+def test_chunk_cached_array():
+
+    computed_blocks = []
+
+    def f(x, block_info=None):
+        computed_blocks.append(block_info[0]['chunk-location'])
+        return x
+
+    data = np.random.rand(3, 100, 70)
+    array = da.from_array(data, chunks=(1, 32, 32)).map_blocks(f, dtype=float)
+
+    # room for 10 chunks
+    cache = _preview.ChunkCache(max_nbytes=10 * 32 * 32 * 8)
+    cached_array = _preview.ChunkCachedArray(array, cache)
+
+    for key in [
+            (1, slice(10, 50), slice(5, 69)),
+            (0, slice(None, None, 3), -1),
+            (slice(None), 5),
+            Ellipsis,
+            ]:
+        assert np.array_equal(cached_array[key], data[key])
+
+    assert cache.nbytes <= cache.max_nbytes
+
+    # only chunks of the requested region are computed, and only once
+    cache.clear()
+    computed_blocks.clear()
+    cached_array[1, 10:50, 5:69]
+    assert len(computed_blocks) == 6
+    cached_array[1, 60:70, 60:70]
+    assert len(computed_blocks) == 6 + 2
+
+
+def test_get_preview_layer_tuples():
+
+    sims = generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=1, tile_size=300, overlap=30, tiles_x=2, tiles_y=2)
+    sims = [sim.copy(data=sim.data.persist()) for sim in sims]
+    msims = {'tile%s' % isim: viewer_utils.get_msim_pyramid(sim)
+             for isim, sim in enumerate(sims)}
+    ch = str(sims[0].coords['c'].values[0])
+
+    cache = _preview.ChunkCache()
+    layer_tuples = _preview.get_preview_layer_tuples(
+        msims, [ch], 'affine_metadata', cache)
+
+    assert len(layer_tuples) == 1
+    data, kwargs, _ = layer_tuples[0]
+    assert kwargs['name'] == 'preview :: %s' % ch
+
+    # nothing is fused before the data is accessed
+    assert not len(cache.chunks)
+
+    fused = fusion.fuse(sims, transform_key='affine_metadata')
+    assert data[0].shape == fused.shape[:1] + fused.shape[-2:]
+    assert np.array_equal(
+        data[0][0, 200:300, 250:400],
+        fused.data[0, 0, 200:300, 250:400].compute())
+    assert 0 < len(cache.chunks) < np.prod(fused.data.numblocks)
+
+
+def test_get_preview_layer_tuples_3d():
+
+    sims = generate_tiled_dataset(
+        ndim=3, N_t=1, N_c=1, tile_size=150, overlap=15, tiles_x=2, tiles_y=1)
+    msims = {'tile%s' % isim: viewer_utils.get_msim_pyramid(sim)
+             for isim, sim in enumerate(sims)}
+    ch = str(sims[0].coords['c'].values[0])
+
+    cache = _preview.ChunkCache()
+    levels = _preview.get_preview_levels(
+        list(msims.values()), 'affine_metadata', cache)
+    assert len(levels) > 1
+
+    max_spacings = [max(stack_properties['spacing'].values())
+                    for _, stack_properties in levels]
+
+    # 3D previews contain the coarsest level resolving the viewer spacing
+    for viewer_spacing in max_spacings:
+        ilevel = _preview.get_preview_level_index(levels, viewer_spacing)
+        assert max_spacings[ilevel] <= viewer_spacing
+        assert ilevel == len(levels) - 1 \
+            or max_spacings[ilevel + 1] > viewer_spacing
+
+        data, _, _ = _preview.get_preview_layer_tuples(
+            msims, [ch], 'affine_metadata', cache,
+            viewer_spacing=viewer_spacing)[0]
+        assert len(data) == 1
+        assert data[0].shape == levels[ilevel][0].shape
+
+    assert _preview.get_preview_level_index(levels) == len(levels) - 1
+    assert _preview.get_preview_level_index(levels, 1e-6) == 0
@@ -1,13 +1,24 @@
+import copy
+import os
+import shutil
 from pathlib import Path
 
-from napari_stitcher import napari_get_reader, _reader
+import numpy as np
+import dask.array as da
+import pytest
+import tifffile
 
+from napari_stitcher import napari_get_reader, _reader, _czi_index
+
+from multiview_stitcher import msi_utils, sample_data
 from multiview_stitcher.sample_data import get_mosaic_sample_data_path
 
 
-def test_reader():
+def test_reader(tmp_path, monkeypatch):
     """An example of how you might test your plugin."""
 
+    monkeypatch.setenv('NAPARI_STITCHER_CACHE_DIR', str(tmp_path / 'cache'))
+
     test_path = get_mosaic_sample_data_path()
 
     # try to read it back in
@@ -21,3 +32,267 @@ def test_reader():
 
     layer_data_tuple = layer_data_list[0]
     assert isinstance(layer_data_tuple, tuple) and len(layer_data_tuple) > 0
+
+
+def test_czi_index_cache(tmp_path, monkeypatch):
+    """
+    The second open of a CZI file should use the on-disk index,
+    which is invalidated when the file changes.
+    """
+
+    monkeypatch.setenv('NAPARI_STITCHER_CACHE_DIR', str(tmp_path / 'cache'))
+
+    test_path = tmp_path / 'mosaic.czi'
+    shutil.copy(get_mosaic_sample_data_path(), test_path)
+
+    layer_data_list = _reader.read_mosaic(str(test_path))
+
+    index_files = list((tmp_path / 'cache' / 'czi_index').glob('*.json'))
+    assert len(index_files) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Index should have been read from the cache.')
+
+    # reopening neither parses the file nor reads pixel data
+    reads = []
+    read_czi_subblock = _czi_index.read_czi_subblock
+    with monkeypatch.context() as m:
+        m.setattr(_czi_index, 'build_czi_index', fail)
+        m.setattr(_czi_index.czi_utils, 'open_czi', fail)
+        m.setattr(
+            _czi_index, 'read_czi_subblock',
+            lambda *args: reads.append(args) or read_czi_subblock(*args))
+        cached_layer_data_list = _reader.read_mosaic(str(test_path))
+        assert not len(reads)
+
+    assert len(cached_layer_data_list) == len(layer_data_list)
+    for ld, cached_ld in zip(layer_data_list, cached_layer_data_list):
+        assert np.allclose(ld[1]['translate'], cached_ld[1]['translate'])
+        assert ld[1]['contrast_limits'] == cached_ld[1]['contrast_limits']
+        assert np.array_equal(ld[0][0].data, cached_ld[0][0].data)
+
+    # modifying the file invalidates the index
+    stat = os.stat(test_path)
+    os.utime(test_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    built = []
+    build_czi_index = _czi_index.build_czi_index
+    monkeypatch.setattr(
+        _czi_index, 'build_czi_index',
+        lambda path: built.append(path) or build_czi_index(path))
+    _czi_index.get_czi_index(test_path)
+    assert len(built) == 1
+
+    # entries of deleted files are evicted
+    os.remove(test_path)
+    _czi_index.evict_czi_index_cache()
+    assert not len(list((tmp_path / 'cache' / 'czi_index').glob('*.json')))
+
+
+def test_pyramid_cache(tmp_path, monkeypatch):
+    """
+    Persisted pyramids are evicted when exceeding the cache size limit,
+    except for those shown in this session.
+    """
+
+    from napari_stitcher import _cache
+
+    monkeypatch.setenv('NAPARI_STITCHER_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('NAPARI_STITCHER_PYRAMID_CACHE_SIZE', '0')
+
+    test_path = tmp_path / 'mosaic.czi'
+    shutil.copy(get_mosaic_sample_data_path(), test_path)
+
+    layer_data_list = _reader.read_mosaic(str(test_path), cache_pyramids=True)
+
+    pyramid_dir = tmp_path / 'cache' / _reader.PYRAMID_CACHE_SUBDIR
+    store_paths = set(pyramid_dir.glob('*.zarr'))
+    assert len(store_paths) == len(layer_data_list)
+
+    for store_path in store_paths:
+        _cache.release(store_path)
+
+    # modifying the file creates new pyramids, evicting the unused ones
+    stat = os.stat(test_path)
+    os.utime(test_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    _reader.read_mosaic(str(test_path), cache_pyramids=True)
+
+    new_store_paths = set(pyramid_dir.glob('*.zarr'))
+    assert len(new_store_paths) == len(store_paths)
+    assert not len(new_store_paths & store_paths)
+
+    for store_path in new_store_paths:
+        _cache.release(store_path)
+
+
+def test_read_multiple_scenes(tmp_path, monkeypatch):
+    """
+    Load several scenes at once. The sample file contains a single scene,
+    so a second scene is simulated by duplicating the index entries.
+    """
+
+    monkeypatch.setenv('NAPARI_STITCHER_CACHE_DIR', str(tmp_path / 'cache'))
+
+    test_path = str(get_mosaic_sample_data_path())
+
+    index = copy.deepcopy(_czi_index.get_czi_index(test_path))
+
+    assert len(_reader.read_mosaic(test_path, scene_index='all')) == \
+        len(_reader.read_mosaic(test_path, scene_index=0))
+
+    with pytest.raises(ValueError):
+        _reader.read_mosaic(test_path, scene_index=[0, 1])
+
+    index['n_scenes'] = 2
+    index['scene_names'] = ['sceneA', 'sceneB']
+    index['intervals']['1'] = index['intervals']['0']
+    index['entries'] += [
+        dict(entry, pos=dict(entry['pos'], S=1))
+        for entry in index['entries']]
+
+    monkeypatch.setattr(_czi_index, 'get_czi_index', lambda path: index)
+
+    layer_data_list = _reader.read_mosaic(test_path, scene_index='all')
+    names = [ld[1]['name'] for ld in layer_data_list]
+
+    assert len(names) == 4
+    assert names[:2] == [name.replace('sceneB', 'sceneA')
+                         for name in names[2:]]
+    assert all(name.startswith('sceneA_') for name in names[:2])
+
+
+def test_read_zarr_tiles(tmp_path):
+    """
+    Read a directory of multiscale zarr tile stores lazily.
+    """
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=2, tile_size=40, tiles_x=2, tiles_y=1, tiles_z=1)
+
+    for isim, sim in enumerate(sims):
+        msi_utils.multiscale_spatial_image_to_zarr(
+            msi_utils.get_msim_from_sim(sim, scale_factors=[2]),
+            str(tmp_path / ('tile_%03d.zarr' % isim)))
+
+    reader = napari_get_reader(str(tmp_path))
+    assert reader is _reader.read_zarr_tiles
+    assert napari_get_reader(str(tmp_path / 'tile_000.zarr')) \
+        is _reader.read_zarr_tiles
+
+    layer_data_list = reader(str(tmp_path))
+
+    assert len(layer_data_list) == len(sims) * 2
+    for ld in layer_data_list:
+        # all resolution levels are passed on
+        assert len(ld[0]) == 2
+        # pixel data is not loaded
+        assert all(isinstance(d.data, da.Array) for d in ld[0])
+
+    # tile positions are taken from the metadata
+    assert not np.allclose(
+        layer_data_list[0][1]['translate'], layer_data_list[2][1]['translate'])
+
+
+def test_read_ome_zarr(tmp_path):
+    """
+    Read back an OME-Zarr store written by the napari-stitcher writer.
+    """
+
+    from napari_stitcher import _writer, viewer_utils
+    from multiview_stitcher.io import METADATA_TRANSFORM_KEY
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=2, tile_size=600, tiles_x=1, tiles_y=1, tiles_z=1)
+
+    layer_data_list = viewer_utils.create_image_layer_tuples_from_msims(
+        [msi_utils.get_msim_from_sim(sims[0], scale_factors=[])],
+        transform_key=METADATA_TRANSFORM_KEY)
+
+    path = str(tmp_path / 'fused.zarr')
+    _writer.write_ome_zarr(
+        path, [(ld[0], ld[1], 'image') for ld in layer_data_list],
+        chunksizes={'y': 128, 'x': 128})
+
+    reader = napari_get_reader(path)
+    assert reader is _reader.read_zarr_tiles
+
+    read_layer_data_list = reader(path)
+    assert len(read_layer_data_list) == 2
+
+    for ld, read_ld in zip(layer_data_list, read_layer_data_list):
+        # all resolution levels are passed on
+        assert len(read_ld[0]) > 1
+        assert all(isinstance(d.data, da.Array) for d in read_ld[0])
+        assert np.array_equal(
+            np.asarray(read_ld[0][0]).squeeze(), np.asarray(ld[0][0]).squeeze())
+        assert np.allclose(read_ld[1]['scale'], ld[1]['scale'])
+        assert np.allclose(read_ld[1]['translate'], ld[1]['translate'])
+
+
+def test_read_tif_tiles(tmp_path):
+    """
+    Read one tif file per tile and channel, deriving grid positions
+    and channels from the filenames.
+    """
+
+    spacing = 0.5
+    for row in range(2):
+        for col in range(3):
+            for ch in ['GFP', 'RFP']:
+                tifffile.imwrite(
+                    tmp_path / ('img_r%s_c%s_ch%s.tif' % (row, col, ch)),
+                    np.random.randint(0, 100, (20, 30), dtype=np.uint16),
+                    resolution=(1 / spacing, 1 / spacing))
+
+    assert napari_get_reader(str(tmp_path)) is _reader.read_tif_tiles
+
+    # lists of tile files are read together, while single tif files
+    # (also tiles) are left to other readers
+    tile_paths = sorted(str(p) for p in tmp_path.glob('img_*.tif'))
+    assert napari_get_reader(tile_paths) is _reader.read_tif_tiles
+    assert napari_get_reader(tile_paths[:1]) is None
+    assert napari_get_reader(tile_paths[0]) is None
+
+    tifffile.imwrite(tmp_path / 'tile_003.tif', np.zeros((20, 30), np.uint8))
+    assert napari_get_reader(str(tmp_path / 'tile_003.tif')) is None
+    os.remove(tmp_path / 'tile_003.tif')
+
+    tifffile.imwrite(tmp_path / 'image.tif', np.zeros((20, 30), np.uint8))
+    assert napari_get_reader(str(tmp_path / 'image.tif')) is None
+    os.remove(tmp_path / 'image.tif')
+
+    layer_data_list = _reader.read_tif_tiles(
+        str(tmp_path / 'img_*.tif'),
+        filename_pattern=r'img_r(?P<row>\d+)_c(?P<col>\d+)'
+                         r'_ch(?P<channel>\w+)\.tif',
+        overlap=0.1,
+    )
+
+    assert len(layer_data_list) == 2 * 3 * 2
+    assert [ld[1]['name'] for ld in layer_data_list[:2]] == \
+        ['tile_000 :: GFP', 'tile_000 :: RFP']
+
+    # data is read lazily
+    assert isinstance(layer_data_list[0][0][0].data, da.Array)
+
+    # last tile is at row 1, col 2
+    assert np.allclose(layer_data_list[-1][1]['scale'], [spacing] * 2)
+    assert np.allclose(
+        layer_data_list[-1][1]['translate'],
+        [1 * 0.9 * 20 * spacing, 2 * 0.9 * 30 * spacing])
+
+    # big-endian files are converted to native byte order
+    big_endian = np.arange(2 * 20 * 30, dtype='>u2').reshape((2, 20, 30))
+    tifffile.imwrite(tmp_path / 'big_endian_001.tif', big_endian,
+                     byteorder='>', metadata={'axes': 'ZYX'})
+    layer_data_list = _reader.read_tif_tiles(
+        [str(tmp_path / 'big_endian_001.tif')])
+    assert np.array_equal(
+        np.asarray(layer_data_list[0][0][0].data).squeeze(), big_endian)
+
+    # compressed files are read without memory mapping
+    tifffile.imwrite(tmp_path / 'compressed_001.tif',
+                     np.ones((20, 30), dtype=np.uint8), compression='zlib')
+    layer_data_list = _reader.read_tif_tiles(
+        [str(tmp_path / 'compressed_001.tif')])
+    assert np.all(np.asarray(layer_data_list[0][0][0].data) == 1)
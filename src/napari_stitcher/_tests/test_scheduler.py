@@ -0,0 +1,97 @@
+import importlib
+import threading
+
+import numpy as np
+import dask
+import dask.array as da
+
+from multiview_stitcher import fusion, msi_utils, registration
+from multiview_stitcher.sample_data import generate_tiled_dataset
+
+from napari_stitcher import _checkpoint, _scheduler, _utils
+
+import pytest
+
+
+def test_get_default_scheduler_settings(monkeypatch):
+
+    assert _scheduler.get_default_scheduler_settings() == {
+        'scheduler': 'threads', 'n_workers': None, 'memory_limit': None}
+
+    monkeypatch.setenv('NAPARI_STITCHER_SCHEDULER', 'processes')
+    monkeypatch.setenv('NAPARI_STITCHER_N_WORKERS', '2')
+
+    with _scheduler.scheduler_context():
+        assert dask.config.get('scheduler') == 'processes'
+        assert dask.config.get('num_workers') == 2
+
+    with pytest.raises(ValueError):
+        with _scheduler.scheduler_context('gpu'):
+            pass
+
+
+@pytest.mark.parametrize('scheduler', _scheduler.SCHEDULERS)
+def test_scheduler_context(tmp_path, scheduler):
+
+    if scheduler == _scheduler.SCHEDULER_DISTRIBUTED and \
+            importlib.util.find_spec('distributed') is None:
+        with pytest.raises(ImportError):
+            with _scheduler.scheduler_context(scheduler):
+                pass
+        return
+
+    sims = generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=1, tile_size=100, overlap=20, tiles_x=2, tiles_y=1)
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims]
+
+    expected_params = registration.register(
+        msims, reg_channel_index=0, transform_key='affine_metadata')
+    expected_fused = fusion.fuse(
+        sims, transform_key='affine_metadata').data.compute()
+
+    with _scheduler.scheduler_context(scheduler, n_workers=2):
+
+        params = registration.register(
+            msims, reg_channel_index=0, transform_key='affine_metadata')
+
+        mfused = _checkpoint.write_msim_to_zarr(
+            msi_utils.get_msim_from_sim(
+                fusion.fuse(sims, transform_key='affine_metadata'),
+                scale_factors=[]),
+            tmp_path / 'fused.zarr')
+
+    for p, expected_p in zip(params, expected_params):
+        assert np.allclose(p.data, expected_p.data)
+
+    assert np.array_equal(
+        mfused['scale0/image'].data.compute(), expected_fused)
+
+    _scheduler.close_local_clusters()
+
+
+def test_cancellation_callback():
+
+    cancel_event = threading.Event()
+    computed_blocks = []
+
+    def f(x, block_info=None):
+        computed_blocks.append(block_info[0]['chunk-location'])
+        # cancel while computing the first block
+        cancel_event.set()
+        return x
+
+    data = da.ones((10,), chunks=1).map_blocks(f, dtype=float)
+
+    with _utils.CancellationCallback(cancel_event):
+
+        with pytest.raises(_utils.CancelledError):
+            data.compute(scheduler='single-threaded')
+        assert len(computed_blocks) == 1
+
+        # computations started from other threads are not affected
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(data.compute(scheduler='threads')))
+        thread.start()
+        thread.join()
+        assert np.array_equal(results[0], np.ones(10))
@@ -246,6 +246,38 @@ def test_vanilla_layers_2D_no_time(make_napari_viewer):
     wdg.run_fusion()
 
 
+def test_background_registration_and_fusion(make_napari_viewer, qtbot):
+
+    viewer = make_napari_viewer()
+    wdg = StitcherQWidget(viewer)
+    viewer.window.add_dock_widget(wdg)
+
+    sims = generate_tiled_dataset(ndim=2, N_t=1, N_c=1,
+            tile_size=30, tiles_x=2, tiles_y=1, tiles_z=1, overlap=5, zoom=10)
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[]) for sim in sims]
+    for lt in viewer_utils.create_image_layer_tuples_from_msims(
+            msims, transform_key=METADATA_TRANSFORM_KEY):
+        viewer.add_image(lt[0], **lt[1])
+
+    wdg.button_load_layers_all.clicked()
+
+    # widgets are disabled while the workers run
+    wdg.run_registration(background=True)
+    assert not wdg.button_fuse.enabled
+    assert wdg.button_cancel.enabled
+    qtbot.waitUntil(lambda: wdg.worker is None, timeout=60000)
+
+    # results are applied when done
+    assert wdg.visualization_type_rbuttons.value == _stitcher_widget.CHOICE_REGISTERED
+    assert wdg.button_fuse.enabled
+    assert not wdg.button_cancel.enabled
+
+    n_layers = len(viewer.layers)
+    wdg.run_fusion(background=True)
+    qtbot.waitUntil(lambda: wdg.worker is None, timeout=60000)
+    assert len(viewer.layers) == n_layers + 1
+
+
 def test_load_layers_filters_non_image_layers(make_napari_viewer):
     viewer = make_napari_viewer()
 
@@ -434,3 +466,39 @@ def test_manual_transform_show_original_no_msim_update(make_napari_viewer):
     assert np.allclose(
         np.array(updated_metadata), np.array(original_metadata)
     ), "affine_metadata should NOT be updated live when showing Original"
+
+
+def test_multi_channel_layers(make_napari_viewer):
+    """
+    Multi-channel layers are loaded without splitting them
+    and their channels are registered and fused separately.
+    """
+
+    import xarray as xr
+
+    viewer = make_napari_viewer()
+
+    D = 100
+    im = np.random.random((2, D, D))
+
+    for name, sl, translate in [
+            ('im1', slice(0, D//2+D//10), (0, 0)),
+            ('im2', slice(D//2-D//10, D), (0, D//2-D//10-5))]:
+        viewer.add_image(
+            xr.DataArray(im[:, :, sl], dims=['c', 'y', 'x'],
+                         coords={'c': ['ch0', 'ch1']}),
+            translate=translate, name=name)
+
+    wdg = StitcherQWidget(viewer)
+    viewer.window.add_dock_widget(wdg)
+
+    wdg.button_load_layers_all.clicked()
+
+    assert len(wdg.msims) == 2
+    assert list(wdg.reg_ch_picker.choices) == ['ch0', 'ch1']
+
+    wdg.reg_ch_picker.value = 'ch1'
+    wdg.run_registration()
+    wdg.run_fusion()
+
+    assert len(wdg.fused_layers) == 2
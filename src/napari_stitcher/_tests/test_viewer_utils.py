@@ -4,7 +4,7 @@ import xarray as xr
 
 from multiview_stitcher.io import METADATA_TRANSFORM_KEY
 from multiview_stitcher import (
-    msi_utils, sample_data, registration, fusion
+    msi_utils, sample_data, registration, fusion, spatial_image_utils
     )
 import pytest
 
@@ -67,3 +67,218 @@ def test_create_image_layer_tuples_from_msims(ndim, N_c, N_t, make_napari_viewer
         current_step = list(viewer.dims.current_step)
         current_step[0] = current_step[0] + 1
         viewer.dims.current_step = tuple(current_step)
+
+
+def test_get_msim_pyramid(tmp_path):
+    """
+    Pyramid levels are chosen from the tile size and
+    can be persisted into a zarr store.
+    """
+
+    scale_factors = viewer_utils.get_pyramid_scale_factors(
+        {'y': 600, 'x': 300})
+    assert len(scale_factors) == 2
+
+    scale_factors = viewer_utils.get_pyramid_scale_factors(
+        {'z': 20, 'y': 600, 'x': 300})
+    assert len(scale_factors) == 2
+    assert all(sf['z'] == 1 for sf in scale_factors)
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=1, tile_size=300,
+        tiles_x=1, tiles_y=1, tiles_z=1, zoom=1)
+
+    msim = viewer_utils.get_msim_pyramid(sims[0])
+    scale_keys = msi_utils.get_sorted_scale_keys(msim)
+    assert len(scale_keys) == 2
+    assert isinstance(msim['scale1/image'].data, da.Array)
+
+    store_path = str(tmp_path / 'pyramid.zarr')
+    msim_stored = viewer_utils.get_msim_pyramid(
+        sims[0], store_path=store_path)
+    assert msi_utils.get_sorted_scale_keys(msim_stored) == scale_keys
+    assert np.array_equal(
+        msim['scale1/image'].data.compute(),
+        msim_stored['scale1/image'].data.compute())
+
+    # existing stores are reused
+    msim_stored = viewer_utils.get_msim_pyramid(
+        sims[0] * 0, store_path=store_path)
+    assert np.array_equal(
+        msim['scale1/image'].data.compute(),
+        msim_stored['scale1/image'].data.compute())
+
+
+def test_image_layer_to_msim_multiscale_spacing():
+    """
+    Lower resolution levels of multiscale layers keep their spacing.
+    """
+
+    from napari.layers import Image
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=1, N_c=1, tile_size=300,
+        tiles_x=1, tiles_y=1, tiles_z=1, zoom=1)
+
+    msim = viewer_utils.get_msim_pyramid(sims[0])
+    ld = viewer_utils.create_image_layer_tuples_from_msims(
+        [msim], transform_key=METADATA_TRANSFORM_KEY)[0]
+
+    msim_layer = viewer_utils.image_layer_to_msim(Image(ld[0], **ld[1]), None)
+
+    for scale_key in msi_utils.get_sorted_scale_keys(msim):
+        assert spatial_image_utils.get_spacing_from_sim(
+            msi_utils.get_sim_from_msim(msim_layer, scale_key)) == \
+            spatial_image_utils.get_spacing_from_sim(
+                msi_utils.get_sim_from_msim(msim, scale_key))
+
+
+def test_estimate_contrast_limits():
+    """
+    Contrast limits of all tiles and channels are estimated
+    in a single dask computation.
+    """
+
+    from dask.callbacks import Callback
+
+    sims = sample_data.generate_tiled_dataset(
+        ndim=2, N_t=2, N_c=2, tile_size=40, tiles_x=3, tiles_y=1, tiles_z=1)
+    msims = [msi_utils.get_msim_from_sim(sim, scale_factors=[])
+             for sim in sims]
+
+    n_computations = []
+    with Callback(start=lambda dsk: n_computations.append(1)):
+        contrast_limits = viewer_utils.estimate_contrast_limits(
+            msims, percentiles=(0, 100))
+    assert len(n_computations) == 1
+
+    for ch in sims[0].coords['c'].values:
+        data = np.concatenate([
+            np.asarray(sim.sel(c=ch).isel(t=0).data).ravel()
+            for sim in sims])
+        assert contrast_limits[str(ch)] == [data.min(), data.max()]
+
+    # percentiles narrow the limits
+    narrow_contrast_limits = viewer_utils.estimate_contrast_limits(
+        msims, percentiles=(10, 90))
+    for ch, limits in narrow_contrast_limits.items():
+        assert limits[0] >= contrast_limits[ch][0]
+        assert limits[1] <= contrast_limits[ch][1]
+
+    # limits are shared across tiles
+    lds = viewer_utils.create_image_layer_tuples_from_msims(msims)
+    assert lds[0][1]['contrast_limits'] == lds[2][1]['contrast_limits']
+
+
+@pytest.mark.parametrize('use_memmap', [False, True])
+def test_image_layer_to_msim_zero_copy(use_memmap, tmp_path):
+    """
+    In-memory layer data is referenced rather than copied.
+    """
+
+    from napari.layers import Image
+
+    if use_memmap:
+        data = np.memmap(tmp_path / 'data.dat', dtype=np.uint16,
+                         mode='w+', shape=(2, 300, 200))
+    else:
+        data = np.zeros((2, 300, 200), dtype=np.uint16)
+    data[:] = np.arange(200, dtype=np.uint16)
+
+    l = Image(data)
+    msim = viewer_utils.image_layer_to_msim(l, None)
+
+    assert viewer_utils.get_duplicated_nbytes(l, msim) == 0
+
+    sim = msi_utils.get_sim_from_msim(msim)
+    assert np.array_equal(sim.data.compute().squeeze(), data)
+
+
+@pytest.mark.parametrize('use_dask', [False, True])
+def test_image_layer_to_msim_multiscale_arrays(use_dask):
+    """
+    Multiscale layers containing plain arrays are converted
+    with level spacings inferred from the level shapes.
+    """
+
+    from napari.layers import Image
+
+    data = [np.zeros((400 // f, 300 // f), dtype=np.uint16)
+            for f in [1, 2, 4]]
+    if use_dask:
+        data = [da.from_array(d) for d in data]
+
+    l = Image(data, multiscale=True, scale=(0.5, 0.5), translate=(10, 20),
+              name='tile_0 :: ch0')
+    msim = viewer_utils.image_layer_to_msim(l, None)
+
+    scale_keys = msi_utils.get_sorted_scale_keys(msim)
+    assert len(scale_keys) == 3
+
+    for f, scale_key in zip([1, 2, 4], scale_keys):
+        sim = msi_utils.get_sim_from_msim(msim, scale_key)
+        assert spatial_image_utils.get_spacing_from_sim(sim) == \
+            {'y': 0.5 * f, 'x': 0.5 * f}
+        assert spatial_image_utils.get_origin_from_sim(sim) == \
+            {'y': 10 + (f - 1) * 0.25, 'x': 20 + (f - 1) * 0.25}
+        assert sim.coords['c'].values == 'ch0'
+
+
+def test_image_layer_to_msim_multi_channel():
+    """
+    Multi-channel layers are converted into a single msim
+    keeping their channel names.
+    """
+
+    from napari.layers import Image
+
+    data = xr.DataArray(
+        np.random.random((2, 50, 40)), dims=['c', 'y', 'x'],
+        coords={'c': ['GFP', 'RFP']})
+
+    msim = viewer_utils.image_layer_to_msim(Image(data, name='tile_0'), None)
+
+    sim = msi_utils.get_sim_from_msim(msim)
+    assert list(sim.coords['c'].values) == ['GFP', 'RFP']
+
+    sim_ch = msi_utils.get_sim_from_msim(msi_utils.multiscale_sel_coords(
+        msim, {'c': 'RFP'}))
+    assert np.allclose(sim_ch.data.compute().squeeze(), data.sel(c='RFP'))
+
+
+def test_get_layer_identity():
+
+    from napari.layers import Image
+
+    data = np.random.randint(0, 100, (10, 10))
+
+    assert viewer_utils.get_layer_identity(Image(data)) ==\
+        viewer_utils.get_layer_identity(Image(data.copy()))
+
+    assert viewer_utils.get_layer_identity(Image(data)) !=\
+        viewer_utils.get_layer_identity(Image(data + 1))
+
+
+def test_get_layer_identity_memoized(monkeypatch):
+
+    from napari.layers import Image
+
+    data = np.random.randint(0, 100, (10, 10))
+    layer = Image(data)
+
+    ntokenize = [0]
+    tokenize = viewer_utils.tokenize
+
+    def counting_tokenize(*args, **kwargs):
+        ntokenize[0] += 1
+        return tokenize(*args, **kwargs)
+
+    monkeypatch.setattr(viewer_utils, 'tokenize', counting_tokenize)
+
+    identity = viewer_utils.get_layer_identity(layer)
+    assert viewer_utils.get_layer_identity(layer) == identity
+    assert ntokenize[0] == 1
+
+    layer.data = data + 1
+    assert viewer_utils.get_layer_identity(layer) != identity
+    assert ntokenize[0] == 2
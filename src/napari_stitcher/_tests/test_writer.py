@@ -1,5 +1,6 @@
 import sys
 import numpy as np
+import dask.array as da
 
 import tempfile
 from pathlib import Path
@@ -93,3 +94,208 @@ def test_writer_napari(field_ndim, N_t, N_c, make_napari_viewer):
         assert resolution_value_checked
         assert bitspersample_checked
 
+
+@pytest.mark.parametrize("field_ndim", [2, 3])
+def test_write_ome_zarr(field_ndim, tmp_path):
+
+    import numcodecs
+    import zarr
+    from multiview_stitcher import ngff_utils, spatial_image_utils
+
+    from napari_stitcher import _writer
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=field_ndim, N_t=2, N_c=2, tile_size=240,
+        tiles_x=1, tiles_y=1, tiles_z=1,
+    )
+
+    full_layer_data_list = viewer_utils.create_image_layer_tuples_from_msims(
+        [msi_utils.get_msim_from_sim(sims[0], scale_factors=[])],
+        transform_key=METADATA_TRANSFORM_KEY,
+    )
+
+    chunksizes = {'z': 64, 'y': 64, 'x': 64}
+    compressor = numcodecs.Blosc(cname='zstd')
+
+    path = str(tmp_path / "test.zarr")
+    _writer.write_ome_zarr(
+        path,
+        [(l[0], l[1], 'image') for l in full_layer_data_list],
+        chunksizes=chunksizes,
+        compressor=compressor,
+    )
+
+    sim = ngff_utils.read_sim_from_ome_zarr(path, resolution_level=0)
+    assert list(sim.coords['c'].values) == ['channel 0', 'channel 1']
+    assert np.array_equal(
+        np.asarray(sim.data), np.asarray(sims[0].transpose(*sim.dims).data))
+
+    # pyramid has been written
+    sim1 = ngff_utils.read_sim_from_ome_zarr(path, resolution_level=1)
+    assert spatial_image_utils.get_spacing_from_sim(sim1)['x'] == \
+        2 * spatial_image_utils.get_spacing_from_sim(sim)['x']
+
+    arr = zarr.open_array(path + '/0', mode='r')
+    assert arr.chunks[-field_ndim:] == (64,) * field_ndim
+    assert arr.compressors[0] == compressor
+
+
+@pytest.mark.parametrize("max_memory", [2 ** 30, 10000])
+def test_write_tif_bounded_memory(max_memory, tmp_path):
+    """
+    Tiled BigTIFF output is identical when computing
+    whole slabs of planes or strips of single planes.
+    """
+
+    from napari_stitcher import _writer
+
+    sims = _sample_data.generate_tiled_dataset(
+        ndim=3, N_t=2, N_c=2, tile_size=100,
+        tiles_x=1, tiles_y=1, tiles_z=1,
+    )
+    # avoid regenerating the sample data for each strip
+    sims[0] = sims[0].copy(data=sims[0].data.persist())
+
+    full_layer_data_list = viewer_utils.create_image_layer_tuples_from_msims(
+        [msi_utils.get_msim_from_sim(sims[0], scale_factors=[])],
+        transform_key=METADATA_TRANSFORM_KEY,
+    )
+
+    path = str(tmp_path / "test.tif")
+    _writer.write_multiple(
+        path,
+        [(l[0], l[1], 'image') for l in full_layer_data_list],
+        max_memory=max_memory,
+        tile=(32, 32),
+    )
+
+    with tifffile.TiffFile(path) as tif:
+        assert tif.is_bigtiff
+        assert tif.series[0].axes == 'TZCYX'
+        assert tif.pages[0].tile == (32, 32)
+        read_im = tif.asarray()
+
+    assert np.array_equal(
+        read_im, np.asarray(sims[0].transpose('t', 'z', 'c', 'y', 'x').data))
+
+
+def test_iter_tif_tiles_computes_chunks_once(tmp_path):
+    """
+    Chunks spanning more planes than fit into max_memory
+    are computed only once.
+    """
+
+    from napari_stitcher import _writer
+
+    arr = np.arange(2 * 8 * 3 * 40 * 40, dtype=np.uint16).reshape(
+        (2, 8, 3, 40, 40))
+
+    computed_blocks = []
+
+    def compute_block(block, block_info=None):
+        computed_blocks.append(block_info[None]['chunk-location'])
+        return block
+
+    data = da.from_array(arr, chunks=(1, 4, 1, 40, 40)).map_blocks(
+        compute_block, dtype=arr.dtype, meta=np.empty((0,) * 5, arr.dtype))
+
+    tiles = list(_writer._iter_tif_tiles(
+        data, (20, 20), max_memory=2 * 40 * 40 * arr.itemsize,
+        spill_dir=tmp_path))
+
+    assert len(computed_blocks) == len(set(computed_blocks)) == 2 * 2 * 3
+
+    planes = np.reshape(tiles, (-1, 2, 2, 20, 20)).transpose(
+        0, 1, 3, 2, 4).reshape((2, 8, 3, 40, 40))
+    assert np.array_equal(planes, arr)
+
+    # temporary files are removed
+    assert not len(list(tmp_path.iterdir()))
+
+
+@pytest.mark.parametrize("extension", ['.tif', '.zarr'])
+def test_write_single_image(extension, tmp_path):
+    """
+    Single layers are written including their spatial metadata.
+    """
+
+    import json
+    import dask.array as da
+    from napari.layers import Image
+    from multiview_stitcher import spatial_image_utils
+
+    from napari_stitcher import _writer
+
+    data = da.from_array(
+        np.random.randint(0, 1000, (2, 20, 100, 80)).astype(np.uint16),
+        chunks=(1, 8, 32, 32))
+    affine = np.eye(4)
+    affine[1, 3] = 7
+
+    l = Image(data, scale=(2, 0.5, 0.5), translate=(1, 2, 3),
+              affine=affine, name='fused :: ch1')
+
+    path = str(tmp_path / ("test" + extension))
+    _writer.write_single_image(path, *l.as_layer_data_tuple()[:2])
+
+    if extension == '.tif':
+        with tifffile.TiffFile(path) as tif:
+            assert np.array_equal(tif.asarray(), data)
+            spatial_metadata = json.loads(
+                tif.pages[0].tags[_writer.TIF_SPATIAL_METADATA_TAG].value)
+        assert spatial_metadata['scale'] == [2, 0.5, 0.5]
+        assert spatial_metadata['translate'] == [1, 2, 3]
+        assert np.allclose(spatial_metadata['affine'], affine)
+    else:
+        # written as OME-Zarr and read back by the napari-stitcher reader
+        from napari_stitcher import _reader
+        sim = msi_utils.get_sim_from_msim(_reader._read_zarr_tile_msim(path))
+        assert np.array_equal(sim.data.squeeze(), data)
+        assert spatial_image_utils.get_spacing_from_sim(sim) == \
+            {'z': 2, 'y': 0.5, 'x': 0.5}
+        assert spatial_image_utils.get_origin_from_sim(sim) == \
+            {'z': 1, 'y': 2, 'x': 3}
+        assert np.allclose(spatial_image_utils.get_affine_from_sim(
+            sim, METADATA_TRANSFORM_KEY), affine)
+
+        # zarr stores are replaced, other paths are not
+        _writer.write_single_image(path, *l.as_layer_data_tuple()[:2])
+        with pytest.raises(ValueError):
+            _writer.write_single_image(
+                str(tmp_path), *l.as_layer_data_tuple()[:2])
+
+
+def test_write_non_aligned_layers(tmp_path):
+    """
+    Layers of different extent are resampled onto a common grid.
+    """
+
+    import dask.array as da
+    from multiview_stitcher import spatial_image_utils
+
+    from napari_stitcher import _writer
+
+    sim_a = spatial_image_utils.get_sim_from_array(
+        da.ones((2, 30, 20), dtype=np.uint16, chunks=(1, 16, 16)),
+        dims=['t', 'y', 'x'], c_coords=['a'],
+        scale={'y': 1, 'x': 1}, translation={'y': 0, 'x': 0})
+    sim_b = spatial_image_utils.get_sim_from_array(
+        da.full((2, 36, 20), 2, dtype=np.uint16, chunks=(1, 16, 16)),
+        dims=['t', 'y', 'x'], c_coords=['b'],
+        scale={'y': 1, 'x': 1}, translation={'y': -4, 'x': 2})
+
+    data = [([sim_a], {}, 'image'), ([sim_b], {}, 'image')]
+
+    sim = _writer._get_sim_from_layer_data(data)
+    assert spatial_image_utils.get_shape_from_sim(sim) == {'y': 36, 'x': 22}
+    assert spatial_image_utils.get_origin_from_sim(sim) == {'y': -4, 'x': 0}
+
+    path = str(tmp_path / "test.tif")
+    _writer.write_multiple(path, data)
+
+    read_im = tifffile.imread(path)
+    assert read_im.shape == (2, 2, 36, 22)
+    assert np.all(read_im[:, 0, 4:34, :20] == 1)
+    assert np.all(read_im[:, 0, :4] == 0)
+    assert np.all(read_im[:, 1, :, 2:] == 2)
+    assert np.all(read_im[:, 1, :, :2] == 0)
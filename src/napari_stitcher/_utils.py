@@ -1,7 +1,12 @@
+import os
+import threading
+from pathlib import Path
+
 import numpy as np
 import xarray as xr
 
 from dask import delayed, compute
+from dask.callbacks import Callback
 import dask.array as da
 from tqdm.dask import TqdmCallback
 
@@ -35,6 +40,66 @@ class VisibleActivityDock(object):
         self.viewer.window._status_bar._toggle_activity_dock(False)
 
 
+class CancelledError(Exception):
+    """
+    Raised within computations cancelled by the user.
+    """
+
+
+class CancellationCallback(Callback):
+    """
+    Dask callback aborting the (local scheduler) computations started from
+    the thread it was entered in once cancel_event is set. Tasks which are
+    already running complete, but no further tasks are started.
+    """
+
+    def __init__(self, cancel_event):
+        super().__init__()
+        self.cancel_event = cancel_event
+        self.thread_id = None
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        return super().__enter__()
+
+    def _pretask(self, key, dsk, state):
+        if self.cancel_event.is_set() and threading.get_ident() == self.thread_id:
+            raise CancelledError('Computation cancelled.')
+
+
+def get_cache_dir(subdir=None):
+    """
+    Return (and create) the directory napari-stitcher uses for on-disk caches.
+
+    The location can be set using the NAPARI_STITCHER_CACHE_DIR environment
+    variable and defaults to ~/.cache/napari-stitcher.
+    """
+    cache_dir = os.environ.get('NAPARI_STITCHER_CACHE_DIR')
+    if cache_dir is None:
+        cache_dir = Path(os.environ.get(
+            'XDG_CACHE_HOME', Path.home() / '.cache')) / 'napari-stitcher'
+
+    cache_dir = Path(cache_dir)
+    if subdir is not None:
+        cache_dir = cache_dir / subdir
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    return cache_dir
+
+
+def get_file_signature(path):
+    """
+    Identify a file by its resolved path, size and modification time.
+    """
+    stat = os.stat(path)
+    return {
+        'path': str(Path(path).resolve()),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
 def get_str_unique_to_view_from_layer_name(layer_name):
     return layer_name.split(' :: ')[0]
 
@@ -47,6 +112,74 @@ def get_str_unique_to_ch_from_sim_coords(layer_coords):
     return str(layer_coords['c'].values)
 
 
+def get_ch_coords_from_sim_coords(layer_coords):
+    """
+    Channel names of a single or multi-channel sim.
+    """
+    return [str(ch) for ch in np.atleast_1d(layer_coords['c'].values)]
+
+
+def get_ch_sel_dict(sim, ch):
+    """
+    Coordinates selecting a channel from a multi-channel sim.
+    Single channel sims need no selection.
+    """
+    return {'c': ch} if 'c' in sim.dims else {}
+
+
+def combine_channels_per_view(sims, channels):
+    """
+    Combine the channel layers of each view into one multi-channel sim.
+
+    Fusing multi-channel sims shares the computation of transformed
+    coordinates and blending weights between channels.
+
+    Parameters
+    ----------
+    sims : dict
+        Single or multi-channel sims keyed by layer name.
+    channels : list of str
+        Channels to combine, in this order.
+
+    Returns
+    -------
+    list of SpatialImage or None
+        One sim per view containing all channels. None if the views
+        don't contain all channels or the channels of a view differ
+        in shape, spacing, origin or dtype.
+    """
+
+    view_sims = {}
+    for lname, sim in sims.items():
+        if 'c' not in sim.dims:
+            sim = sim.expand_dims(
+                c=[sim.coords['c'].values],
+                axis=sim.dims.index('t') + 1 if 't' in sim.dims else 0)
+        view_sims.setdefault(
+            get_str_unique_to_view_from_layer_name(lname), []).append(sim)
+
+    combined_sims = []
+    for vsims in view_sims.values():
+
+        ch_coords = sum([get_ch_coords_from_sim_coords(sim.coords)
+                         for sim in vsims], [])
+        if sorted(ch_coords) != sorted(channels):
+            return None
+
+        if any(sim.dtype != vsims[0].dtype or
+               any(not sim.coords[dim].equals(vsims[0].coords[dim])
+                   for dim in vsims[0].dims if dim != 'c')
+               for sim in vsims[1:]):
+            return None
+
+        combined_sim = xr.concat(vsims, dim='c', combine_attrs='override')
+        combined_sim = combined_sim.assign_coords(
+            c=[str(ch) for ch in combined_sim.coords['c'].values])
+        combined_sims.append(combined_sim.sel(c=list(channels)))
+
+    return combined_sims
+
+
 def get_view_from_layer(layer):
     return layer.metadata['view']
 
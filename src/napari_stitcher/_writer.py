@@ -8,39 +8,86 @@ Replace code below according to your needs.
 """
 from __future__ import annotations
 
+import json
+import os
+import tempfile
+
 import numpy as np
 import xarray as xr
+import tifffile
+import zarr
+import dask.array as da
+from dask import compute
 
 import warnings
 from typing import TYPE_CHECKING, Any, List, Sequence, Tuple, Union
 
-from multiview_stitcher import spatial_image_utils, io
+from multiview_stitcher import (
+    spatial_image_utils, ngff_utils, param_utils,
+    fusion, transformation)
+from multiview_stitcher.io import METADATA_TRANSFORM_KEY
+
+from napari_stitcher import _utils
 
 if TYPE_CHECKING:
     DataType = Union[Any, Sequence[Any]]
     FullLayerData = Tuple[DataType, dict, str]
 
 
-def write_single_image(path: str, data: Any, meta: dict) -> List[str]:
-    """Writes a single image layer"""
+# maximum number of bytes of image data computed at once when writing tifs
+DEFAULT_TIF_MAX_MEMORY = 2 ** 30
 
-    # implement your writer logic here ...
+DEFAULT_TIF_TILE = (256, 256)
 
-    # return path to any file(s) that were successfully written
-    return [path]
+# private tif tag containing the scale, translate and affine of single layers
+TIF_SPATIAL_METADATA_TAG = 65000
 
+# OME-Zarr group attribute containing the affine of single layers,
+# which cannot be represented by NGFF coordinate transformations
+ZARR_SPATIAL_METADATA_ATTR = 'napari_stitcher'
 
-def write_multiple(path: str, data: List[FullLayerData]) -> List[str]:
+# files identifying a directory as zarr (v2 or v3) store
+ZARR_STORE_FILENAMES = ('.zgroup', '.zarray', '.zattrs', 'zarr.json')
+
+
+def _resample_sim(sim, stack_properties, output_chunksize=None):
     """
-    Writes zarr backed dask arrays containing fused images.
-    Ignores transform_keys.
-    FullLayerData: 3-tuple with (data, meta, layer_type)
+    Lazily resample a sim onto the grid given by stack_properties,
+    one field (timepoint and channel) at a time.
     """
 
-    # implement your writer logic here ...
+    sdims = spatial_image_utils.get_spatial_dims_from_sim(sim)
+    nsdims = [dim for dim in sim.dims if dim not in sdims]
 
-    if not path.endswith('.tif'):
-        raise ValueError('Only .tif file saving is supported.')
+    if output_chunksize is None:
+        output_chunksize = spatial_image_utils.get_default_spatial_chunksizes(
+            len(sdims))
+
+    fields = np.empty([sim.sizes[dim] for dim in nsdims], dtype=object)
+    for ns_index in np.ndindex(fields.shape):
+        field = sim.isel(dict(zip(nsdims, ns_index)), drop=True)
+        field = transformation.transform_sim(
+            field.copy(data=da.asarray(field.data)),
+            output_stack_properties=stack_properties,
+            output_chunks=tuple(
+                min(output_chunksize[dim], int(stack_properties['shape'][dim]))
+                for dim in sdims),
+        )
+        fields[ns_index] = field.expand_dims(
+            {dim: [sim.coords[dim].values[ind]]
+             for dim, ind in zip(nsdims, ns_index)})
+
+    return xr.combine_nested(fields.tolist(), concat_dim=nsdims)
+
+
+def _get_sim_from_layer_data(data: List[FullLayerData]):
+    """
+    Combine the (lazy) image data of layers into a single multi-channel sim.
+
+    Layers not occupying the same space are lazily resampled onto a
+    common grid containing all layers, using the finest spacing among
+    them. Resampling happens chunk by chunk when writing.
+    """
 
     sims = [d[0][0] for d in data]
 
@@ -48,18 +95,485 @@ def write_multiple(path: str, data: List[FullLayerData]) -> List[str]:
     origins = [spatial_image_utils.get_origin_from_sim(sim, asarray=True) for sim in sims]
     shapes = [spatial_image_utils.get_shape_from_sim(sim, asarray=True) for sim in sims]
 
-    for isim in range(len(data)):
-        if not np.allclose(spacings[isim], spacings[0]) or \
-           not np.allclose(origins[isim], origins[0]) or \
-           not np.allclose(shapes[isim], shapes[0]):
-            raise ValueError('Image saving: Data of all layers must occupy the same space.')
+    if not all(np.allclose(spacings[isim], spacings[0]) and
+               np.allclose(origins[isim], origins[0]) and
+               np.allclose(shapes[isim], shapes[0])
+               for isim in range(len(sims))):
+
+        sdims = spatial_image_utils.get_spatial_dims_from_sim(sims[0])
+        ndim = len(sdims)
+
+        stack_properties = fusion.calc_fusion_stack_properties(
+            sims,
+            [param_utils.identity_transform(ndim) for _ in sims],
+            spacing={dim: min(spacing[idim] for spacing in spacings)
+                     for idim, dim in enumerate(sdims)},
+            mode='union',
+        )
+
+        sims = [sim if np.allclose(
+                    spatial_image_utils.get_shape_from_sim(sim, asarray=True),
+                    [stack_properties['shape'][dim] for dim in sdims]) and
+                np.allclose(
+                    spatial_image_utils.get_spacing_from_sim(sim, asarray=True),
+                    [stack_properties['spacing'][dim] for dim in sdims]) and
+                np.allclose(
+                    spatial_image_utils.get_origin_from_sim(sim, asarray=True),
+                    [stack_properties['origin'][dim] for dim in sdims])
+                else _resample_sim(sim, stack_properties)
+                for sim in sims]
 
     # suppress pandas future warning occuring within xarray.concat
     with warnings.catch_warnings():
         warnings.simplefilter(action='ignore', category=FutureWarning)
-        sim_to_write = xr.concat([sim for sim in sims], dim='c')
+        sim = xr.concat([sim for sim in sims], dim='c')
+
+    return sim
+
+
+def _iter_plane_tiles(plane, tile):
+    """
+    Yield the tiles of a plane (or of a strip of a plane) in row-major order.
+    Tiles at the border are padded by tifffile.
+    """
+    for y in range(0, plane.shape[0], tile[0]):
+        for x in range(0, plane.shape[1], tile[1]):
+            yield plane[y: y + tile[0], x: x + tile[1]]
+
+
+def _iter_tif_tiles(data, tile, max_memory, pbar=None, spill_dir=None):
+    """
+    Yield the tiles of all planes of a dask array in the order expected
+    by tifffile, computing at most max_memory bytes at a time.
+
+    Planes are computed in slabs which are aligned with the chunks of
+    the array, such that chunks spanning several planes are computed
+    only once. Slabs consist of the chunks along one leading dimension
+    and all planes of the subsequent leading dimensions, choosing the
+    largest slabs fitting into max_memory. Planes not fitting into
+    max_memory are computed in strips of tile rows.
+
+    If the slabs fitting into max_memory would split chunks spanning
+    several planes (e.g. chunks of many z planes of multiple channels),
+    each of these chunks would be computed once per slab. Instead, the
+    planes of one chunk along the leading dimension are computed once
+    into a temporary file within spill_dir, from which they are then
+    read slab by slab. Memory usage is then bounded by the size of the
+    chunks computed in parallel rather than by max_memory.
+    """
+
+    lead_shape = data.shape[:-2]
+    lead_chunks = data.chunks[:-2]
+    plane_shape = data.shape[-2:]
+    plane_nbytes = int(np.prod(plane_shape)) * data.dtype.itemsize
+
+    # leading dimension along which to split into slabs
+    for slab_dim in range(len(lead_shape)):
+        slab_nbytes = max(lead_chunks[slab_dim]) \
+            * int(np.prod(lead_shape[slab_dim + 1:])) * plane_nbytes
+        if slab_nbytes <= max_memory:
+            break
+    else:
+        slab_dim = len(lead_shape)
+
+    row_nbytes = plane_shape[1] * data.dtype.itemsize
+    if slab_dim == len(lead_shape) and plane_nbytes > max_memory:
+        # prefer strips aligned with the chunks of the rows
+        row_chunk = data.chunks[-2][0]
+        n_rows = tile[0] * row_chunk // np.gcd(tile[0], row_chunk)
+        if n_rows * row_nbytes > max_memory:
+            n_rows = tile[0]
+        n_rows *= int(max(1, max_memory // (n_rows * row_nbytes)))
+    else:
+        n_rows = plane_shape[0]
+
+    # leading dimension whose chunks would be split into several slabs
+    spill_dim = next((dim for dim in range(min(slab_dim, len(lead_shape)))
+                      if max(lead_chunks[dim]) > 1), None)
+
+    if spill_dim is not None:
+        yield from _iter_spilled_tif_tiles(
+            data, spill_dim, tile, max_memory, pbar, spill_dir)
+        return
+
+    for outer_index in np.ndindex(lead_shape[:slab_dim]):
+
+        if slab_dim < len(lead_shape):
+            bounds = np.cumsum((0,) + lead_chunks[slab_dim])
+            slab_slices = [outer_index + (slice(start, stop),)
+                           for start, stop in zip(bounds[:-1], bounds[1:])]
+        else:
+            slab_slices = [outer_index]
+
+        for slab_slice in slab_slices:
+            if n_rows >= plane_shape[0]:
+                slab, = compute(data[slab_slice])
+                for plane in np.asarray(slab).reshape((-1,) + plane_shape):
+                    yield from _iter_plane_tiles(plane, tile)
+                    if pbar is not None:
+                        pbar.update(1)
+            else:
+                for y in range(0, plane_shape[0], n_rows):
+                    strip, = compute(data[slab_slice][y: y + n_rows])
+                    yield from _iter_plane_tiles(np.asarray(strip), tile)
+                if pbar is not None:
+                    pbar.update(1)
+
+
+def _iter_spilled_tif_tiles(data, spill_dim, tile, max_memory, pbar, spill_dir):
+    """
+    Compute the planes of each chunk along spill_dim once into a
+    temporary file and yield their tiles (see _iter_tif_tiles).
+    """
+
+    bounds = np.cumsum((0,) + data.chunks[spill_dim])
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmpdir:
+        for outer_index in np.ndindex(data.shape[:spill_dim]):
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                slab = data[outer_index + (slice(start, stop),)]
+                spilled = np.memmap(
+                    os.path.join(tmpdir, 'slab.dat'), dtype=slab.dtype,
+                    mode='w+', shape=slab.shape)
+                da.store(slab, spilled, lock=False)
+
+                yield from _iter_tif_tiles(
+                    da.from_array(
+                        spilled,
+                        chunks=(1,) * (slab.ndim - 2) + slab.shape[-2:],
+                        name=False),
+                    tile, max_memory, pbar)
+
+                del spilled
+
+
+def write_multiple(
+        path: str,
+        data: List[FullLayerData],
+        max_memory: int = DEFAULT_TIF_MAX_MEMORY,
+        tile: Tuple[int, int] = DEFAULT_TIF_TILE,
+        compression: str = 'zlib',
+        maxworkers: int = None,
+        ) -> List[str]:
+    """
+    Writes zarr backed dask arrays containing fused images
+    into a tiled (OME-)BigTIFF file, one channel per layer.
+    Ignores transform_keys.
+
+    The image data is computed plane by plane (or in strips of
+    large planes) and streamed into the file, such that at most
+    max_memory bytes of image data are held in memory at a time.
+    Chunks spanning more planes than fit into max_memory are computed
+    once into a temporary file next to the output file.
+
+    Parameters
+    ----------
+    path : str
+        Path of the output tif file.
+    data : list of FullLayerData
+        3-tuples with (data, meta, layer_type).
+    max_memory : int, optional
+        Maximum number of bytes of image data to compute at once.
+    tile : tuple of int, optional
+        Shape of the tif tiles (y, x).
+    compression : str, optional
+        Compression passed to tifffile, by default 'zlib'.
+        Tiles are compressed in parallel.
+    maxworkers : int, optional
+        Number of threads used for compression, by default
+        determined by tifffile.
+
+    Returns
+    -------
+    list of str
+        Path to the written file.
+    """
+
+    if not path.endswith('.tif'):
+        raise ValueError('Only .tif file saving is supported.')
+
+    sim = _get_sim_from_layer_data(data)
+
+    _write_sim_as_tif(
+        path, sim, max_memory=max_memory, tile=tile,
+        compression=compression, maxworkers=maxworkers)
+
+    # return path to any file(s) that were successfully written
+    return [path]
+
 
-    io.save_sim_as_tif(path, sim_to_write)
+def _write_sim_as_tif(
+        path, sim, max_memory=DEFAULT_TIF_MAX_MEMORY, tile=DEFAULT_TIF_TILE,
+        compression='zlib', maxworkers=None, extratags=()):
+    """
+    Stream a (lazy) sim into a tiled OME-BigTIFF file.
+    """
+
+    spatial_dims = spatial_image_utils.get_spatial_dims_from_sim(sim)
+    spacing = spatial_image_utils.get_spacing_from_sim(sim)
+
+    channels = [str(ch) for ch in sim.coords['c'].values]
+
+    # order planes as T, Z, C
+    sim = sim.transpose(*tuple(
+        ['t'] + [dim for dim in ['z'] if dim in spatial_dims] + ['c', 'y', 'x']))
+    sim = sim.squeeze(drop=True)
+
+    metadata = {
+        'axes': ''.join(sim.dims).upper(),
+        'Channel': {'Name': channels},
+    }
+    for dim in spatial_dims:
+        metadata['PhysicalSize%s' % dim.upper()] = spacing[dim]
+        metadata['PhysicalSize%sUnit' % dim.upper()] = 'µm' # assume um
+
+    with _utils.progress(
+            total=int(np.prod(sim.shape[:-2])), desc='Saving tif') as pbar:
+        tifffile.imwrite(
+            path,
+            data=_iter_tif_tiles(
+                da.asarray(sim.data), tile, max_memory, pbar,
+                spill_dir=os.path.dirname(os.path.abspath(path))),
+            shape=sim.shape,
+            dtype=sim.dtype,
+            tile=tile,
+            bigtiff=True,
+            ome=True,
+            compression=compression,
+            maxworkers=maxworkers,
+            resolution=(1. / spacing['x'], 1. / spacing['y']),
+            metadata=metadata,
+            extratags=extratags,
+        )
+
+
+def _get_sim_from_single_layer_data(data: Any, meta: dict):
+    """
+    Create a (lazy) sim from the data and metadata of a single
+    image layer, keeping its scale, translate and affine.
+    """
+
+    ldata = data[0] if meta.get('multiscale') else data
+
+    if isinstance(ldata, xr.DataArray):
+        dims = list(ldata.dims)
+        c_coords = ldata.coords['c'].values if 'c' in ldata.coords else None
+        ldata = ldata.data
+    else:
+        dims = ['t', 'z', 'y', 'x'][-ldata.ndim:]
+        c_coords = None
+
+    if c_coords is None:
+        c_coords = [meta.get('name', 'default_channel').split(' :: ')[-1]]
+
+    sdims = [dim for dim in dims if dim in spatial_image_utils.SPATIAL_DIMS]
+    ndim = len(sdims)
+
+    scale = np.asarray(meta.get('scale', np.ones(ndim)))[-ndim:]
+    translate = np.asarray(meta.get('translate', np.zeros(ndim)))[-ndim:]
+    affine = np.asarray(meta.get('affine', np.eye(ndim + 1)))
+    affine = affine[-(ndim + 1):, -(ndim + 1):]
+
+    sim = spatial_image_utils.get_sim_from_array(
+        da.asarray(ldata),
+        dims=dims,
+        scale=dict(zip(sdims, scale)),
+        translation=dict(zip(sdims, translate)),
+        affine=param_utils.affine_to_xaffine(affine),
+        transform_key=METADATA_TRANSFORM_KEY,
+        c_coords=np.atleast_1d(c_coords),
+    )
+
+    return sim
+
+
+def write_single_image(
+        path: str,
+        data: Any,
+        meta: dict,
+        tile: Tuple[int, int] = DEFAULT_TIF_TILE,
+        compression: str = 'zlib',
+        ) -> List[str]:
+    """
+    Writes a single (e.g. fused) image layer into a tif file
+    or a zarr store.
+
+    The (lazy) layer data is streamed into the output chunk by chunk,
+    such that memory usage stays around the size of one chunk
+    (or one row of chunks for tif files).
+
+    Tif files are written as tiled OME-BigTIFF, containing the
+    layer's scale as physical pixel sizes. The layer's scale,
+    translate and affine are additionally stored as json in the
+    private tif tag TIF_SPATIAL_METADATA_TAG.
+
+    Zarr stores are written as multiscale OME-Zarr, like using
+    write_ome_zarr, keeping the layer's scale and translate as pixel
+    spacing and origin. The layer's affine is stored as group attribute
+    ZARR_SPATIAL_METADATA_ATTR, which the napari-stitcher reader sets
+    as METADATA_TRANSFORM_KEY transform.
+
+    Existing zarr stores at path are replaced, other existing files
+    or directories are not.
+
+    Parameters
+    ----------
+    path : str
+        Path ending with .tif, .tiff or .zarr.
+    data : array-like or list of array-like
+        Layer data. Of multiscale layers, only the highest
+        resolution is written.
+    meta : dict
+        Layer attributes.
+    tile : tuple of int, optional
+        Shape of the tif tiles (y, x).
+    compression : str, optional
+        Tif compression passed to tifffile, by default 'zlib'.
+
+    Returns
+    -------
+    list of str
+        Path to the written file.
+    """
+
+    sim = _get_sim_from_single_layer_data(data, meta)
+
+    if path.endswith('.zarr'):
+
+        with _utils.TqdmCallback(tqdm_class=_utils.progress,
+                                 desc='Saving zarr'):
+            _write_sim_as_ome_zarr(path, sim)
+
+        zarr.open_group(path, mode='a').attrs[ZARR_SPATIAL_METADATA_ATTR] = {
+            'affine': spatial_image_utils.get_affine_from_sim(
+                sim, METADATA_TRANSFORM_KEY).data.tolist()}
+
+    elif path.endswith(('.tif', '.tiff')):
+
+        sdims = spatial_image_utils.get_spatial_dims_from_sim(sim)
+        spatial_metadata = {
+            'scale': [spatial_image_utils.get_spacing_from_sim(sim)[dim]
+                      for dim in sdims],
+            'translate': [spatial_image_utils.get_origin_from_sim(sim)[dim]
+                          for dim in sdims],
+            'affine': spatial_image_utils.get_affine_from_sim(
+                sim, METADATA_TRANSFORM_KEY).data.tolist(),
+        }
+
+        # computing any part of a plane loads the intersecting chunks,
+        # so limit memory usage to around one row of chunks
+        max_memory = int(np.prod([max(c) for c in sim.data.chunks[:-1]])) \
+            * sim.shape[-1] * sim.dtype.itemsize
+
+        _write_sim_as_tif(
+            path, sim, max_memory=max_memory, tile=tile,
+            compression=compression,
+            extratags=[(TIF_SPATIAL_METADATA_TAG, 's', 0,
+                        json.dumps(spatial_metadata), True)],
+        )
+
+    else:
+        raise ValueError('Only .tif and .zarr file saving is supported.')
 
     # return path to any file(s) that were successfully written
     return [path]
+
+
+def write_ome_zarr(
+        path: str,
+        data: List[FullLayerData],
+        chunksizes: dict = None,
+        compressor: Any = None,
+        downscale_factors_per_spatial_dim: dict = None,
+        ngff_version: str = '0.4',
+        ) -> List[str]:
+    """
+    Writes (fused) image layers into a multiscale OME-Zarr store,
+    one channel per layer.
+
+    Data is streamed chunk by chunk into the store and each
+    resolution level is computed from the previously written one,
+    such that the full volume never needs to fit into memory.
+    Ignores transform_keys.
+
+    Parameters
+    ----------
+    path : str
+        Path of the output zarr store.
+    data : list of FullLayerData
+        3-tuples with (data, meta, layer_type).
+    chunksizes : dict, optional
+        Output chunk size per spatial dimension, by default
+        the default spatial chunk sizes of multiview-stitcher.
+    compressor : numcodecs codec, optional
+        Compressor of the zarr arrays, by default zarr's default.
+    downscale_factors_per_spatial_dim : dict, optional
+        Downscale factors between resolution levels, by default 2
+        for all spatial dimensions.
+    ngff_version : str, optional
+        '0.4' (zarr v2) or '0.5' (zarr v3), by default '0.4'.
+
+    Returns
+    -------
+    list of str
+        Path to the written store.
+    """
+
+    sim = _get_sim_from_layer_data(data)
+
+    _write_sim_as_ome_zarr(
+        path, sim, chunksizes=chunksizes, compressor=compressor,
+        downscale_factors_per_spatial_dim=downscale_factors_per_spatial_dim,
+        ngff_version=ngff_version)
+
+    return [path]
+
+
+def _check_zarr_overwrite(path):
+    """
+    Refuse to replace existing files or directories which are not zarr stores.
+    """
+    if not os.path.exists(path):
+        return
+    if not os.path.isdir(path) or not any(
+            os.path.exists(os.path.join(path, fn))
+            for fn in ZARR_STORE_FILENAMES):
+        raise ValueError(
+            '%s exists and is not a zarr store, not overwriting it.' % path)
+
+
+def _write_sim_as_ome_zarr(
+        path, sim, chunksizes=None, compressor=None,
+        downscale_factors_per_spatial_dim=None, ngff_version='0.4'):
+    """
+    Stream a (lazy) sim into a multiscale OME-Zarr store,
+    replacing an existing zarr store at path.
+    """
+
+    _check_zarr_overwrite(path)
+
+    sdims = spatial_image_utils.get_spatial_dims_from_sim(sim)
+
+    if chunksizes is None:
+        chunksizes = spatial_image_utils.get_default_spatial_chunksizes(
+            len(sdims))
+
+    # the output chunks are given by the chunks of the (lazy) input
+    sim = sim.chunk({dim: chunksizes[dim] if dim in sdims else 1
+                     for dim in sim.dims})
+
+    zarr_array_creation_kwargs = {}
+    if compressor is not None:
+        zarr_array_creation_kwargs['compressor'] = compressor
+
+    ngff_utils.write_sim_to_ome_zarr(
+        sim,
+        path,
+        downscale_factors_per_spatial_dim=downscale_factors_per_spatial_dim,
+        overwrite=True,
+        ngff_version=ngff_version,
+        zarr_array_creation_kwargs=zarr_array_creation_kwargs,
+        show_progressbar=False,
+        # write using dask, which streams chunks into the store
+        batch_options={'n_batch': None},
+    )
@@ -1,19 +1,26 @@
+import os
+import shutil
+import weakref
+
 import numpy as np
 import xarray as xr
 import dask.array as da
 from dask import compute
+from dask.base import tokenize
+from dask import get as dask_get
 from functools import partial
 import warnings
 
 from spatial_image import to_spatial_image
 import multiscale_spatial_image as msi
-from multiscale_spatial_image import to_multiscale
 
 from multiview_stitcher import mv_graph, spatial_image_utils, msi_utils, param_utils
 
 from napari.experimental import link_layers
 from napari.utils import notifications
 
+from napari_stitcher import _cache, _utils
+
 
 def get_layer_dims(l,viewer):
     """
@@ -35,14 +42,16 @@ def get_layer_dims(l,viewer):
     ldata = l.data
     
     if isinstance(ldata, xr.DataArray):
-        dims = ldata.dims
+        dims = list(ldata.dims)
 
     # infer dimensions for images loaded with napari-aicsimageio
     elif 'aicsimage' in l.metadata:
         xim = l.metadata['aicsimage']
         xim = xim.squeeze()
         dims = [dim.lower() for dim in xim.dims]
-        dims = [dim for dim in dims if dim not in ['c']] # remove channel dim
+        # remove channel dim unless the layer contains all channels
+        if len(dims) > len(ldata.shape):
+            dims = [dim for dim in dims if dim not in ['c']]
     
     else:
         ndim = len(ldata.shape)
@@ -64,6 +73,213 @@ def set_msims_affine_transforms_from_viewer(viewer, msims, transform_key):
             msim, affine, transform_key=transform_key)
 
 
+def get_spatial_block_chunks(dims):
+    """
+    Chunks consisting of spatial blocks for each timepoint (and channel),
+    matching the access pattern of registration and fusion.
+    """
+    sdims = [dim for dim in dims if dim in spatial_image_utils.SPATIAL_DIMS]
+    spatial_chunksizes = spatial_image_utils.get_default_spatial_chunksizes(
+        len(sdims))
+    return tuple(spatial_chunksizes[dim] if dim in sdims else 1
+                 for dim in dims)
+
+
+class _ArrayView(object):
+    """
+    Array-like referencing an in-memory array. Wrapping arrays in this
+    prevents dask from copying numpy (and memmap) chunks into the task graph.
+    """
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.ndim = array.ndim
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+
+def wrap_array_as_dask(data, dims):
+    """
+    Wrap an in-memory array (e.g. numpy or memmap) as a dask array
+    without copying it.
+
+    Parameters
+    ----------
+    data : array-like
+    dims : list of str
+        Dimension labels of data.
+
+    Returns
+    -------
+    dask.array.Array
+        Chunked in spatial blocks per timepoint, with chunks being
+        views into data.
+    """
+
+    return da.from_array(
+        _ArrayView(data),
+        chunks=get_spatial_block_chunks(dims),
+        # avoid hashing the full array contents for naming the dask array
+        # (memmaps are tokenized based on their file instead)
+        name='array-view-%s' % tokenize(data)
+        if isinstance(data, np.memmap) else False,
+        meta=np.empty((0,) * data.ndim, dtype=data.dtype),
+    )
+
+
+def get_duplicated_nbytes(l, msim):
+    """
+    Number of bytes of in-memory layer data that are copied
+    rather than referenced by the msim created from the layer.
+
+    Lazy (e.g. dask backed) layer data is not held in memory
+    and therefore never counted as duplicated.
+    """
+
+    ldata = l.data[0] if l.multiscale else l.data
+
+    if isinstance(ldata, xr.DataArray):
+        ldata = ldata.data
+
+    if not isinstance(ldata, np.ndarray):
+        return 0
+
+    data = msi_utils.get_sim_from_msim(msim).data
+    if not isinstance(data, da.Array):
+        return 0 if np.shares_memory(np.asarray(data), ldata) else ldata.nbytes
+
+    # evaluate the task producing the first chunk, as dask.compute
+    # copies results when finalizing them
+    first_block = dask_get(
+        dict(data.__dask_graph__()), (data.name,) + (0,) * data.ndim)
+
+    return 0 if np.shares_memory(first_block, ldata) else ldata.nbytes
+
+
+# tokens of layer data, keyed by layer
+_layer_tokens = weakref.WeakKeyDictionary()
+
+
+def get_layer_identity(l):
+    """
+    Identify the data of a layer, also across sessions.
+
+    Layers read from a file are identified by the file's signature
+    (path, size and modification time) and the layer name. Otherwise
+    the data is tokenized, i.e. in-memory arrays are hashed and lazy
+    (dask) arrays are identified by their graph. Tokens are memoized
+    per layer until its data is replaced or its data event is emitted.
+    """
+
+    if l.source.path is not None and os.path.exists(l.source.path):
+        return [_utils.get_file_signature(l.source.path), l.name]
+
+    ldata = l.data[0] if l.multiscale else l.data
+
+    if isinstance(ldata, xr.DataArray):
+        ldata = ldata.data
+
+    if l in _layer_tokens and _layer_tokens[l][0] is ldata:
+        return _layer_tokens[l][1]
+
+    if l not in _layer_tokens:
+        l.events.data.connect(partial(_forget_layer_token, weakref.ref(l)))
+
+    token = tokenize(ldata)
+    _layer_tokens[l] = (ldata, token)
+
+    return token
+
+
+def _forget_layer_token(layer_ref, event=None):
+    layer = layer_ref()
+    if layer is not None:
+        _layer_tokens[layer] = (None, None)
+
+
+def assign_layer_channel_coords(sim, l):
+    """
+    Assign channel coordinates to a sim created from a layer.
+
+    Multi-channel layers keep their channel names if available
+    (xarray coordinates or aicsimageio metadata). Single channel
+    layers are named after the channel part of the layer name.
+    """
+
+    if 'c' in sim.dims:
+        if isinstance(l.data, xr.DataArray) and 'c' in l.data.coords:
+            ch_coords = l.data.coords['c'].values
+        elif 'aicsimage' in l.metadata \
+                and 'C' in l.metadata['aicsimage'].coords:
+            ch_coords = l.metadata['aicsimage'].coords['C'].values
+        else:
+            ch_coords = ['ch%03d' % ich for ich in range(len(sim.coords['c']))]
+        return sim.assign_coords(c=[str(ch) for ch in ch_coords])
+
+    if len(l.name.split(' :: ')) > 1:
+        return sim.assign_coords(c=l.name.split(' :: ')[-1])
+    else:
+        return sim.assign_coords(c='default_channel')
+
+
+def get_sim_from_multiscale_layer_level(l, viewer, level):
+    """
+    Convert a resolution level of a multiscale layer containing
+    array (e.g. numpy or dask) data into a SpatialImage.
+
+    The spacing of the level is inferred from the ratio between
+    the shapes of the highest resolution level and the level.
+
+    Parameters
+    ----------
+    l : napari.layers.Image
+        Multiscale layer.
+    viewer : napari.Viewer
+    level : int
+        Index of the resolution level.
+
+    Returns
+    -------
+    SpatialImage
+    """
+
+    dims = get_layer_dims(l, viewer)
+    sdims = [dim for dim in dims if dim in ['x', 'y', 'z']]
+
+    data = l.data[level]
+    shape0 = l.data[0].shape
+
+    factors = {dim: shape0[dims.index(dim)] / data.shape[dims.index(dim)]
+               for dim in sdims}
+
+    if not 't' in dims:
+        dims = ['t'] + dims
+        data = data[np.newaxis]
+
+    if not isinstance(data, da.Array):
+        data = wrap_array_as_dask(data, dims)
+
+    # pixels of lower resolution levels are centered on the
+    # pixels of the highest resolution they were binned from
+    sim = to_spatial_image(
+        data,
+        scale={dim: s * factors[dim]
+               for dim, s in zip(sdims, l.scale[-len(sdims):])},
+        translation={dim: t + (factors[dim] - 1) / 2 * s
+                     for dim, s, t in zip(
+                        sdims, l.scale[-len(sdims):],
+                        l.translate[-len(sdims):])},
+        dims=dims,
+    )
+
+    sim = assign_layer_channel_coords(sim, l)
+
+    return sim
+
+
 def image_layer_to_msim(l, viewer):
 
     """
@@ -87,17 +303,34 @@ def image_layer_to_msim(l, viewer):
 
             # convert to SpatialImage if necessary
             if not isinstance(ldata, xr.DataArray):
-                # need to implement downsampling logic for this
-                raise(NotImplementedError('Multiscale layers with non-xarray data not supported yet.'))
+                sim = get_sim_from_multiscale_layer_level(l, viewer, isim)
             else:
                 sdims = spatial_image_utils.get_spatial_dims_from_sim(ldata)
 
-                ldata = ldata.assign_coords({'c': str(ldata.coords['c'].values)})
+                if 'c' in ldata.dims:
+                    ldata = ldata.assign_coords(
+                        {'c': [str(ch) for ch in ldata.coords['c'].values]})
+                else:
+                    ldata = ldata.assign_coords(
+                        {'c': str(ldata.coords['c'].values)})
+
+                # the layer's scale and translate refer to the highest
+                # resolution, lower resolutions keep their relative
+                # spacing and origin
+                level_spacing = spatial_image_utils.get_spacing_from_sim(ldata)
+                level_origin = spatial_image_utils.get_origin_from_sim(ldata)
+                if isim == 0:
+                    spacing0, origin0 = level_spacing, level_origin
 
                 sim = to_spatial_image(
                     ldata,
-                    scale={dim: s for dim, s in zip(sdims, l.scale[-len(sdims):])},
-                    translation={dim: t for dim, t in zip(sdims, l.translate[-len(sdims):])},
+                    scale={dim: s * level_spacing[dim] / spacing0[dim]
+                           for dim, s in zip(sdims, l.scale[-len(sdims):])},
+                    translation={dim: t + (level_origin[dim] - origin0[dim])
+                                 * s / spacing0[dim]
+                                 for dim, s, t in zip(
+                                     sdims, l.scale[-len(sdims):],
+                                     l.translate[-len(sdims):])},
                     dims=ldata.dims,
                 )
 
@@ -112,18 +345,18 @@ def image_layer_to_msim(l, viewer):
 
         sdims = [dim for dim in dims if dim in ['x', 'y', 'z']]
 
-        if not 't' in dims:
-            dims = ['t'] + dims
-            ldata = ldata[np.newaxis]
-
         # make sure to work with dask array
         if isinstance(ldata, xr.DataArray):
             data = ldata.data
         else:
             data = ldata
 
+        if not 't' in dims:
+            dims = ['t'] + dims
+            data = data[np.newaxis]
+
         if not isinstance(data, da.Array):
-            data = da.from_array(data)
+            data = wrap_array_as_dask(data, dims)
 
         sim = to_spatial_image(
             data,
@@ -132,12 +365,9 @@ def image_layer_to_msim(l, viewer):
             dims=dims,
         )
 
-        if len(l.name.split(' :: ')) > 1:
-            sim = sim.assign_coords(c=l.name.split(' :: ')[-1])
-        else:
-            sim = sim.assign_coords(c='default_channel')
+        sim = assign_layer_channel_coords(sim, l)
             
-        msim = to_multiscale(sim, scale_factors=[])
+        msim = msi_utils.get_msim_from_sim(sim, scale_factors=[])
         
     ndim = spatial_image_utils.get_ndim_from_sim(msi_utils.get_sim_from_msim(msim))
     affine = np.array(l.affine.affine_matrix)[-(ndim+1):, -(ndim+1):]
@@ -149,6 +379,92 @@ def image_layer_to_msim(l, viewer):
     return msim
 
 
+def get_pyramid_scale_factors(spatial_shape, min_size=256, factor=2):
+    """
+    Determine scale factors for a resolution pyramid.
+
+    Levels are added until the lowest resolution fits into min_size
+    in y and x. z is not downsampled, as it is typically much smaller
+    and more coarsely sampled than y and x.
+
+    Parameters
+    ----------
+    spatial_shape : dict
+        Shape of the highest resolution level for each spatial dimension.
+    min_size : int, optional
+        Size in y and x below which no further levels are added,
+        by default 256.
+    factor : int, optional
+        Downsampling factor between subsequent levels, by default 2.
+
+    Returns
+    -------
+    list of dict
+        Relative scale factors of each level with respect to the previous
+        one, as expected by msi_utils.get_msim_from_sim.
+    """
+
+    scale_factors = []
+    shape = dict(spatial_shape)
+    while max(shape[dim] for dim in ['y', 'x']) > min_size:
+        level_factors = {dim: factor if dim in ['y', 'x'] and
+                         shape[dim] // factor > 0 else 1
+                         for dim in shape}
+        shape = {dim: shape[dim] // level_factors[dim] for dim in shape}
+        scale_factors.append(level_factors)
+
+    return scale_factors
+
+
+def get_msim_pyramid(sim, scale_factors=None, store_path=None):
+    """
+    Lazily build a resolution pyramid for a sim.
+
+    Parameters
+    ----------
+    sim : SpatialImage
+    scale_factors : list, optional
+        Relative scale factors of each level. By default determined
+        from the tile size using get_pyramid_scale_factors.
+    store_path : str, optional
+        If given, the pyramid is persisted into a zarr store at this
+        location (computing it once) and loaded from there subsequently.
+        The store is marked as complete and recently used, for least
+        recently used eviction using _cache.evict.
+
+    Returns
+    -------
+    MultiscaleSpatialImage
+    """
+
+    if scale_factors is None:
+        scale_factors = get_pyramid_scale_factors(
+            spatial_image_utils.get_shape_from_sim(sim))
+
+    if store_path is not None and _cache.is_complete(store_path):
+        _cache.mark_used(store_path)
+        return msi_utils.multiscale_spatial_image_from_zarr(store_path)
+
+    msim = msi_utils.get_msim_from_sim(sim, scale_factors=scale_factors)
+
+    if store_path is None:
+        return msim
+
+    # write to a temporary location first to avoid leaving
+    # incomplete stores behind
+    tmp_store_path = str(store_path) + '.tmp'
+    with _cache.ActiveEntry(tmp_store_path):
+        if os.path.exists(tmp_store_path):
+            shutil.rmtree(tmp_store_path)
+        msi_utils.multiscale_spatial_image_to_zarr(msim, tmp_store_path)
+        _cache.mark_complete(tmp_store_path)
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path)
+        os.replace(tmp_store_path, store_path)
+
+    return msi_utils.multiscale_spatial_image_from_zarr(store_path)
+
+
 def add_image_layer_tuples_to_viewer(
         viewer, lds,
         do_link_layers=False,
@@ -179,6 +495,86 @@ def add_image_layer_tuples_to_viewer(
     return layers
 
 
+# percentiles of the intensity distribution used as default contrast limits
+DEFAULT_CONTRAST_PERCENTILES = (0.1, 99.9)
+
+
+def estimate_contrast_limits(
+        msims,
+        percentiles=DEFAULT_CONTRAST_PERCENTILES,
+        max_tiles=16,
+        max_samples_per_tile=2**16,
+        ):
+    """
+    Estimate contrast limits for each channel, shared across tiles.
+
+    Intensities are sampled from the lowest resolution level of the
+    first timepoint using a regular stride, and all samples are computed
+    in a single batched dask computation. For large numbers of tiles,
+    only max_tiles evenly spaced tiles are sampled.
+
+    Parameters
+    ----------
+    msims : list of MultiscaleSpatialImage
+    percentiles : tuple of float, optional
+        Lower and upper percentiles of the sampled intensities,
+        by default DEFAULT_CONTRAST_PERCENTILES. (0, 100) corresponds
+        to minimum and maximum.
+    max_tiles : int, optional
+        Maximum number of tiles to sample, by default 16.
+    max_samples_per_tile : int, optional
+        Approximate maximum number of pixels sampled per tile and channel,
+        by default 2**16.
+
+    Returns
+    -------
+    dict
+        Contrast limits [lower, upper] for each channel name.
+    """
+
+    tile_indices = np.unique(np.linspace(
+        0, len(msims) - 1, min(len(msims), max_tiles)).astype(int))
+
+    ch_names, samples = [], []
+    for itile in tile_indices:
+        msim = msims[itile]
+        scale_keys = msi_utils.get_sorted_scale_keys(msim)
+        sim = msi_utils.get_sim_from_msim(msim, scale=scale_keys[-1])
+
+        if 't' in sim.dims:
+            sim = sim.isel(t=0)
+
+        sdims = spatial_image_utils.get_spatial_dims_from_sim(sim)
+        n_pixels = np.prod([sim.sizes[dim] for dim in sdims])
+        stride = int(np.ceil(
+            (n_pixels / max_samples_per_tile) ** (1 / len(sdims))))
+
+        for ch_name in _get_ch_names(sim):
+            sim_ch = sim.sel(c=ch_name) if 'c' in sim.dims else sim
+            ch_names.append(ch_name)
+            samples.append(
+                sim_ch.isel({dim: slice(None, None, stride)
+                             for dim in sdims}).data.ravel())
+
+    samples = compute(*samples)
+
+    contrast_limits = {}
+    for ch_name in np.unique(ch_names):
+        ch_samples = np.concatenate([
+            sample for sample_ch_name, sample in zip(ch_names, samples)
+            if sample_ch_name == ch_name])
+        limits = [float(v) for v in np.percentile(ch_samples, percentiles)]
+        if limits[0] == limits[1]:
+            limits[1] = limits[1] + 1
+        contrast_limits[str(ch_name)] = limits
+
+    return contrast_limits
+
+
+def _get_ch_names(sim):
+    return [str(ch) for ch in np.atleast_1d(sim.coords['c'].values)]
+
+
 def create_image_layer_tuples_from_msim(
     msim,
     colormap=None,
@@ -188,12 +584,22 @@ def create_image_layer_tuples_from_msim(
     contrast_limits=None,
     blending='additive',
     data_as_array=False,
+    contrast_percentiles=DEFAULT_CONTRAST_PERCENTILES,
     ):
 
     """
+    contrast_limits can be a list [lower, upper] or a dict containing
+    these for each channel. If None, they're estimated from the data
+    using estimate_contrast_limits and contrast_percentiles.
     """
 
     if 'c' in msi_utils.get_dims(msim):
+
+        # estimate all channels in one computation
+        if contrast_limits is None:
+            contrast_limits = estimate_contrast_limits(
+                [msim], percentiles=contrast_percentiles)
+
         out_layers = []
         for ch_coord in msi_utils.get_sim_from_msim(msim).coords['c']:
 
@@ -206,6 +612,7 @@ def create_image_layer_tuples_from_msim(
                 contrast_limits=contrast_limits,
                 blending=blending,
                 data_as_array=data_as_array,
+                contrast_percentiles=contrast_percentiles,
                 )
             
         return out_layers
@@ -220,19 +627,15 @@ def create_image_layer_tuples_from_msim(
 
     sim = msi_utils.get_sim_from_msim(msim)
 
+    if ch_name is None:
+        ch_name = _get_ch_names(sim)[0]
+
     if contrast_limits is None:
-        sim_thumb = msim[scale_keys[-1]]['image'].sel(t=sim.coords['t'][0])
-        contrast_limits = [
-            compute(np.min(sim_thumb.data))[0],
-            compute(np.max(sim_thumb.data))[0]]
-        if contrast_limits[0] == contrast_limits[1]:
-            contrast_limits[1] = contrast_limits[1] + 1
+        contrast_limits = estimate_contrast_limits(
+            [msim], percentiles=contrast_percentiles)
 
-    if ch_name is None:
-        try:
-            ch_name = str(sim.coords['c'].values[0])
-        except:
-            ch_name = str(sim.coords['c'].data)
+    if isinstance(contrast_limits, dict):
+        contrast_limits = contrast_limits[ch_name]
 
     if colormap is None:
         if 'GFP' in ch_name:
@@ -305,6 +708,7 @@ def create_image_layer_tuples_from_msims(
         contrast_limits=None,
         ch_coord=None,
         data_as_array=False,
+        contrast_percentiles=DEFAULT_CONTRAST_PERCENTILES,
 ):
 
     if positional_cmaps and len(msims) > 1:
@@ -317,11 +721,19 @@ def create_image_layer_tuples_from_msims(
     else:
         cmaps = [None for _ in msims]
 
+    if ch_coord is not None:
+        msims = [msi_utils.multiscale_sel_coords(msim, {'c': ch_coord})
+                 for msim in msims]
+
+    # shared contrast limits for all tiles of a channel
+    if contrast_limits is None:
+        contrast_limits = estimate_contrast_limits(
+            msims, percentiles=contrast_percentiles)
+
     out_layers = []
     for iview, msim in enumerate(msims):
         out_layers += create_image_layer_tuples_from_msim(
-            msim if ch_coord is None
-            else msi_utils.multiscale_sel_coords(msim, {'c': ch_coord}),
+            msim,
             cmaps[iview],
             name_prefix=name_prefix + '_%03d' %iview,
             transform_key=transform_key,